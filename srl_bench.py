@@ -0,0 +1,233 @@
+import srl_upgrade
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+#Benchmark for the parse, save and compare stages of srl_upgrade.py against synthetic SR Linux json_ietf payloads.
+#Each stage is run on a freshly generated payload at every scale point and its run time and peak memory are reported
+
+BENCH_HOSTNAME = 'bench-tor'
+
+def gnmi_response(module_name,val):
+    #Same shape pygnmi hands back for a single path json_ietf get
+    return {'notification': [{'timestamp': 0, 'prefix': None, 'alias': None, 'atomic': False,
+                              'update': [{'path': module_name.split(':')[-1], 'val': {module_name : val}}]}]}
+
+def mac_address(index):
+    return ':'.join('%02x' % ((index >> shift) & 0xff) for shift in (40,32,24,16,8,0))
+
+def ipv4_address(index):
+    return '10.%d.%d.%d' % ((index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
+
+def generate_version(layout):
+    return gnmi_response('srl_nokia-system:version', 'v22.11.2-74-g39f3b1b9b7' if layout == 'v22' else 'v23.10.1-218-ga3fc1bea5a')
+
+def generate_interfaces(ports,subinterfaces,arp_entries):
+    #ethernet-1/N ports with subinterfaces, the arp neighbors are spread across every subinterface
+    interfaces = []
+    subint_count = ports*subinterfaces
+    for port in range(ports):
+        interface = {'name': 'ethernet-1/'+str(port+1), 'admin-state': 'enable', 'oper-state': 'up',
+                     'description': 'bench port '+str(port+1), 'subinterface': []}
+        for index in range(subinterfaces):
+            subint_number = port*subinterfaces + index
+            neighbors = [{'ipv4-address': ipv4_address(entry), 'link-layer-address': mac_address(entry).upper(),
+                          'origin': 'dynamic', 'expiry-time': '2024-01-01T00:00:00.000Z'}
+                         for entry in range(subint_number, arp_entries, subint_count)]
+            interface['subinterface'].append({'index': index, 'name': interface['name']+'.'+str(index), 'oper-state': 'up',
+                                              'ipv4': {'srl_nokia-interfaces-nbr:arp': {'neighbor': neighbors}}})
+        interfaces.append(interface)
+    return gnmi_response('srl_nokia-interfaces:interface', interfaces)
+
+def generate_network_instances(ports,mac_vrfs,macs_per_vrf):
+    instances = [{'name': 'default', 'type': 'srl_nokia-network-instance:default', 'oper-state': 'up'}]
+    for vrf in range(mac_vrfs):
+        macs = [{'address': mac_address(vrf*macs_per_vrf + index + 1), 'destination': 'ethernet-1/'+str(index%ports + 1)+'.0',
+                 'type': 'learnt', 'last-update': '2024-01-01T00:00:00.000Z'} for index in range(macs_per_vrf)]
+        instances.append({'name': 'mac-vrf-'+str(vrf+1), 'type': 'srl_nokia-network-instance:mac-vrf', 'oper-state': 'up',
+                          'bridge-table': {'mac-learning': {'srl_nokia-bridge-table-mac-learning-entries:learnt-entries': {'mac': macs}}}})
+    return gnmi_response('srl_nokia-network-instance:network-instance', instances)
+
+def generate_bgp_neighbors(bgp_peers,layout):
+    #v22 keeps received routes under a container per family, v23+ under an afi-safi list
+    neighbors = []
+    for peer in range(bgp_peers):
+        neighbor = {'peer-address': ipv4_address(peer+1), 'session-state': 'established'}
+        if layout == 'v22':
+            neighbor.update({'ipv4-unicast': {'received-routes': 100}, 'ipv6-unicast': {'received-routes': 50},
+                             'evpn': {'received-routes': 1000}})
+        else:
+            neighbor['afi-safi'] = [{'afi-safi-name': 'srl_nokia-common:evpn', 'received-routes': 1000},
+                                    {'afi-safi-name': 'srl_nokia-common:ipv4-unicast', 'received-routes': 100},
+                                    {'afi-safi-name': 'srl_nokia-common:ipv6-unicast', 'received-routes': 50}]
+        neighbors.append(neighbor)
+    return gnmi_response('srl_nokia-network-instance:neighbor', neighbors)
+
+def generate_tor_data(options):
+    #A parsed tor_data dict with every saved section, used by the save and compare stages
+    hostname = BENCH_HOSTNAME
+    tor_data = {}
+    tor_data['version'] = srl_upgrade.parse_srl_version(srl_upgrade.parse_gnmi_result(generate_version(options['layout'])),hostname)
+    tor_data['app'] = {hostname : {'app-'+str(app) : 'running' for app in range(40)}}
+    network_instances = srl_upgrade.parse_gnmi_result(generate_network_instances(options['ports'],options['mac_vrfs'],options['macs_per_vrf']))
+    tor_data['network-instance'] = srl_upgrade.parse_network_instances(network_instances,hostname)
+    tor_data['mac'] = srl_upgrade.parse_mac_information(network_instances,hostname)
+    bgp_neighbors = srl_upgrade.parse_gnmi_result(generate_bgp_neighbors(options['bgp_peers'],options['layout']))
+    if options['layout'] == 'v22':
+        tor_data['bgp'] = srl_upgrade.parse_bgp_gnmi_v22(bgp_neighbors,hostname)
+    else:
+        tor_data['bgp'] = srl_upgrade.parse_bgp_gnmi(bgp_neighbors,hostname)
+    interfaces = srl_upgrade.parse_gnmi_result(generate_interfaces(options['ports'],options['subinterfaces'],options['arp_entries']))
+    tor_data['interface'] = srl_upgrade.parse_interface_status(interfaces,hostname)
+    tor_data['arp'] = srl_upgrade.parse_arp_status(interfaces,hostname)
+    tor_data['fan'] = {hostname : {str(fan) : 'up' for fan in range(1,5)}}
+    tor_data['power'] = {'1' : 'up', '2' : 'up'}
+    tor_data['control'] = {'A' : {'card_type' : 'imm', 'card_oper_status' : 'up'}}
+    tor_data['linecard'] = {'1' : {'card_type' : 'imm', 'card_oper_status' : 'up'}}
+    tor_data['tunnel'] = {hostname : [ipv4_address(vtep) for vtep in range(1,33)]}
+    tor_data['port'] = {}
+    tor_data['port-shutdown'] = []
+    return tor_data
+
+def churn_tor_data(tor_data,churn):
+    #The post check side: a churn fraction of macs move port and the same fraction of arp entries are relearnt elsewhere.
+    #The entries are sampled with a fixed seed so every run and scale point moves the same share of them
+    picker = random.Random(0)
+    for services in (tor_data['mac'][BENCH_HOSTNAME], tor_data['arp'][BENCH_HOSTNAME]):
+        for entries in services.values():
+            for key in picker.sample(list(entries),round(len(entries)*churn)):
+                entries[key] = 'moved-' + str(entries[key])
+    return tor_data
+
+def scale_options(args,macs):
+    #Every scale point spreads its macs over the mac-vrfs and uses the same number of arp entries
+    return {'layout' : args.layout, 'ports' : args.ports, 'subinterfaces' : args.subinterfaces, 'mac_vrfs' : args.mac_vrfs,
+            'macs_per_vrf' : max(1, macs // args.mac_vrfs), 'arp_entries' : args.arp_entries if args.arp_entries else macs,
+            'bgp_peers' : args.bgp_peers}
+
+def bench_stages(options,compare_workers,churn):
+    #(stage, setup, run) for every stage. setup builds the input outside of the measurement, run gets its result
+    hostname = BENCH_HOSTNAME
+    def parse_bgp(raw_data):
+        bgp_neighbors = srl_upgrade.parse_gnmi_result(raw_data)
+        if options['layout'] == 'v22':
+            return srl_upgrade.parse_bgp_gnmi_v22(bgp_neighbors,hostname)
+        return srl_upgrade.parse_bgp_gnmi(bgp_neighbors,hostname)
+    def write_json(tor_data):
+        srl_upgrade.save_data(tor_data,hostname,'precheck')
+    def write_snapshot(tor_data):
+        srl_upgrade.save_data(tor_data,hostname,'precheck','snapshot')
+    def write_before_and_after():
+        tor_data = generate_tor_data(options)
+        with open(os.devnull,'w') as devnull, contextlib.redirect_stdout(devnull):
+            srl_upgrade.save_data(tor_data,hostname,'precheck')
+            srl_upgrade.save_data(churn_tor_data(tor_data,churn),hostname,'postcheck')
+    def compare(unused):
+        srl_upgrade.compare_data(hostname,compare_workers)
+    return [
+        ('parse_gnmi_result', lambda: generate_network_instances(options['ports'],options['mac_vrfs'],options['macs_per_vrf']),
+         srl_upgrade.parse_gnmi_result),
+        ('parse_bgp_gnmi_'+options['layout'], lambda: generate_bgp_neighbors(options['bgp_peers'],options['layout']), parse_bgp),
+        ('parse_arp_status', lambda: srl_upgrade.parse_gnmi_result(generate_interfaces(options['ports'],options['subinterfaces'],options['arp_entries'])),
+         lambda raw: srl_upgrade.parse_arp_status(raw,hostname)),
+        ('parse_mac_information', lambda: srl_upgrade.parse_gnmi_result(generate_network_instances(options['ports'],options['mac_vrfs'],options['macs_per_vrf'])),
+         lambda raw: srl_upgrade.parse_mac_information(raw,hostname)),
+        ('save_data json', lambda: generate_tor_data(options), write_json),
+        ('save_data snapshot', lambda: generate_tor_data(options), write_snapshot),
+        ('compare_data', write_before_and_after, compare),
+    ]
+
+def measure(setup,run,repeat):
+    #Best run time out of repeat runs, then one more run under tracemalloc for the peak memory above what setup allocated.
+    #Output the stage prints (save/compare progress) is thrown away
+    best_time = None
+    with open(os.devnull,'w') as devnull, contextlib.redirect_stdout(devnull):
+        for attempt in range(repeat):
+            stage_input = setup()
+            start = time.perf_counter()
+            run(stage_input)
+            elapsed = time.perf_counter() - start
+            best_time = elapsed if best_time is None else min(best_time,elapsed)
+        stage_input = setup()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        run(stage_input)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+    return best_time, peak
+
+def run_benchmark(args):
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='srl-bench-')
+    start_dir = os.getcwd()
+    #save_data and compare_data work in the current directory
+    os.chdir(work_dir)
+    try:
+        for macs in args.scale:
+            options = scale_options(args,macs)
+            for stage, setup, run in bench_stages(options,args.compare_workers,args.churn):
+                if args.stages and stage.split(' ')[0] not in args.stages:
+                    continue
+                elapsed, peak = measure(setup,run,args.repeat)
+                result = {'stage' : stage, 'macs' : macs, 'arp' : options['arp_entries'], 'seconds' : elapsed, 'peak_bytes' : peak}
+                results.append(result)
+                print ('%-24s %8d macs %8d arps %10.4f s %10.1f MiB' % (stage, macs, options['arp_entries'], elapsed, peak/1048576))
+    finally:
+        os.chdir(start_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def check_regressions(results,baseline_file,max_regression):
+    #Stages that are more than max_regression percent slower, or use that much more memory, than the saved baseline
+    with open(baseline_file) as infile:
+        baseline = {(result['stage'],result['macs']) : result for result in json.load(infile)}
+    regressions = []
+    for result in results:
+        previous = baseline.get((result['stage'],result['macs']))
+        if not previous:
+            continue
+        for metric in ('seconds','peak_bytes'):
+            if previous[metric] and result[metric] > previous[metric] * (1 + max_regression/100):
+                regressions.append(result)
+                print ('\u001b[31m' + result['stage'] + ' at ' + str(result['macs']) + ' macs regressed on ' + metric + ': ' +
+                       str(round(previous[metric],4)) + ' -> ' + str(round(result[metric],4)) + '\u001b[0;0m')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Time and measure peak memory of the srl_upgrade parse, save and compare stages')
+    parser.add_argument('-scale', action='store', default='1000,10000,100000', help=('comma separated total mac counts to run every stage at'))
+    parser.add_argument('-layout', action='store', choices=['v22','v23'], default='v23', help=('bgp and version layout to generate'))
+    parser.add_argument('-ports', action='store', type=int, default=48, help=('ethernet ports per TOR'))
+    parser.add_argument('-subinterfaces', action='store', type=int, default=4, help=('subinterfaces per port, arp entries are spread over all of them'))
+    parser.add_argument('-mac_vrfs', action='store', type=int, default=20, help=('mac-vrfs the macs are spread over'))
+    parser.add_argument('-arp_entries', action='store', type=int, default=0, help=('arp entries per TOR, 0 uses the mac count of each scale point'))
+    parser.add_argument('-bgp_peers', action='store', type=int, default=64, help=('bgp neighbors in the default network instance'))
+    parser.add_argument('-churn', action='store', type=float, default=0.01, help=('fraction (0 to 1) of macs and arps that move between the before and after data compared'))
+    parser.add_argument('-compare_workers', action='store', type=int, default=1, help=('compare_data workers, 1 keeps the measurement in this process'))
+    parser.add_argument('-repeat', action='store', type=int, default=3, help=('runs per stage, the fastest is reported'))
+    parser.add_argument('-stages', action='store', required=False, help=('comma separated stages to run, default all'))
+    parser.add_argument('-save_results', action='store', required=False, help=('write the results to this json file, to use as a later -baseline'))
+    parser.add_argument('-baseline', action='store', required=False, help=('json results of an earlier run to check for regressions against'))
+    parser.add_argument('-max_regression', action='store', type=float, default=20, help=('percent slower or bigger than the baseline that counts as a regression'))
+    args = parser.parse_args()
+    if not 0 <= args.churn <= 1:
+        parser.error('-churn is a fraction between 0 and 1')
+    args.scale = [int(macs) for macs in args.scale.split(',')]
+    args.stages = args.stages.split(',') if args.stages else None
+
+    results = run_benchmark(args)
+    if args.save_results:
+        with open(args.save_results, "w") as outfile:
+            json.dump(results, outfile, indent=1)
+    if args.baseline and check_regressions(results,args.baseline,args.max_regression):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
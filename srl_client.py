@@ -0,0 +1,94 @@
+import argparse
+import http.client
+import json
+import os
+import socket
+import sys
+
+#Thin client of srl_daemon.py. Only the standard library is imported, so a check costs the round trip to the daemon
+#instead of loading pygnmi and deepdiff and connecting to the TOR
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self,socket_path,timeout=None):
+        super().__init__('localhost',timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def daemon_request(method,path,body=None,daemon='127.0.0.1:8781',socket_path=None,token=None,timeout=None):
+    #(http status, json response) of one request to the daemon
+    if socket_path:
+        connection = UnixHTTPConnection(socket_path,timeout)
+    else:
+        host, _, port = daemon.rpartition(':')
+        connection = http.client.HTTPConnection(host or '127.0.0.1',int(port),timeout=timeout)
+    headers = {'Content-Type' : 'application/json'}
+    if token:
+        headers['Authorization'] = 'Bearer ' + token
+    try:
+        connection.request(method,path,json.dumps(body) if body is not None else None,headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'{}')
+    finally:
+        connection.close()
+
+def print_summary(response):
+    #The compare summary table of a post check or compare response, in the colors of srl_upgrade.py
+    for row in response.get('summary',[]):
+        color = '\033[1;31m' if row['status'] == 'different' else '\033[1;32m'
+        changes = ', '.join(change + ' ' + str(count) for change, count in row['counts'].items())
+        print (color + '{:<18} {:<10} {:>7} {:>9}  {}'.format(row['section'],row['status'],row['groups'],row['entries'],changes) + '\033[0;0m')
+
+def main():
+    parser = argparse.ArgumentParser(description='Run SR Linux upgrade checks through srl_daemon.py')
+    parser.add_argument('-daemon', action='store', default='127.0.0.1:8781', help=('host:port of the daemon'))
+    parser.add_argument('-socket', action='store', required=False, help=('unix socket of the daemon, instead of -daemon'))
+    parser.add_argument('-token_env', action='store', required=False, help=('environment variable holding the daemon token'))
+    parser.add_argument('-timeout', action='store', type=float, default=None, help=('seconds to wait for the daemon'))
+    parser.add_argument('-hostname', action='store', required=False, help=('TOR to run the check on'))
+    parser.add_argument('-pre_check', action='store', required=False, help=('set flag to run the pre check'))
+    parser.add_argument('-drain', action='store', required=False, help=('set flag to also enter bgp maint mode and shut the access ports in the pre check'))
+    parser.add_argument('-post_check', action='store', required=False, help=('set flag to run the post check and compare'))
+    parser.add_argument('-compare', action='store', required=False, help=('set flag to diff the saved pre and post check only'))
+    parser.add_argument('-no_shut_ports', action='store', required=False, help=('set flag to exit bgp maint mode and enable the ports shut by the pre check'))
+    parser.add_argument('-approval_policy', action='store', required=False, help=('json file of approvals sent with -drain and -no_shut_ports, it can only deny more than the daemon policy'))
+    parser.add_argument('-diff_limit', action='store', required=False, help=('entries returned per group of differences, e.g. 20,mac=200'))
+    parser.add_argument('-state', action='store', required=False, help=('print the latest collected state of -hostname, or one section of it'))
+    parser.add_argument('-health', action='store', required=False, help=('set flag to print the health of every TOR'))
+    parser.add_argument('-json', action='store', required=False, help=('set flag to print the whole json response'))
+    args = parser.parse_args()
+
+    token = os.environ.get(args.token_env) if args.token_env else None
+    body = {}
+    if args.diff_limit:
+        body['diff_limit'] = args.diff_limit
+    if args.approval_policy:
+        with open(args.approval_policy) as infile:
+            body['approvals'] = json.load(infile)
+    if args.health:
+        method, path = 'GET', '/health'
+    elif args.state:
+        method, path = 'GET', '/devices/' + args.hostname + '/state' + ('' if args.state in ('True','all') else '?section=' + args.state)
+    else:
+        actions = [action for action, flag in (('pre_check',args.pre_check),('post_check',args.post_check),('compare',args.compare),('no_shut',args.no_shut_ports)) if flag]
+        if len(actions) != 1 or not args.hostname:
+            parser.error('pass -hostname with one of -pre_check, -post_check, -compare or -no_shut_ports, or -health or -state')
+        if args.drain:
+            body['drain'] = True
+        method, path = 'POST', '/devices/' + args.hostname + '/' + actions[0]
+    status, response = daemon_request(method,path,body,args.daemon,args.socket,token,args.timeout)
+    if args.json or method == 'GET' or status != 200:
+        print (json.dumps(response,indent=2))
+    else:
+        print (response['hostname'] + ' ' + response['action'] + ' in ' + str(response['seconds']) + 's, version ' + str(response.get('version')))
+        if response.get('port_issues'):
+            print ('\033[1;31m flapping or erroring ports: ' + ', '.join(response['port_issues']) + '\033[0;0m')
+        print_summary(response)
+        print (('\033[1;32m ok' if response['ok'] else '\033[1;31m not ok') + '\033[0;0m')
+    sys.exit(0 if status == 200 and response.get('ok',True) else 1)
+
+if __name__ == "__main__":
+    main()
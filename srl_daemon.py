@@ -0,0 +1,337 @@
+import srl_upgrade
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import socketserver
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+#Keeps a warm gnmi session to every TOR of an inventory and serves pre checks, post checks, compares and no shuts over
+#http or a unix socket. Callers (srl_client.py, orchestration) skip the python start up, imports and connects of a cold
+#srl_upgrade.py run, and the latest collected state of every TOR is kept in memory
+
+DEFAULT_LISTEN = '127.0.0.1:8781'
+
+def open_tors(devices,options):
+    #One entry per TOR: its session (connected on first use and after a failed health check), a lock so one request
+    #runs against a TOR at a time, its health and the latest state collected from it
+    tors = {}
+    for device in devices:
+        session = srl_upgrade.GnmiSession((device['ip'],device.get('port','57400')),device['username'],device['password'],device['hostname'],options.get('insecure',False),options.get('retry_policy'))
+        tors[device['hostname']] = {'device' : device, 'session' : session, 'lock' : threading.Lock(),
+                                    'health' : {'ok' : None, 'checked' : None, 'latency' : None, 'version' : None, 'error' : None}, 'state' : None}
+    return tors
+
+def check_health(tor,options):
+    #Fetches the version over the warm session. A TOR busy with a request is skipped, the request shows whether the
+    #session works. A failed check closes the session so the next call reconnects
+    if not tor['lock'].acquire(blocking=False):
+        return
+    try:
+        hostname = tor['device']['hostname']
+        start = time.perf_counter()
+        try:
+            version = srl_upgrade.collect_tor_data(tor['session'],hostname,options['batch'],options['batch_size'],options['pruned'],None,None,['version'])['version'][hostname]
+            tor['health'] = {'ok' : True, 'checked' : datetime.now().isoformat(), 'latency' : round(time.perf_counter() - start,3), 'version' : version, 'error' : None}
+        except Exception as ex:
+            logging.debug(hostname + ' health check failed: ' + str(ex))
+            tor['session'].close()
+            tor['health'] = dict(tor['health'], ok=False, checked=datetime.now().isoformat(), latency=None, error=str(ex))
+    finally:
+        tor['lock'].release()
+
+def health_loop(tors,options,interval,stop):
+    while not stop.is_set():
+        for tor in tors.values():
+            if stop.is_set():
+                break
+            check_health(tor,options)
+        stop.wait(interval)
+
+def daemon_approvals(approvals,requested=None):
+    #Nobody can answer a prompt on the daemon, actions left to prompt are denied. The approvals of a request can only
+    #narrow the daemon's -approval_policy (deny an action or lower max_shutdown_ports), never approve more than it does
+    approvals = dict(approvals or {})
+    for action in srl_upgrade.APPROVAL_ACTIONS:
+        if approvals.get(action,'prompt') == 'prompt' or (requested or {}).get(action,'approve') != 'approve':
+            approvals[action] = 'deny'
+    if (requested or {}).get('max_shutdown_ports') is not None:
+        approvals['max_shutdown_ports'] = min(int(requested['max_shutdown_ports']),approvals.get('max_shutdown_ports',int(requested['max_shutdown_ports'])))
+    return approvals
+
+def cache_state(tor,phase,tor_data):
+    tor['state'] = {'phase' : phase, 'collected' : datetime.now().isoformat(), 'sections' : tor_data}
+
+def port_issues(tor_data,hostname):
+    return [port for port in tor_data['port'][hostname] if tor_data['port'][hostname][port]['port_issues']]
+
+def truncated_result(result,limit):
+    #A section result with at most limit entries per group, the group counts keep the full numbers
+    groups = [dict(group, entries=group['entries'][:limit] if limit else group['entries'], total_entries=len(group['entries'])) for group in result['groups']]
+    return dict(result, groups=groups)
+
+def compare_tor(hostname,daemon,diff_limits,skip_sections=()):
+    #Diffs the saved pre and post check on the daemon's warm process pool into <hostname>-compare.txt and
+    #<hostname>-compare.jsonl. Returns the summary rows and the section results, truncated to diff_limits
+    sections = [section for section, comparator in srl_upgrade.SECTION_COMPARATORS if section not in skip_sections]
+    kept = []
+
+    def keep_results(section_results):
+        for section, result in section_results:
+            kept.append(truncated_result(result[0],diff_limits.get(section,diff_limits['default'])))
+            yield section, result
+
+    section_results = srl_upgrade.compare_sections(hostname,sections,daemon['compare_workers'],None,daemon['compare_pool'])
+    with open(hostname+'-compare.txt', "w") as outfile:
+        rows = srl_upgrade.report_compare(hostname,keep_results(section_results),diff_limits,hostname+'-compare.jsonl',outfile)
+    return rows, kept
+
+def compare_response(hostname,daemon,request,skip_sections=()):
+    diff_limits = srl_upgrade.parse_diff_limits(request.get('diff_limit'))
+    allowed = request.get('allowed_differences',['version'])
+    rows, results = compare_tor(hostname,daemon,diff_limits,skip_sections)
+    differences = [row['section'] for row in rows if row['status'] == 'different']
+    return {'differences' : differences, 'unexpected_differences' : [section for section in differences if section not in allowed],
+            'summary' : rows, 'sections' : results, 'report' : hostname+'-compare.jsonl'}
+
+def run_pre_check(tor,daemon,request):
+    #Collects and saves the pre check. With drain set, also enters bgp maintenance mode and shuts the access ports, as
+    #far as the daemon's -approval_policy (narrowed by the request's approvals) allows
+    hostname, session, options = tor['device']['hostname'], tor['session'], daemon['options']
+    tor_data = srl_upgrade.collect_and_check(session,hostname,'precheck',options)
+    srl_upgrade.save_data(tor_data,hostname,'precheck',options['save_format'],options['snapshot_encoding'],options['history_db'])
+    srl_upgrade.clear_checkpoint(srl_upgrade.checkpoint_dir_name(hostname,'before'))
+    cache_state(tor,'before',tor_data)
+    response = {'version' : tor_data['version'][hostname], 'port_issues' : port_issues(tor_data,hostname), 'port_shutdown' : tor_data['port-shutdown'][hostname]}
+    if request.get('drain'):
+        approvals = daemon_approvals(daemon['approvals'],request.get('approvals'))
+        atomic_maint = request.get('atomic_maint',daemon['atomic_maint'])
+        maint_update = srl_upgrade.enter_bgp_maint_mode(session,not atomic_maint,approvals)
+        response['maint_mode'] = maint_update is not None
+        response['ports_shut'] = srl_upgrade.shutdown_access_ports(tor_data['port-shutdown'],session,hostname,[maint_update] if atomic_maint and maint_update else None,
+                                                                   daemon['set_chunk_size'],approvals)
+    response['ok'] = not response['port_issues'] and response.get('maint_mode',True) and response.get('ports_shut',True)
+    return response
+
+def run_post_check(tor,daemon,request):
+    hostname, session, options = tor['device']['hostname'], tor['session'], daemon['options']
+    tor_data = srl_upgrade.collect_and_check(session,hostname,'postcheck',options)
+    srl_upgrade.save_data(tor_data,hostname,'postcheck',options['save_format'],options['snapshot_encoding'],options['history_db'])
+    srl_upgrade.clear_checkpoint(srl_upgrade.checkpoint_dir_name(hostname,'after'))
+    cache_state(tor,'after',tor_data)
+    response = {'version' : tor_data['version'][hostname], 'port_issues' : port_issues(tor_data,hostname)}
+    if request.get('compare',True):
+        response.update(compare_response(hostname,daemon,request,srl_upgrade.skipped_sections(tor_data,hostname)))
+    response['ok'] = not response['port_issues'] and not response.get('unexpected_differences')
+    return response
+
+def run_compare(tor,daemon,request):
+    #Sections the saved tiered post check left out are not diffed, they have no current data to diff
+    hostname = tor['device']['hostname']
+    skip_sections = srl_upgrade.saved_skipped_sections(hostname)
+    response = compare_response(hostname,daemon,request,skip_sections)
+    response['ok'] = not response['unexpected_differences']
+    return response
+
+def run_no_shut(tor,daemon,request):
+    #Exits bgp maintenance mode (if approved) and enables the ports saved by the pre check, in one set with atomic_maint
+    hostname, session = tor['device']['hostname'], tor['session']
+    approvals = daemon_approvals(daemon['approvals'],request.get('approvals'))
+    atomic_maint = request.get('atomic_maint',daemon['atomic_maint'])
+    maint_update = srl_upgrade.exit_bgp_maint_mode(session,not atomic_maint,approvals)
+    srl_upgrade.no_shutdown_access_ports(session,hostname,[maint_update] if atomic_maint and maint_update else None,daemon['set_chunk_size'])
+    return {'maint_mode_exited' : maint_update is not None, 'ports_enabled' : srl_upgrade.load_section(hostname,'before','port-shutdown')[hostname],
+            'ok' : maint_update is not None}
+
+ACTIONS = {
+    'pre_check' : run_pre_check,
+    'post_check' : run_post_check,
+    'compare' : run_compare,
+    'no_shut' : run_no_shut,
+}
+
+def run_action(daemon,hostname,action,request):
+    #(http status, response). One request per TOR at a time, a second one gets 409 instead of queueing behind a change
+    tor = daemon['tors'].get(hostname)
+    if tor is None:
+        return 404, {'error' : 'unknown TOR ' + hostname}
+    if not tor['lock'].acquire(blocking=False):
+        return 409, {'error' : hostname + ' is busy with another request'}
+    start = time.perf_counter()
+    try:
+        srl_upgrade.set_metrics_device(hostname)
+        response = ACTIONS[action](tor,daemon,request)
+    except Exception as ex:
+        logging.debug(hostname + ' ' + action + ' failed: ' + str(ex))
+        tor['session'].close()
+        return 500, {'error' : str(ex), 'hostname' : hostname, 'action' : action}
+    finally:
+        tor['lock'].release()
+    response.update({'hostname' : hostname, 'action' : action, 'seconds' : round(time.perf_counter() - start,3)})
+    return 200, response
+
+def device_summary(tor):
+    state = tor['state']
+    return {'ip' : tor['device']['ip'], 'group' : tor['device'].get('group'), 'health' : tor['health'], 'busy' : tor['lock'].locked(),
+            'state' : {'phase' : state['phase'], 'collected' : state['collected']} if state else None}
+
+def cached_state(tor,section=None):
+    if tor['state'] is None:
+        return 404, {'error' : 'nothing collected from ' + tor['device']['hostname'] + ' yet'}
+    sections = tor['state']['sections']
+    if section is not None:
+        if section not in sections:
+            return 404, {'error' : 'no ' + section + ' section in the latest ' + tor['state']['phase'] + ' check'}
+        sections = {section : sections[section]}
+    return 200, dict(tor['state'], sections=sections)
+
+def handle_request(daemon,method,path,query,request):
+    #Routes:
+    #  GET  /health                        daemon uptime and the health of every TOR
+    #  GET  /devices                       every TOR with its health and latest state
+    #  GET  /devices/<hostname>/state      latest collected state, ?section=bgp for one section
+    #  POST /devices/<hostname>/<action>   pre_check, post_check, compare or no_shut, with a json body
+    parts = [part for part in path.split('/') if part]
+    if method == 'GET' and parts == ['health']:
+        return 200, {'started' : daemon['started'], 'uptime' : round(time.time() - daemon['started_time'],1),
+                     'devices' : {hostname : tor['health'] for hostname, tor in daemon['tors'].items()}}
+    if method == 'GET' and parts == ['devices']:
+        return 200, {hostname : device_summary(tor) for hostname, tor in daemon['tors'].items()}
+    if len(parts) == 3 and parts[0] == 'devices':
+        hostname, action = parts[1], parts[2]
+        if method == 'GET' and action == 'state':
+            if hostname not in daemon['tors']:
+                return 404, {'error' : 'unknown TOR ' + hostname}
+            return cached_state(daemon['tors'][hostname],query.get('section',[None])[0])
+        if method == 'POST' and action in ACTIONS:
+            return run_action(daemon,hostname,action,request)
+    return 404, {'error' : 'no route for ' + method + ' ' + path}
+
+def request_handler(daemon):
+    class DaemonRequestHandler(BaseHTTPRequestHandler):
+        def respond(self,method):
+            if daemon['token'] and self.headers.get('Authorization') != 'Bearer ' + daemon['token']:
+                status, response = 401, {'error' : 'missing or wrong token'}
+            else:
+                url = urlparse(self.path)
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    request = json.loads(self.rfile.read(length) or b'{}') if length else {}
+                    status, response = handle_request(daemon,method,url.path,parse_qs(url.query),request)
+                except ValueError as ex:
+                    status, response = 400, {'error' : 'bad request body: ' + str(ex)}
+            body = json.dumps(response, default=str).encode()
+            self.send_response(status)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.respond('GET')
+
+        def do_POST(self):
+            self.respond('POST')
+
+        def log_message(self,format,*args):
+            #Unix socket clients have no address
+            logging.debug('request: ' + format % args)
+
+    return DaemonRequestHandler
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(daemon,listen=None,socket_path=None):
+    handler = request_handler(daemon)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path,handler)
+        os.chmod(socket_path,0o600)
+        return server
+    host, _, port = (listen or DEFAULT_LISTEN).rpartition(':')
+    return ThreadingHTTPServer((host or '127.0.0.1',int(port)),handler)
+
+def start_daemon(devices,options,approvals=None,atomic_maint=False,set_chunk_size=0,compare_workers=None,health_interval=30,token=None):
+    #The daemon state shared by the request threads, with its health checker running. compare_workers 1 diffs in the
+    #request thread, otherwise on a process pool started once (spawned, as the gnmi threads keep running)
+    daemon = {'tors' : open_tors(devices,options), 'options' : options, 'approvals' : approvals or {}, 'atomic_maint' : atomic_maint,
+              'set_chunk_size' : set_chunk_size, 'compare_workers' : compare_workers, 'token' : token, 'stop' : threading.Event(),
+              'started' : datetime.now().isoformat(), 'started_time' : time.time(),
+              'compare_pool' : None if compare_workers == 1 else concurrent.futures.ProcessPoolExecutor(max_workers=compare_workers,mp_context=multiprocessing.get_context('spawn'))}
+    threading.Thread(target=health_loop,args=(daemon['tors'],options,health_interval,daemon['stop']),daemon=True,name='health').start()
+    return daemon
+
+def stop_daemon(daemon):
+    daemon['stop'].set()
+    for tor in daemon['tors'].values():
+        tor['session'].close()
+    if daemon['compare_pool'] is not None:
+        daemon['compare_pool'].shutdown(cancel_futures=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve SR Linux upgrade checks over http or a unix socket with warm gnmi sessions')
+    parser.add_argument('-inventory', action='store', required=True, help=('csv or yaml inventory of TORs'))
+    parser.add_argument('-username', action='store', required=False, help=('username for inventory entries without one'))
+    parser.add_argument('-password', action='store', required=False, help=('password for inventory entries without one'))
+    parser.add_argument('-gnmi_port', action='store', default='57400', help=('gnmi port for inventory entries without one'))
+    parser.add_argument('-insecure', action='store', required=False, help=('set flag to connect without TLS, for srl_fake_target.py'))
+    parser.add_argument('-listen', action='store', default=DEFAULT_LISTEN, help=('host:port to serve http on'))
+    parser.add_argument('-socket', action='store', required=False, help=('unix socket path to serve on instead of -listen'))
+    parser.add_argument('-token_env', action='store', required=False, help=('environment variable holding a token every request must send as Authorization: Bearer <token>'))
+    parser.add_argument('-health_interval', action='store', type=float, default=30, help=('seconds between health checks of every TOR'))
+    parser.add_argument('-approval_policy', action='store', required=False, help=('json or yaml approvals for drain and no shut requests, prompt means deny. Requests can only deny more'))
+    parser.add_argument('-atomic_maint', action='store', required=False, help=('set flag to send the bgp maint mode change in the same gnmi set as the ports'))
+    parser.add_argument('-set_chunk_size', action='store', type=int, default=0, help=('max updates per gnmi set when shutting or enabling ports'))
+    parser.add_argument('-batch', action='store', required=False, help=('set flag to send all collection paths in one gnmi get'))
+    parser.add_argument('-batch_size', action='store', type=int, default=0, help=('max paths per gnmi get when -batch is set'))
+    parser.add_argument('-pruned', action='store', required=False, help=('set flag to fetch only the state leaves each section uses'))
+    parser.add_argument('-flap_window', action='store', type=int, default=10, help=('max seconds to watch interfaces for flaps and errors'))
+    parser.add_argument('-flap_sample_interval', action='store', type=float, default=2, help=('seconds between error counter samples'))
+    parser.add_argument('-save_format', action='store', choices=['json','snapshot'], default='json', help=('how the pre and post checks are saved'))
+    parser.add_argument('-snapshot_encoding', action='store', choices=['json','msgpack'], default='json', help=('encoding of each snapshot section'))
+    parser.add_argument('-resume', action='store', required=False, help=('set flag to reuse checkpointed sections of a failed pre or post check'))
+    parser.add_argument('-resume_max_age', action='store', type=int, default=3600, help=('seconds a checkpointed section is reused for'))
+    parser.add_argument('-history_db', action='store', required=False, help=('sqlite file every saved pre and post check is also added to'))
+    parser.add_argument('-tiered', action='store', required=False, help=('set flag to only collect and diff the post check sections whose totals changed'))
+    parser.add_argument('-rpc_timeout', action='store', type=float, default=None, help=('seconds a gnmi call may take before it is cancelled and retried, 0 waits forever. Replaces the per path defaults of RPC_TIMEOUTS (60, 300 for /network-instance/, 180 for /interface/)'))
+    parser.add_argument('-retries', action='store', type=int, default=None, help=('retries of a failed or timed out gnmi call, default 3'))
+    parser.add_argument('-retry_backoff', action='store', type=float, default=None, help=('seconds the jittered exponential backoff between retries starts from, default 1'))
+    parser.add_argument('-run_deadline', action='store', type=float, default=srl_upgrade.DEFAULT_RUN_DEADLINE, help=('seconds the whole collection of a pre or post check, retries included, has to finish in, default 900. 0 sets no deadline'))
+    parser.add_argument('-fetch_workers', action='store', type=int, default=4, help=('collection paths fetched in parallel when -batch is not set, 1 fetches them one at a time'))
+    parser.add_argument('-port_policy', action='store', required=False, help=('json or yaml rules deciding which up ports are shut'))
+    parser.add_argument('-compare_workers', action='store', type=int, default=None, help=('processes of the warm compare pool, 1 diffs in the request thread'))
+    parser.add_argument('-debug',action='store', help='Set flag for debug to log all data to files')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(filename=(f'srl_daemon_debug-{datetime.now().strftime("%Y-%m-%d-%H:%M:%S")}.log'), filemode='w',level=logging.DEBUG, format='%(asctime)s %(threadName)s %(message)s')
+    token = None
+    if args.token_env:
+        token = os.environ.get(args.token_env)
+        if not token:
+            raise SystemExit('Environment variable ' + args.token_env + ' is not set')
+    devices = srl_upgrade.load_inventory(args.inventory,args.username,args.password,args.gnmi_port)
+    approvals = srl_upgrade.load_approval_policy(args.approval_policy) if args.approval_policy else None
+    daemon = start_daemon(devices,srl_upgrade.collection_options(args),approvals,bool(args.atomic_maint),args.set_chunk_size,args.compare_workers,args.health_interval,token)
+    server = make_server(daemon,args.listen,args.socket)
+    print ('Serving ' + str(len(devices)) + ' TORs on ' + (args.socket or args.listen))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stop_daemon(daemon)
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+import srl_upgrade
+import srl_bench
+from pygnmi.spec.v080 import gnmi_pb2, gnmi_pb2_grpc
+from pygnmi.create_gnmi_path import gnmi_path_degenerator
+import grpc
+import argparse
+import concurrent.futures
+import json
+import random
+import threading
+import time
+
+#Local stand in for an SR Linux gNMI server. Serves Get/Set/Subscribe (json_ietf) from a recorded or synthetic state tree,
+#with configurable latency, jitter and failure injection, so the whole pre check -> maintenance -> post check flow can be
+#run and load tested without lab hardware. The script connects to it with -insecure True
+
+#Top level containers recorded from a real TOR with -record
+RECORDED_ROOTS = ['system','network-instance','interface','platform','tunnel']
+
+RPC_NAMES = ['capabilities','get','set','subscribe']
+
+def strip_element_prefix(name):
+    return name.split(':')[-1]
+
+def path_elements(prefix,path):
+    #(name, keys) list for a gnmi Path proto, joined to the request prefix
+    elements = []
+    for gnmi_path in (prefix,path):
+        if gnmi_path is None or not gnmi_path.elem:
+            continue
+        elements.extend(srl_upgrade.split_gnmi_path(gnmi_path_degenerator(gnmi_path)))
+    return [(strip_element_prefix(name),keys) for name, keys in elements]
+
+def gnmi_path(elements):
+    return gnmi_pb2.Path(elem=[gnmi_pb2.PathElem(name=name,key={key : str(value) for key, value in keys.items()}) for name, keys in elements])
+
+def entry_matches(entry,keys):
+    return type(entry) is dict and all(value == '*' or str(entry.get(key)) == str(value) for key, value in keys.items())
+
+def expand_path(node,elements,matched=None):
+    #Yields (concrete elements, value, kind) for everything the path points at, wildcard keys match every entry.
+    #kind is list (a whole unkeyed list), entry (one keyed list entry), container or leaf
+    matched = matched or []
+    if not elements:
+        yield matched, node, 'container' if type(node) is dict else 'leaf'
+        return
+    (name, keys), rest = elements[0], elements[1:]
+    if type(node) is not dict:
+        return
+    child = srl_upgrade.get_child(node,name)
+    if child is None:
+        return
+    if type(child) is list:
+        if not keys:
+            if rest:
+                return
+            yield matched + [(name,{})], child, 'list'
+            return
+        for entry in child:
+            if entry_matches(entry,keys):
+                entry_keys = {key : entry.get(key) for key in keys}
+                if rest:
+                    yield from expand_path(entry,rest,matched + [(name,entry_keys)])
+                else:
+                    yield matched + [(name,entry_keys)], entry, 'entry'
+        return
+    yield from expand_path(child,rest,matched + [(name,{})])
+
+def encode_value(name,value,kind):
+    #What SR Linux puts in json_ietf_val: containers and list entries as their content, whole lists under their name
+    if kind == 'list':
+        value = {name : value}
+    return gnmi_pb2.TypedValue(json_ietf_val=json.dumps(value).encode())
+
+def decode_value(typed_value):
+    if typed_value.HasField('json_ietf_val'):
+        return json.loads(typed_value.json_ietf_val)
+    if typed_value.HasField('json_val'):
+        return json.loads(typed_value.json_val)
+    return getattr(typed_value,typed_value.WhichOneof('value'))
+
+def refresh_counters(state):
+    #Set the bridge table and arp counters the -tiered quick check reads from the mac and arp tables of the state. Call it
+    #again after changing the tables
+    for instance in state.get('network-instance',[]):
+        bridge_table = instance.get('bridge-table')
+        if bridge_table is None:
+            continue
+        learnt = bridge_table.get('mac-learning',{}).get('learnt-entries',{}).get('mac',[])
+        bridge_table['statistics'] = {'active-entries' : len(learnt), 'mac-type' : [{'type' : 'learnt', 'active-entries' : len(learnt)}]}
+    for interface in state.get('interface',[]):
+        for subinterface in interface.get('subinterface',[]):
+            arp = subinterface.get('ipv4',{}).get('arp')
+            if arp is None:
+                continue
+            dynamic = [neighbor for neighbor in arp.get('neighbor',[]) if neighbor.get('origin') == 'dynamic']
+            arp['statistics'] = {'total-entries' : len(arp.get('neighbor',[])), 'neighbor-origin' : [{'origin' : 'dynamic', 'total-entries' : len(dynamic)}]}
+    return state
+
+def build_synthetic_state(options,uplinks=4):
+    #A state tree built from the srl_bench payload generators, with the uplinks in the default network instance so the
+    #pre check finds access ports to shut
+    state = {}
+    state['system'] = {
+        'information' : {'version' : srl_upgrade.parse_gnmi_result(srl_bench.generate_version(options['layout']))},
+        'app-management' : {'application' : [{'name' : 'app-'+str(app), 'state' : 'running'} for app in range(40)]},
+        'maintenance' : {'group' : [{'name' : 'ebgp-ipv4-maintenance', 'maintenance-mode' : {'admin-state' : 'disable'}}]},
+    }
+    interfaces = srl_upgrade.parse_gnmi_result(srl_bench.generate_interfaces(options['ports']+uplinks,options['subinterfaces'],options['arp_entries']))
+    for interface in interfaces:
+        interface.update({'last-change' : '2024-01-01T00:00:00.000Z', 'statistics' : {'in-error-packets' : 0, 'out-error-packets' : 0}})
+    state['interface'] = interfaces
+    network_instances = srl_upgrade.parse_gnmi_result(srl_bench.generate_network_instances(options['ports'],options['mac_vrfs'],options['macs_per_vrf']))
+    default_instance = network_instances[0]
+    default_instance['interface'] = [{'name' : 'ethernet-1/'+str(port)+'.0'} for port in range(options['ports']+1,options['ports']+uplinks+1)]
+    default_instance['protocols'] = {'bgp' : {'neighbor' : srl_upgrade.parse_gnmi_result(srl_bench.generate_bgp_neighbors(options['bgp_peers'],options['layout']))}}
+    state['network-instance'] = network_instances
+    state['platform'] = {
+        'fan-tray' : [{'id' : fan, 'oper-state' : 'up'} for fan in range(1,5)],
+        'power-supply' : [{'id' : supply, 'oper-state' : 'up'} for supply in range(1,3)],
+        'control' : [{'slot' : 'A', 'type' : 'imm', 'oper-state' : 'up'}],
+        'linecard' : [{'slot' : 1, 'type' : 'imm', 'oper-state' : 'up'}],
+    }
+    state['tunnel'] = {'vxlan-tunnel' : {'vtep' : [{'address' : srl_bench.ipv4_address(vtep)} for vtep in range(1,33)]}}
+    return refresh_counters(srl_upgrade.strip_module_prefixes(state))
+
+def record_state(session,state_file):
+    #Save the top level containers of a real TOR so they can be served back with -state
+    state = {}
+    for root in RECORDED_ROOTS:
+        raw_data = srl_upgrade.run_gnmi_query(session,'/'+root)
+        value = srl_upgrade.parse_gnmi_result(raw_data)
+        raw_value = raw_data['notification'][0]['update'][0]['val'] if value is not None else None
+        #Lists come back under their own name, containers as their content
+        if type(raw_value) is dict and len(raw_value) == 1 and strip_element_prefix(list(raw_value)[0]) == root:
+            raw_value = list(raw_value.values())[0]
+        if raw_value is not None:
+            state[root] = srl_upgrade.strip_module_prefixes(raw_value)
+    with open(state_file, "w") as outfile:
+        json.dump(state, outfile)
+    print ('Recorded ' + ', '.join(state) + ' to ' + state_file)
+
+class FakeTarget(gnmi_pb2_grpc.gNMIServicer):
+    def __init__(self,state,latency=0,jitter=0,failure_rate=0,fail_rpcs=None,max_message_size=0,flap_ports=None,flap_interval=5,tick=0.1):
+        self.state = state
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.fail_rpcs = fail_rpcs or RPC_NAMES
+        self.max_message_size = max_message_size
+        self.flap_ports = flap_ports or []
+        self.flap_interval = flap_interval
+        self.tick = tick
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.server = None
+        #Per RPC counters, so connection reuse and batching can be measured from the target side
+        self.stats = {rpc : {'calls' : 0, 'failed' : 0, 'paths' : 0, 'response_bytes' : 0} for rpc in RPC_NAMES}
+
+    def start(self,port=57400,address='127.0.0.1',workers=32):
+        #Returns the port the server bound to, port 0 picks a free one
+        options = []
+        if self.max_message_size:
+            options = [('grpc.max_send_message_length', self.max_message_size), ('grpc.max_receive_message_length', self.max_message_size)]
+        self.server = grpc.server(concurrent.futures.ThreadPoolExecutor(max_workers=workers), options=options)
+        gnmi_pb2_grpc.add_gNMIServicer_to_server(self,self.server)
+        bound_port = self.server.add_insecure_port(address+':'+str(port))
+        self.server.start()
+        if self.flap_ports:
+            threading.Thread(target=self.flap_loop,daemon=True).start()
+        return bound_port
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.stop(0)
+
+    def delay_or_fail(self,rpc,context,paths=0):
+        with self.lock:
+            self.stats[rpc]['calls'] += 1
+            self.stats[rpc]['paths'] += paths
+        if rpc in self.fail_rpcs and random.random() < self.failure_rate:
+            with self.lock:
+                self.stats[rpc]['failed'] += 1
+            context.abort(grpc.StatusCode.UNAVAILABLE, 'injected ' + rpc + ' failure')
+        delay = self.latency + random.uniform(-self.jitter,self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def count_response(self,rpc,response):
+        with self.lock:
+            self.stats[rpc]['response_bytes'] += response.ByteSize()
+        return response
+
+    def Capabilities(self,request,context):
+        self.delay_or_fail('capabilities',context)
+        return self.count_response('capabilities', gnmi_pb2.CapabilityResponse(supported_encodings=[gnmi_pb2.JSON_IETF, gnmi_pb2.JSON], gNMI_version='0.8.0'))
+
+    def notification(self,prefix,path):
+        #One notification holding an update for everything a requested path matched
+        elements = path_elements(prefix,path)
+        notification = gnmi_pb2.Notification(timestamp=time.time_ns())
+        with self.lock:
+            for matched, value, kind in expand_path(self.state,elements):
+                name = matched[-1][0] if matched else ''
+                notification.update.add(path=gnmi_path(matched), val=encode_value(name,value,kind))
+        return notification
+
+    def Get(self,request,context):
+        self.delay_or_fail('get',context,len(request.path))
+        response = gnmi_pb2.GetResponse(notification=[self.notification(request.prefix,path) for path in request.path])
+        return self.count_response('get',response)
+
+    def apply_update(self,elements,value):
+        #Merge one set update into the state, creating containers and list entries that are missing
+        node = self.state
+        for index, (name, keys) in enumerate(elements):
+            last_element = index == len(elements) - 1
+            if keys:
+                entries = node.setdefault(name,[])
+                entry = next((entry for entry in entries if entry_matches(entry,keys)), None)
+                if entry is None:
+                    entry = dict(keys)
+                    entries.append(entry)
+                node = entry
+                if last_element and type(value) is dict:
+                    node.update(srl_upgrade.strip_module_prefixes(value))
+            elif last_element:
+                if type(value) is dict:
+                    node.setdefault(name,{}).update(srl_upgrade.strip_module_prefixes(value))
+                else:
+                    node[name] = value
+            else:
+                node = node.setdefault(name,{})
+        #Ports follow their admin state, like a TOR with the far end up
+        for matched, interface, kind in expand_path(self.state,[('interface',{'name' : '*'})]):
+            oper_state = 'down' if interface.get('admin-state') == 'disable' else 'up'
+            if interface.get('oper-state') != oper_state:
+                interface['oper-state'] = oper_state
+                interface['last-change'] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z',time.gmtime())
+
+    def delete_path(self,elements):
+        for matched, value, kind in list(expand_path(self.state,elements)):
+            parent = next(expand_path(self.state,matched[:-1]))[1] if len(matched) > 1 else self.state
+            name, keys = matched[-1]
+            child = srl_upgrade.get_child(parent,name)
+            if keys and type(child) is list:
+                child.remove(value)
+            elif type(parent) is dict:
+                parent.pop(name,None)
+
+    def Set(self,request,context):
+        self.delay_or_fail('set',context,len(request.delete)+len(request.replace)+len(request.update))
+        response = gnmi_pb2.SetResponse(timestamp=time.time_ns())
+        #Every operation in one request is applied together, like a single commit on the TOR
+        with self.lock:
+            for path in request.delete:
+                self.delete_path(path_elements(request.prefix,path))
+                response.response.add(path=path, op=gnmi_pb2.UpdateResult.DELETE)
+            for operation, updates in ((gnmi_pb2.UpdateResult.REPLACE,request.replace),(gnmi_pb2.UpdateResult.UPDATE,request.update)):
+                for update in updates:
+                    self.apply_update(path_elements(request.prefix,update.path),decode_value(update.val))
+                    response.response.add(path=update.path, op=operation)
+        return self.count_response('set',response)
+
+    def leaf_values(self,prefix,subscription):
+        values = {}
+        with self.lock:
+            for matched, value, kind in expand_path(self.state,path_elements(prefix,subscription.path)):
+                values[gnmi_path(matched).SerializeToString(deterministic=True)] = (matched, value, kind)
+        return values
+
+    def stream_notification(self,values):
+        notification = gnmi_pb2.Notification(timestamp=time.time_ns())
+        for matched, value, kind in values:
+            notification.update.add(path=gnmi_path(matched), val=encode_value(matched[-1][0],value,kind))
+        return self.count_response('subscribe',gnmi_pb2.SubscribeResponse(update=notification))
+
+    def Subscribe(self,request_iterator,context):
+        request = next(request_iterator)
+        subscription_list = request.subscribe
+        self.delay_or_fail('subscribe',context,len(subscription_list.subscription))
+        subscriptions = list(subscription_list.subscription)
+        last_sent = []
+        initial = []
+        for subscription in subscriptions:
+            values = self.leaf_values(subscription_list.prefix,subscription)
+            last_sent.append({key : value[1] for key, value in values.items()})
+            initial.extend(values.values())
+        if initial:
+            yield self.stream_notification(initial)
+        yield self.count_response('subscribe',gnmi_pb2.SubscribeResponse(sync_response=True))
+        if subscription_list.mode != gnmi_pb2.SubscriptionList.STREAM:
+            return
+        next_sample = [time.time() + subscription.sample_interval / 1000000000 for subscription in subscriptions]
+        #Sample subscriptions resend every value each interval, on change ones only send the values that changed
+        while context.is_active() and not self.stopped.is_set():
+            time.sleep(self.tick)
+            changed = []
+            for index, subscription in enumerate(subscriptions):
+                values = self.leaf_values(subscription_list.prefix,subscription)
+                if subscription.mode == gnmi_pb2.SAMPLE and subscription.sample_interval:
+                    if time.time() >= next_sample[index]:
+                        next_sample[index] += subscription.sample_interval / 1000000000
+                        changed.extend(values.values())
+                else:
+                    changed.extend(value for key, value in values.items() if last_sent[index].get(key) != value[1])
+                last_sent[index] = {key : value[1] for key, value in values.items()}
+            if changed:
+                yield self.stream_notification(changed)
+
+    def flap_loop(self):
+        #Take each flap port down and back up every flap_interval seconds, bumping its error counters
+        while not self.stopped.wait(self.flap_interval):
+            for oper_state in ('down','up'):
+                with self.lock:
+                    for port in self.flap_ports:
+                        for matched, interface, kind in expand_path(self.state,[('interface',{'name' : port})]):
+                            interface['oper-state'] = oper_state
+                            interface['last-change'] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z',time.gmtime())
+                            statistics = interface.setdefault('statistics',{})
+                            statistics['in-error-packets'] = statistics.get('in-error-packets',0) + 1
+                if self.stopped.wait(0.5):
+                    return
+
+def report_stats(stats):
+    for rpc in RPC_NAMES:
+        counters = stats[rpc]
+        print (rpc + ': ' + str(counters['calls']) + ' calls, ' + str(counters['failed']) + ' failed, ' + str(counters['paths']) + ' paths, ' +
+               str(round(counters['response_bytes']/1048576,2)) + ' MiB sent')
+
+def main():
+    parser = argparse.ArgumentParser(description='Local fake SR Linux gNMI target for srl_upgrade.py')
+    parser.add_argument('-port', action='store', type=int, default=57400, help=('port to serve gNMI on'))
+    parser.add_argument('-address', action='store', default='127.0.0.1', help=('address to serve gNMI on'))
+    parser.add_argument('-state', action='store', required=False, help=('json state file to serve, recorded with -record. Synthetic state is served without it'))
+    parser.add_argument('-record', action='store', required=False, help=('record the state of -tor_ip to this json file and exit'))
+    parser.add_argument('-tor_ip', action='store', required=False, help=('TOR to record state from'))
+    parser.add_argument('-username', action='store', required=False, help=('username of the TOR to record from'))
+    parser.add_argument('-password', action='store', required=False, help=('password of the TOR to record from'))
+    parser.add_argument('-hostname', action='store', required=False, help=('hostname of the TOR to record from'))
+    parser.add_argument('-macs', action='store', type=int, default=1000, help=('synthetic state: total macs'))
+    parser.add_argument('-layout', action='store', choices=['v22','v23'], default='v23', help=('synthetic state: bgp and version layout'))
+    parser.add_argument('-ports', action='store', type=int, default=48, help=('synthetic state: access ports, 4 uplinks are added after them'))
+    parser.add_argument('-subinterfaces', action='store', type=int, default=1, help=('synthetic state: subinterfaces per port'))
+    parser.add_argument('-mac_vrfs', action='store', type=int, default=20, help=('synthetic state: mac-vrfs the macs are spread over'))
+    parser.add_argument('-arp_entries', action='store', type=int, default=0, help=('synthetic state: arp entries, 0 uses the mac count'))
+    parser.add_argument('-bgp_peers', action='store', type=int, default=4, help=('synthetic state: bgp neighbors'))
+    parser.add_argument('-latency', action='store', type=float, default=0, help=('seconds added to every rpc'))
+    parser.add_argument('-jitter', action='store', type=float, default=0, help=('max seconds the latency varies by either way'))
+    parser.add_argument('-failure_rate', action='store', type=float, default=0, help=('fraction of rpcs failed with UNAVAILABLE'))
+    parser.add_argument('-fail_rpcs', action='store', default=','.join(RPC_NAMES), help=('comma separated rpcs -failure_rate applies to'))
+    parser.add_argument('-max_message_size', action='store', type=int, default=0, help=('max grpc message bytes, 0 keeps the grpc defaults'))
+    parser.add_argument('-flap_ports', action='store', required=False, help=('comma separated ports to bounce every -flap_interval seconds'))
+    parser.add_argument('-flap_interval', action='store', type=float, default=5, help=('seconds between flaps of -flap_ports'))
+    args = parser.parse_args()
+
+    if args.record:
+        with srl_upgrade.GnmiSession((args.tor_ip,'57400'),args.username,args.password,args.hostname) as session:
+            record_state(session,args.record)
+        return
+    if args.state:
+        with open(args.state) as infile:
+            state = json.load(infile)
+    else:
+        bench_args = argparse.Namespace(layout=args.layout, ports=args.ports, subinterfaces=args.subinterfaces, mac_vrfs=args.mac_vrfs,
+                                        arp_entries=args.arp_entries, bgp_peers=args.bgp_peers)
+        state = build_synthetic_state(srl_bench.scale_options(bench_args,args.macs))
+    target = FakeTarget(state,args.latency,args.jitter,args.failure_rate,args.fail_rpcs.split(','),args.max_message_size,
+                        args.flap_ports.split(',') if args.flap_ports else None,args.flap_interval)
+    port = target.start(args.port,args.address)
+    print ('Serving fake gNMI target on ' + args.address + ':' + str(port) + ', ctrl-c to stop')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        target.stop()
+        report_stats(target.stats)
+
+if __name__ == "__main__":
+    main()
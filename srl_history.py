@@ -0,0 +1,145 @@
+import srl_upgrade
+from deepdiff import DeepDiff
+import argparse
+import json
+
+#Queries against the sqlite history srl_upgrade.py writes with -history_db. Every pre and post check of every TOR is a
+#run, so any two runs can be diffed and entries can be looked up across the fleet with indexed queries instead of
+#loading the json of every TOR
+
+def run_info(connection,run_id):
+    row = connection.execute('SELECT run_id, hostname, phase, created, version FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+    if row is None:
+        raise SystemExit('No run ' + str(run_id) + ' in the history')
+    return dict(zip(['run_id','hostname','phase','created','version'],row))
+
+def list_runs(connection,hostname=None,limit=50):
+    query = 'SELECT run_id, hostname, phase, created, version FROM runs'
+    parameters = ()
+    if hostname:
+        query += ' WHERE hostname = ?'
+        parameters = (hostname,)
+    query += ' ORDER BY run_id DESC LIMIT ?'
+    return [dict(zip(['run_id','hostname','phase','created','version'],row)) for row in connection.execute(query, parameters + (limit,))]
+
+def section_digests(connection,run_id):
+    return {section : digest for section, digest in connection.execute('SELECT section, digest FROM run_sections WHERE run_id = ?', (run_id,))}
+
+def diff_table(connection,section,run_a,run_b):
+    #Entries removed (only in run_a), added (only in run_b) and changed (same key, other values) between two runs, each
+    #one indexed query on the (run_id, group, key) primary key
+    spec = srl_upgrade.HISTORY_TABLES[section]
+    table = spec['table']
+    keys = srl_upgrade.history_key_columns(spec)
+    values = list(spec['values'])
+    same_key = ' AND '.join('other.' + column + ' = entry.' + column for column in keys)
+    selected = ', '.join('entry.' + column for column in keys + values)
+    missing = 'SELECT ' + selected + ' FROM ' + table + ' entry WHERE entry.run_id = ? AND NOT EXISTS (SELECT 1 FROM ' + table + ' other WHERE other.run_id = ? AND ' + same_key + ') ORDER BY ' + ', '.join('entry.' + column for column in keys)
+    changed = ('SELECT ' + ', '.join('entry.' + column for column in keys) + ', ' + ', '.join('entry.' + column for column in values) + ', ' + ', '.join('other.' + column for column in values) +
+               ' FROM ' + table + ' entry JOIN ' + table + ' other ON other.run_id = ? AND ' + same_key + ' WHERE entry.run_id = ? AND (' +
+               ' OR '.join('entry.' + column + ' IS NOT other.' + column for column in values) + ') ORDER BY ' + ', '.join('entry.' + column for column in keys))
+    return {
+        'removed' : [row for row in connection.execute(missing, (run_a, run_b))],
+        'added' : [row for row in connection.execute(missing, (run_b, run_a))],
+        'changed' : [(row[:len(keys)], row[len(keys):len(keys)+len(values)], row[len(keys)+len(values):]) for row in connection.execute(changed, (run_b, run_a))],
+    }
+
+def diff_runs(connection,run_a,run_b,sections=None):
+    #{section : diff} for the sections saved in both runs, None for sections whose digests match. Table sections are
+    #diffed in sql, the rest with DeepDiff on their json
+    digests_a = section_digests(connection,run_a)
+    digests_b = section_digests(connection,run_b)
+    diffs = {}
+    for section in (sections or [section for section in srl_upgrade.SAVED_SECTIONS if section in digests_a or section in digests_b]):
+        if section not in digests_a or section not in digests_b:
+            diffs[section] = 'not saved in run ' + str(run_a if section not in digests_a else run_b)
+        elif digests_a[section] == digests_b[section]:
+            diffs[section] = None
+        elif section in srl_upgrade.HISTORY_TABLES:
+            diffs[section] = diff_table(connection,section,run_a,run_b)
+        else:
+            data_a, data_b = [json.loads(connection.execute('SELECT data FROM run_sections WHERE run_id = ? AND section = ?', (run_id, section)).fetchone()[0])
+                              for run_id in (run_a, run_b)]
+            diffs[section] = DeepDiff(data_a,data_b).to_dict()
+    return diffs
+
+def report_run_diff(section,section_diff):
+    if section_diff is None:
+        print ('\033[1;32m No differences were found with ' + section + ' \033[0;0m')
+    elif type(section_diff) is str:
+        print ('\033[1;33m ' + section + ' ' + section_diff + ' \033[0;0m')
+    elif section in srl_upgrade.HISTORY_TABLES:
+        print ('\033[1;31m Differences were found for ' + section + ': added ' + str(len(section_diff['added'])) + ', removed ' + str(len(section_diff['removed'])) +
+               ', changed ' + str(len(section_diff['changed'])) + '\033[0;0m')
+        for row in section_diff['removed']:
+            print ('removed: ' + ' '.join(str(value) for value in row))
+        for row in section_diff['added']:
+            print ('added: ' + ' '.join(str(value) for value in row))
+        for key, before_values, after_values in section_diff['changed']:
+            print ('changed: ' + ' '.join(key) + ' ' + ' '.join(str(value) for value in before_values) + ' -> ' + ' '.join(str(value) for value in after_values))
+    else:
+        for difference in section_diff:
+            print ('\033[1;31m Differences were found for ' + section + ' with type: ' + difference + '\033[0;0m')
+            print (section_diff[difference])
+
+def lost_entries(connection,section,key):
+    #Every TOR and run where key was present and gone in the next run of the same TOR that saved the section
+    spec = srl_upgrade.HISTORY_TABLES[section]
+    table = spec['table']
+    query = ('WITH section_runs AS (SELECT runs.run_id, runs.hostname, LEAD(runs.run_id) OVER (PARTITION BY runs.hostname ORDER BY runs.run_id) AS next_run '
+             'FROM runs JOIN run_sections ON run_sections.run_id = runs.run_id AND run_sections.section = ?) '
+             'SELECT section_runs.hostname, section_runs.run_id, section_runs.next_run, ' + ', '.join('entry.' + column for column in srl_upgrade.history_key_columns(spec) + list(spec['values'])) +
+             ' FROM ' + table + ' entry JOIN section_runs ON section_runs.run_id = entry.run_id WHERE entry.' + spec['key'] + ' = ? AND section_runs.next_run IS NOT NULL'
+             ' AND NOT EXISTS (SELECT 1 FROM ' + table + ' other WHERE other.run_id = section_runs.next_run AND other.' + spec['key'] + ' = entry.' + spec['key'] + ')'
+             ' ORDER BY section_runs.hostname, section_runs.run_id')
+    return [row for row in connection.execute(query, (section, key))]
+
+def find_entries(connection,section,key):
+    #Where key is in the latest run of every TOR that saved the section
+    spec = srl_upgrade.HISTORY_TABLES[section]
+    query = ('WITH latest AS (SELECT runs.hostname, MAX(runs.run_id) AS run_id FROM runs JOIN run_sections ON run_sections.run_id = runs.run_id AND run_sections.section = ? GROUP BY runs.hostname) '
+             'SELECT latest.hostname, latest.run_id, ' + ', '.join('entry.' + column for column in srl_upgrade.history_key_columns(spec) + list(spec['values'])) +
+             ' FROM ' + spec['table'] + ' entry JOIN latest ON latest.run_id = entry.run_id WHERE entry.' + spec['key'] + ' = ? ORDER BY latest.hostname')
+    return [row for row in connection.execute(query, (section, key))]
+
+def describe_run(run):
+    return 'run ' + str(run['run_id']) + ' ' + run['hostname'] + ' ' + run['phase'] + ' ' + run['created'] + ' ' + str(run['version'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the sqlite history srl_upgrade.py writes with -history_db')
+    parser.add_argument('-history_db', action='store', required=True, help=('sqlite history file'))
+    parser.add_argument('-runs', action='store', required=False, help=('set flag to list the latest runs, of -hostname only if set'))
+    parser.add_argument('-hostname', action='store', required=False, help=('TOR to list runs of'))
+    parser.add_argument('-limit', action='store', type=int, default=50, help=('max runs listed'))
+    parser.add_argument('-diff', action='store', required=False, help=('two run ids to diff, e.g. 12,40'))
+    parser.add_argument('-sections', action='store', required=False, help=('comma separated sections to diff, every saved section by default'))
+    parser.add_argument('-lost', action='store', required=False, help=('key (mac, arp ip, bgp peer, interface or app) to find the TORs that lost it from one run to the next'))
+    parser.add_argument('-find', action='store', required=False, help=('key to find in the latest run of every TOR'))
+    parser.add_argument('-section', action='store', choices=list(srl_upgrade.HISTORY_TABLES), default='mac', help=('section -lost and -find look in'))
+    args = parser.parse_args()
+
+    connection = srl_upgrade.open_history(args.history_db)
+    if args.runs:
+        for run in list_runs(connection,args.hostname,args.limit):
+            print (describe_run(run))
+    if args.diff:
+        run_a, run_b = [int(run_id) for run_id in args.diff.split(',')]
+        print ('Diffing ' + describe_run(run_info(connection,run_a)) + ' against ' + describe_run(run_info(connection,run_b)))
+        for section, section_diff in diff_runs(connection,run_a,run_b,args.sections.split(',') if args.sections else None).items():
+            report_run_diff(section,section_diff)
+    if args.lost:
+        rows = lost_entries(connection,args.section,args.lost)
+        if not rows:
+            print ('\033[1;32m No TOR lost ' + args.lost + ' \033[0;0m')
+        for hostname, run_id, next_run, *entry in rows:
+            print ('\033[1;31m ' + hostname + ' lost ' + ' '.join(str(value) for value in entry) + ' between run ' + str(run_id) + ' and run ' + str(next_run) + '\033[0;0m')
+    if args.find:
+        rows = find_entries(connection,args.section,args.find)
+        if not rows:
+            print (args.find + ' is not in the latest run of any TOR')
+        for hostname, run_id, *entry in rows:
+            print (hostname + ' (run ' + str(run_id) + '): ' + ' '.join(str(value) for value in entry))
+    connection.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,466 @@
-from pygnmi.client import gNMIclient
+from pygnmi.client import gNMIclient, gNMIException, telemetryParser
+import grpc
 import json
 import argparse
 import os
-from deepdiff import DeepDiff
-import pprint
 import time
-from jsondiff import diff
 import logging
 from datetime import datetime
-
-def run_gnmi_query(gnmi_host,username,password,hostname,gnmi_path):
-    
-    with gNMIclient(target=gnmi_host, username=username, password=password, override=hostname) as gc:
-        logging.debug('Running gnmi query, raw data to follow')
-        raw_data = gc.get(path=[gnmi_path], encoding='json_ietf')
+import csv
+import sqlite3
+import threading
+import queue
+import concurrent.futures
+import multiprocessing
+import io
+import contextlib
+import gzip
+import hashlib
+import shutil
+import functools
+import atexit
+import tracemalloc
+import sys
+import re
+import socket
+import random
+try:
+    import yaml
+except ImportError:
+    yaml = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#Run instrumentation for -run_report. Phases, stages (parse/save/query functions), rpcs and compare sections are timed per
+#device, the device being whichever hostname the current thread is working on
+METRICS = {'enabled' : False, 'memory' : False, 'started' : None, 'devices' : {}}
+METRICS_LOCK = threading.Lock()
+METRICS_CONTEXT = threading.local()
+
+def enable_metrics(memory=False):
+    METRICS['enabled'] = True
+    METRICS['memory'] = memory
+    METRICS['started'] = time.time()
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def set_metrics_device(hostname):
+    METRICS_CONTEXT.hostname = hostname
+
+def record_metric(kind,name,seconds,**counters):
+    if not METRICS['enabled']:
+        return
+    with METRICS_LOCK:
+        device = METRICS['devices'].setdefault(getattr(METRICS_CONTEXT,'hostname',None) or 'unknown',{})
+        entry = device.setdefault(kind,{}).setdefault(name,{'calls' : 0, 'seconds' : 0.0, 'max_seconds' : 0.0})
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+        entry['max_seconds'] = max(entry['max_seconds'],seconds)
+        for counter, value in counters.items():
+            if counter == 'peak_bytes':
+                entry[counter] = max(entry.get(counter,0),value)
+            else:
+                entry[counter] = entry.get(counter,0) + value
+
+@contextlib.contextmanager
+def measure(kind,name):
+    #Times the block and records it with the counters the block puts in the yielded dict. Peak memory is only traced for
+    #stages, and only for the outermost one (tracemalloc has one peak per process, so it is less exact with fleet workers)
+    counters = {}
+    if not METRICS['enabled']:
+        yield counters
+        return
+    depth = getattr(METRICS_CONTEXT,'depth',0)
+    trace_memory = METRICS['memory'] and kind == 'stages' and depth == 0
+    if kind == 'stages':
+        METRICS_CONTEXT.depth = depth + 1
+    if trace_memory:
+        tracemalloc.reset_peak()
+        memory_start = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        if trace_memory:
+            counters['peak_bytes'] = tracemalloc.get_traced_memory()[1] - memory_start
+        if kind == 'stages':
+            METRICS_CONTEXT.depth = depth
+        record_metric(kind,name,time.perf_counter() - start,**counters)
+
+def count_entries(result,nested=False):
+    #Entries under the hostname of a parsed section, nested sums the entries of every service/subinterface (mac, arp)
+    if result is None:
+        return 0
+    if type(result) is dict and len(result) == 1:
+        result = list(result.values())[0]
+    if nested and type(result) is dict:
+        return sum(len(entries) for entries in result.values() if type(entries) in (dict,list))
+    return len(result) if type(result) in (dict,list) else 1
+
+def instrumented(stage,nested=False):
+    #Decorator timing every call of a parse/save/query function and counting the entries it returns
+    def wrap(function):
+        @functools.wraps(function)
+        def run(*args,**kwargs):
+            if not METRICS['enabled']:
+                return function(*args,**kwargs)
+            with measure('stages',stage) as counters:
+                result = function(*args,**kwargs)
+                counters['entries'] = count_entries(result,nested)
+            return result
+        return run
+    return wrap
+
+def metrics_totals():
+    #Every device's metrics summed, per kind and name
+    totals = {}
+    for device in METRICS['devices'].values():
+        for kind in device:
+            for name, entry in device[kind].items():
+                total = totals.setdefault(kind,{}).setdefault(name,{})
+                for counter, value in entry.items():
+                    if counter in ('max_seconds','peak_bytes'):
+                        total[counter] = max(total.get(counter,0),value)
+                    else:
+                        total[counter] = total.get(counter,0) + value
+    return totals
+
+def prometheus_label(value):
+    return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def write_run_report(report_file,prometheus_file=None):
+    #JSON report of the whole run, and optionally the same numbers in the node exporter textfile format
+    finished = time.time()
+    report = {'started' : datetime.fromtimestamp(METRICS['started']).isoformat(), 'finished' : datetime.fromtimestamp(finished).isoformat(),
+              'duration' : finished - METRICS['started'], 'argv' : sys.argv[1:], 'devices' : METRICS['devices'], 'totals' : metrics_totals()}
+    if report_file:
+        with open(report_file, "w") as outfile:
+            json.dump(report, outfile, indent=1)
+    if prometheus_file:
+        lines = ['# TYPE srl_upgrade_run_duration_seconds gauge', 'srl_upgrade_run_duration_seconds ' + str(report['duration'])]
+        for counter, metric, metric_type in [('seconds','srl_upgrade_seconds_total','counter'), ('max_seconds','srl_upgrade_max_seconds','gauge'),
+                                             ('calls','srl_upgrade_calls_total','counter'), ('entries','srl_upgrade_entries','gauge'),
+                                             ('paths','srl_upgrade_rpc_paths_total','counter'), ('updates','srl_upgrade_rpc_updates_total','counter'),
+                                             ('errors','srl_upgrade_rpc_errors_total','counter'), ('peak_bytes','srl_upgrade_peak_bytes','gauge')]:
+            lines.append('# TYPE ' + metric + ' ' + metric_type)
+            for hostname, device in sorted(METRICS['devices'].items()):
+                for kind in sorted(device):
+                    for name, entry in sorted(device[kind].items()):
+                        if counter in entry:
+                            lines.append(metric + '{device="' + prometheus_label(hostname) + '",kind="' + kind + '",name="' + prometheus_label(name) + '"} ' + str(entry[counter]))
+        #Written to a temp file and renamed so the collector never reads half a file
+        with open(prometheus_file+'.tmp', "w") as outfile:
+            outfile.write('\n'.join(lines) + '\n')
+        os.replace(prometheus_file+'.tmp',prometheus_file)
+
+#Retries of a failed or timed out gnmi call. The wait before retry n is a random time up to min(max_backoff,
+#backoff * 2**n), so TORs that come back from a reboot together do not retry in step. rpc_timeout is the seconds one call
+#may take before it is cancelled. Left at None, calls get the default of RPC_TIMEOUTS and the big collection paths longer
+DEFAULT_RETRY_POLICY = {'retries' : 3, 'backoff' : 1.0, 'max_backoff' : 30.0, 'rpc_timeout' : None}
+RPC_TIMEOUTS = {'default' : 60.0, 'network-instance' : 300.0, 'interface' : 180.0}
+#Seconds a pre or post check collection has, retries included, unless -run_deadline says otherwise
+DEFAULT_RUN_DEADLINE = 900
+
+#Errors of a TOR that is still coming up (refused or slow channel, unavailable or timed out rpcs) that are worth
+#retrying. Rejected calls (INVALID_ARGUMENT, PERMISSION_DENIED, UNAUTHENTICATED, ...) fail the same way every time
+RETRIED_STATUS_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+
+class SessionCancelled(Exception):
+    #Raised by every call of a GnmiSession after cancel(), e.g. for a fleet device that was reported as timed out
+    pass
+
+class RetriedCallError(Exception):
+    #Raised by GnmiSession.timed_call for a failure worth retrying, the original error is its __cause__
+    pass
+
+def retried_error(ex):
+    if isinstance(ex,(TimeoutError,grpc.FutureTimeoutError)):
+        return True
+    #pygnmi wraps the grpc error of a failed rpc in a gNMIException
+    error = getattr(ex,'orig_exc',None) if isinstance(ex,gNMIException) else ex
+    return isinstance(error,grpc.RpcError) and hasattr(error,'code') and error.code() in RETRIED_STATUS_CODES
+
+class GnmiSession:
+    #Holds one gnmi channel to the TOR for the whole run instead of connecting for every query. Calls that fail or run
+    #past their timeout are retried on a fresh connection with jittered exponential backoff, within the deadline. The
+    #channel is shared by the threads fetching sections in parallel
+    def __init__(self,gnmi_host,username,password,hostname,insecure=False,retry_policy=None):
+        self.gnmi_host = gnmi_host
+        self.username = username
+        self.password = password
+        self.hostname = hostname
+        #Plain text channel, for the local fake target (srl_fake_target.py)
+        self.insecure = insecure
+        self.retry_policy = dict(DEFAULT_RETRY_POLICY, **(retry_policy or {}))
+        #time.monotonic() every call has to finish by, see run_deadline
+        self.deadline = None
+        self.lock = threading.Lock()
+        self.gc = None
+        self.cancelled = False
+
+    def remaining(self):
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def connect(self):
+        with self.lock:
+            if self.cancelled:
+                raise SessionCancelled('gnmi session to ' + str(self.gnmi_host) + ' was cancelled')
+            if self.gc is None:
+                logging.debug('Opening gnmi session to ' + str(self.gnmi_host))
+                remaining = self.remaining()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError('run deadline passed before connecting to ' + str(self.gnmi_host))
+                with measure('rpcs','connect'):
+                    gc = gNMIclient(target=self.gnmi_host, username=self.username, password=self.password, override=self.hostname, insecure=self.insecure)
+                    gc.connect(timeout=5 if remaining is None else min(5,remaining))
+                self.gc = gc
+            return self.gc
+
+    def close(self,gc=None):
+        #With gc, only closes the channel if it is still the current one, so a call that timed out on an old channel does
+        #not close the fresh one other threads already use
+        with self.lock:
+            if self.gc is None or (gc is not None and gc is not self.gc):
+                return
+            gc, self.gc = self.gc, None
+        logging.debug('Closing gnmi session to ' + str(self.gnmi_host))
+        try:
+            gc.close()
+        except Exception:
+            pass
+
+    def cancel(self):
+        #Closes the channel for good: the call running on it fails and every later call raises SessionCancelled
+        #instead of connecting again
+        with self.lock:
+            self.cancelled = True
+        self.close()
+
+    def call(self,method,rpc_timeout=None,retries=None,**kwargs):
+        #rpc_timeout None uses the retry policy's, 0 waits as long as the call takes. retries None uses the retry
+        #policy's. A retry is not started if its wait would run past the deadline
+        policy = self.retry_policy
+        if rpc_timeout is None:
+            rpc_timeout = RPC_TIMEOUTS['default'] if policy['rpc_timeout'] is None else policy['rpc_timeout']
+        if retries is None:
+            retries = policy['retries']
+        attempt = 0
+        while True:
+            try:
+                return self.timed_call(method,rpc_timeout,**kwargs)
+            except RetriedCallError as ex:
+                delay = random.uniform(0,min(policy['max_backoff'],policy['backoff'] * 2 ** attempt))
+                attempt += 1
+                remaining = self.remaining()
+                if attempt > retries or (remaining is not None and remaining <= delay):
+                    raise ex.__cause__
+                logging.debug('gnmi ' + method + ' failed, retry ' + str(attempt) + ' in ' + str(round(delay,2)) + 's on a fresh connection: ' + str(ex.__cause__))
+                record_metric('rpcs','backoff',delay)
+                time.sleep(delay)
+
+    def timed_call(self,method,rpc_timeout,**kwargs):
+        with measure('rpcs',method) as counters:
+            counters['paths'] = len(kwargs.get('path') or kwargs.get('update') or [])
+            gc = None
+            try:
+                gc = self.connect()
+                remaining = self.remaining()
+                if remaining is not None:
+                    if remaining <= 0:
+                        raise TimeoutError('run deadline passed before gnmi ' + method + ' to ' + str(self.gnmi_host))
+                    rpc_timeout = min(rpc_timeout,remaining) if rpc_timeout else remaining
+                if rpc_timeout:
+                    response = self.call_with_timeout(gc,method,rpc_timeout,kwargs)
+                else:
+                    response = getattr(gc,method)(**kwargs)
+            except Exception as ex:
+                counters['errors'] = 1
+                #A call cut short because the session closed its channel (a call on another thread timed out) is retried too
+                if not (retried_error(ex) or (gc is not None and gc is not self.gc)):
+                    raise
+                #The retry connects again, the threads still using this channel retry on the new one
+                if gc is not None:
+                    self.close(gc)
+                raise RetriedCallError(str(ex)) from ex
+            #pygnmi hands back decoded responses without their protobuf size, so the size is the number of updates. Encoding
+            #the response again to measure it would double the memory of the largest gets
+            if METRICS['enabled'] and type(response) is dict:
+                counters['updates'] = sum(len(notification.get('update') or []) for notification in response.get('notification') or [])
+            return response
+
+    def call_with_timeout(self,gc,method,rpc_timeout,kwargs):
+        #pygnmi takes no grpc deadline, so the call runs on its own thread and a call still running after rpc_timeout is
+        #cancelled by closing its channel
+        result = {}
+        done = threading.Event()
+
+        def run():
+            try:
+                result['response'] = getattr(gc,method)(**kwargs)
+            except BaseException as ex:
+                result['error'] = ex
+            finally:
+                done.set()
+
+        threading.Thread(target=run,daemon=True,name='gnmi-' + method).start()
+        if not done.wait(rpc_timeout):
+            self.close(gc)
+            raise TimeoutError('gnmi ' + method + ' to ' + str(self.gnmi_host) + ' took longer than ' + str(round(rpc_timeout,1)) + 's')
+        if 'error' in result:
+            raise result['error']
+        return result['response']
+
+    def get(self,rpc_timeout=None,**kwargs):
+        return self.call('get',rpc_timeout,None,**kwargs)
+
+    def set(self,rpc_timeout=None,retry=False,**kwargs):
+        #A set that failed or timed out on the client may still have been committed, so it is only retried if the caller
+        #knows it is safe to send again
+        return self.call('set',rpc_timeout,None if retry else 0,**kwargs)
+
+    def subscribe(self,**kwargs):
+        #Returns the raw grpc response stream, errors on the stream show up while reading it. Only opening the stream is
+        #retried, reading it is bounded by the caller's window
+        return self.call('subscribe',0,None,**kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+@contextlib.contextmanager
+def run_deadline(session,seconds):
+    #Every gnmi call of the block, retries included, has to finish within seconds. An outer deadline that is sooner wins
+    previous = session.deadline
+    if seconds:
+        deadline = time.monotonic() + seconds
+        session.deadline = deadline if previous is None else min(previous,deadline)
+    try:
+        yield
+    finally:
+        session.deadline = previous
+
+#Paths gathered for every pre/post check, keyed by the section they are parsed into
+COLLECTION_PATHS = {
+    'version' : '/system/information/version',
+    'app' : '/system/app-management/application',
+    'network-instance' : '/network-instance/',
+    'bgp' : '/network-instance[name=default]/protocols/bgp/neighbor',
+    'interface' : '/interface/',
+    'fan' : '/platform/fan-tray',
+    'power' : '/platform/power-supply',
+    'control' : '/platform/control',
+    'linecard' : '/platform/linecard',
+    'tunnel' : '/tunnel',
+}
+
+#State only, leaf level paths used with -pruned. root is where the section parser expects to start in the tree rebuilt from
+#the returned leaves, empty is handed to the parser if nothing came back. Sections not listed here use COLLECTION_PATHS.
+#section_paths are the paths only one of the sections sharing the path needs, left out when that section is not fetched
+PRUNED_COLLECTION_PATHS = {
+    'app' : {'root' : 'system/app-management/application', 'empty' : [], 'paths' : [
+        '/system/app-management/application[name=*]/state']},
+    'network-instance' : {'root' : 'network-instance', 'empty' : [], 'paths' : [
+        '/network-instance[name=*]/oper-state',
+        '/network-instance[name=*]/type',
+        '/network-instance[name=*]/bridge-table/mac-learning/learnt-entries/mac[address=*]/destination'],
+        'section_paths' : {'mac' : ['/network-instance[name=*]/bridge-table/mac-learning/learnt-entries/mac[address=*]/destination']}},
+    'interface' : {'root' : 'interface', 'empty' : [], 'paths' : [
+        '/interface[name=*]/admin-state',
+        '/interface[name=*]/oper-state',
+        '/interface[name=*]/description',
+        '/interface[name=*]/subinterface[index=*]/name',
+        '/interface[name=*]/subinterface[index=*]/ipv4/arp/neighbor[ipv4-address=*]'],
+        'section_paths' : {'arp' : ['/interface[name=*]/subinterface[index=*]/name',
+                                    '/interface[name=*]/subinterface[index=*]/ipv4/arp/neighbor[ipv4-address=*]']}},
+    'fan' : {'root' : 'platform/fan-tray', 'empty' : [], 'paths' : [
+        '/platform/fan-tray[id=*]/oper-state']},
+    'power' : {'root' : 'platform/power-supply', 'empty' : [], 'paths' : [
+        '/platform/power-supply[id=*]/oper-state']},
+    'control' : {'root' : 'platform/control', 'empty' : [], 'paths' : [
+        '/platform/control[slot=*]/type',
+        '/platform/control[slot=*]/oper-state']},
+    'linecard' : {'root' : 'platform/linecard', 'empty' : [], 'paths' : [
+        '/platform/linecard[slot=*]/type',
+        '/platform/linecard[slot=*]/oper-state']},
+    'tunnel' : {'root' : 'tunnel/vxlan-tunnel', 'empty' : None, 'paths' : [
+        '/tunnel/vxlan-tunnel/vtep[address=*]/address']},
+}
+
+#Counters fetched by the -tiered quick check instead of the mac and arp tables, in the same format as
+#PRUNED_COLLECTION_PATHS. bgp and version come from COLLECTION_PATHS, bgp is small enough to be its own aggregate
+AGGREGATE_COLLECTION_PATHS = {
+    'mac' : {'root' : 'network-instance', 'empty' : [], 'paths' : [
+        '/network-instance[name=*]/type',
+        '/network-instance[name=*]/bridge-table/statistics/mac-type[type=learnt]/active-entries']},
+    'arp' : {'root' : 'interface', 'empty' : [], 'paths' : [
+        '/interface[name=*]/subinterface[index=*]/name',
+        '/interface[name=*]/subinterface[index=*]/ipv4/arp/statistics/neighbor-origin[origin=dynamic]/total-entries']},
+    'interface' : {'root' : 'interface', 'empty' : [], 'paths' : [
+        '/interface[name=*]/oper-state']},
+}
+
+@instrumented('run_gnmi_query')
+def run_gnmi_query(session,gnmi_path,datatype='all',rpc_timeout=None):
+    #gnmi_path can be a single path, or a list of paths to send in one get request. rpc_timeout None uses the session's
+    if type(gnmi_path) is not list:
+        gnmi_path = [gnmi_path]
+    logging.debug('Running gnmi query, raw data to follow')
+    raw_data = session.get(rpc_timeout=rpc_timeout, path=gnmi_path, encoding='json_ietf', datatype=datatype)
+    log_raw_data(raw_data)
+    logging.debug('End of gnmi query data')
+    return raw_data
+
+#Max list entries per debug log line, so big tables are not formatted into one huge string
+LOG_CHUNK_SIZE = 500
+
+def log_raw_data(raw_data):
+    #Log a get response one update at a time. Nothing is formatted unless debug is on
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    if not raw_data or 'notification' not in raw_data.keys():
         logging.debug(raw_data)
-        logging.debug('End of gnmi query data')
-        return raw_data
-
-
+        return
+    for notification in raw_data['notification']:
+        for update in notification.get('update',[]):
+            log_raw_value(str(update.get('path')),update.get('val'))
+
+def log_raw_value(path,value):
+    #Nested containers and lists get their own log lines and lists are logged LOG_CHUNK_SIZE entries at a time,
+    #so a big mac or arp table is never formatted into one string
+    if type(value) is dict:
+        leaves = {}
+        for key in value:
+            if type(value[key]) in (dict,list):
+                log_raw_value(path + '/' + key,value[key])
+            else:
+                leaves[key] = value[key]
+        if leaves:
+            logging.debug(path + ' ' + json.dumps(leaves))
+    elif type(value) is list:
+        for index in range(0,len(value),LOG_CHUNK_SIZE):
+            chunk = value[index:index+LOG_CHUNK_SIZE]
+            flat_entries = [entry for entry in chunk if not (type(entry) is dict and any(type(child) in (dict,list) for child in entry.values()))]
+            if flat_entries:
+                logging.debug(path + ' entries ' + str(index) + '-' + str(index + len(chunk) - 1) + ' ' + json.dumps(flat_entries))
+            for entry in chunk:
+                if type(entry) is dict and any(type(child) in (dict,list) for child in entry.values()):
+                    log_raw_value(path + '[' + ','.join(str(entry[key]) for key in entry if type(entry[key]) not in (dict,list))[:100] + ']',entry)
+    else:
+        logging.debug(path + ' ' + json.dumps(value))
 
+@instrumented('parse_gnmi_result')
 def parse_gnmi_result(raw_data):
     #Parse the result of 1 GNMI query and return its results   
 
@@ -46,119 +487,479 @@ def parse_gnmi_result(raw_data):
         return None
     return None
 
-#Provide backward compatability for v22
+def get_child(node,name):
+    #Look up a child by name whether or not the device put a module prefix on it (srl_nokia-interfaces-nbr:arp)
+    if name in node:
+        return node[name]
+    for key in node:
+        if key.split(':')[-1] == name:
+            return node[key]
+    return None
+
+def strip_module_prefixes(data):
+    if type(data) is dict:
+        return {key.split(':')[-1] : strip_module_prefixes(value) for key, value in data.items()}
+    if type(data) is list:
+        return [strip_module_prefixes(value) for value in data]
+    return data
+
+@instrumented('build_tree_from_updates')
+def build_tree_from_updates(updates):
+    #Rebuild the nested structure a subtree query returns (lists of dicts holding their keys) out of leaf level updates,
+    #so the same parse_* functions work on pruned queries
+    tree = {}
+    list_entries = {}
+    for update in consume_list(updates):
+        elements = split_gnmi_path(update.get('path'))
+        if not elements:
+            continue
+        value = update.get('val')
+        node = tree
+        node_path = ''
+        for index, (name, keys) in enumerate(elements):
+            last_element = index == len(elements) - 1
+            node_path += '/' + name
+            if keys:
+                node_path += str(sorted(keys.items()))
+                if node_path not in list_entries:
+                    entry = dict(keys)
+                    node.setdefault(name,[]).append(entry)
+                    list_entries[node_path] = entry
+                node = list_entries[node_path]
+                if last_element and type(value) is dict:
+                    node.update(strip_module_prefixes(value))
+            elif last_element:
+                if type(value) is dict and len(value) == 1 and list(value.keys())[0].split(':')[-1] == name:
+                    value = list(value.values())[0]
+                if type(value) is dict:
+                    node.setdefault(name,{}).update(strip_module_prefixes(value))
+                else:
+                    node[name] = value
+            else:
+                node = node.setdefault(name,{})
+    return tree
+
+#Declarative extraction of every section from the response of its collection path. A spec walks the root entries (the
+#list the path returned, or the container itself) and then the child lists named in walk, one level per list:
+#  match       {level : {leaf : value}} that entries of a level have to match, module prefixes on values are ignored
+#  group       (level, leaf) the entries are grouped under. exclude_group is a regex of groups whose entries are skipped
+#  key, value  leaf of the innermost entry it is keyed on, and the leaf (or {name : leaf}) saved for it. Names listed in
+#              optional are left out when the device does not send them
+#  collect     save a list of the value leaf instead of a keyed dict
+#  top_level   save entries next to the hostname key instead of under it, which is how power/control/linecard always saved
+#  root_value  the response itself is the value
+#  consume     drop the innermost entries from the raw data as they are read
+#Leaf paths are relative gnmi paths and can pick list entries by key, afi-safi[afi-safi-name=evpn]/received-routes
+BASE_EXTRACTION_SPECS = {
+    'version' : {'root_value' : True},
+    'app' : {'key' : 'name', 'value' : 'state'},
+    'network-instance' : {'key' : 'name', 'value' : 'oper-state'},
+    'mac' : {'walk' : ['bridge-table/mac-learning/learnt-entries/mac'], 'match' : {0 : {'type' : 'mac-vrf'}}, 'group' : (0,'name'),
+             'key' : 'address', 'value' : 'destination', 'consume' : True},
+    'interface' : {'key' : 'name', 'value' : {'port_description' : 'description', 'port_oper_state' : 'oper-state'}, 'optional' : ['port_description']},
+    #Only dynamic entries are saved, not evpn learnt ones, and nothing on the mgmt interface
+    'arp' : {'walk' : ['subinterface','ipv4/arp/neighbor'], 'group' : (1,'name'), 'exclude_group' : r'mgmt0\.0', 'match' : {2 : {'origin' : 'dynamic'}},
+             'key' : 'ipv4-address', 'value' : 'link-layer-address', 'consume' : True},
+    'fan' : {'key' : 'id', 'value' : 'oper-state'},
+    'power' : {'key' : 'id', 'value' : 'oper-state', 'top_level' : True},
+    'control' : {'key' : 'slot', 'value' : {'card_type' : 'type', 'card_oper_status' : 'oper-state'}, 'top_level' : True},
+    'linecard' : {'key' : 'slot', 'value' : {'card_type' : 'type', 'card_oper_status' : 'oper-state'}, 'top_level' : True},
+    'tunnel' : {'walk' : ['vtep'], 'value' : 'address', 'collect' : True,
+                'missing_message' : 'Appear to be running on a spine or leaf with no VTEPs. If not expected, examine node and script. Continuing.. '},
+    #Counters of the -tiered quick check (AGGREGATE_COLLECTION_PATHS), counted the same way as the mac and arp sections
+    'mac-count' : {'match' : {0 : {'type' : 'mac-vrf'}}, 'key' : 'name', 'value' : 'bridge-table/statistics/mac-type[type=learnt]/active-entries'},
+    'arp-count' : {'walk' : ['subinterface'], 'group' : (0,'name'), 'exclude_group' : r'^mgmt0$', 'key' : 'name',
+                   'value' : 'ipv4/arp/statistics/neighbor-origin[origin=dynamic]/total-entries'},
+}
+
+#Specs per SR Linux release, a TOR gets the newest release that is not newer than its version. A release that changes the
+#schema only needs its changed sections here
+EXTRACTION_SPECS = {
+    #Received routes are in a container per family
+    'v22' : dict(BASE_EXTRACTION_SPECS, bgp={'key' : 'peer-address', 'value' : {
+        'session-state' : 'session-state',
+        'address_family_ipv4_received_routes' : 'ipv4-unicast/received-routes',
+        'address_family_evpn_received_routes' : 'evpn/received-routes',
+        'address_family_ipv6_received_routes' : 'ipv6-unicast/received-routes'}}),
+    #Received routes moved into the afi-safi list
+    'v23' : dict(BASE_EXTRACTION_SPECS, bgp={'key' : 'peer-address', 'value' : {
+        'session-state' : 'session-state',
+        'address_family_evpn_received_routes' : 'afi-safi[afi-safi-name=evpn]/received-routes',
+        'address_family_ipv4_received_routes' : 'afi-safi[afi-safi-name=ipv4-unicast]/received-routes',
+        'address_family_ipv6_received_routes' : 'afi-safi[afi-safi-name=ipv6-unicast]/received-routes'}}),
+}
+
+def release_key(version):
+    #(22, 11, 2) for v22.11.2-74-g39f3b1b9b7, None if it is not a release string
+    match = re.match(r'v?(\d+)(?:\.(\d+))?(?:\.(\d+))?', str(version or ''))
+    if not match:
+        return None
+    return tuple(int(part) for part in match.groups() if part is not None)
+
+def select_release(version=None):
+    #Newest release in EXTRACTION_SPECS that is not newer than version, the newest one if the version is not known
+    releases = sorted(EXTRACTION_SPECS, key=release_key)
+    current = release_key(version)
+    if current is None:
+        return releases[-1]
+    selected = releases[0]
+    for release in releases:
+        if release_key(release) <= current:
+            selected = release
+    return selected
+
+@functools.lru_cache(maxsize=None)
+def leaf_elements(leaf_path):
+    return tuple((name, tuple(keys.items())) for name, keys in split_gnmi_path(leaf_path))
+
+def strip_value_prefix(value):
+    return value.split(':')[-1] if type(value) is str else value
+
+def resolve_leaf(node,leaf_path):
+    #Value at a relative leaf path, None if any part of it is missing
+    for name, keys in leaf_elements(leaf_path):
+        if type(node) is not dict:
+            return None
+        node = get_child(node,name)
+        if keys:
+            if type(node) is not list:
+                return None
+            node = next((entry for entry in node if type(entry) is dict and
+                         all(strip_value_prefix(str(entry.get(key))) == strip_value_prefix(value) for key, value in keys)), None)
+        if node is None:
+            return None
+    return node
+
+def leaf_getter(leaf_path):
+    #Function returning the value at leaf_path of an entry. A plain child name, the usual case, skips the path walk
+    elements = leaf_elements(leaf_path)
+    if len(elements) == 1 and not elements[0][1]:
+        name = elements[0][0]
+        def get_leaf(node):
+            if type(node) is not dict:
+                return None
+            if name in node:
+                return node[name]
+            return get_child(node,name)
+        return get_leaf
+    return lambda node: resolve_leaf(node,leaf_path)
+
+#Specs compiled into leaf getters, by id of the spec dict
+COMPILED_SPECS = {}
+
+def compile_spec(spec):
+    compiled = COMPILED_SPECS.get(id(spec))
+    if compiled is not None:
+        return compiled
+    walk = spec.get('walk',[])
+    compiled = {
+        'walk' : [leaf_getter(leaf) for leaf in walk],
+        'match' : [[(leaf_getter(leaf), strip_value_prefix(value)) for leaf, value in spec.get('match',{}).get(level,{}).items()]
+                   for level in range(len(walk) + 1)],
+        'group' : (spec['group'][0], leaf_getter(spec['group'][1])) if 'group' in spec else None,
+        'exclude_group' : re.compile(spec['exclude_group']) if 'exclude_group' in spec else None,
+        'key' : leaf_getter(spec['key']) if 'key' in spec else None,
+        'values' : [(name, leaf_getter(leaf)) for name, leaf in spec['value'].items()] if type(spec['value']) is dict else None,
+        'value' : leaf_getter(spec['value']) if type(spec.get('value')) is str else None,
+        'optional' : set(spec.get('optional',[])),
+    }
+    COMPILED_SPECS[id(spec)] = compiled
+    return compiled
+
+def entry_matches_spec(entry,conditions):
+    for get_leaf, value in conditions:
+        leaf_value = get_leaf(entry)
+        if leaf_value != value and strip_value_prefix(leaf_value) != value:
+            return False
+    return True
+
+def spec_lists(compiled,entry,level=0,chain=()):
+    #Yields (entries of every level above the innermost one, innermost list) for each innermost list under a root entry
+    if not entry_matches_spec(entry,compiled['match'][level]):
+        return
+    children = compiled['walk'][level](entry)
+    if type(children) is not list:
+        return
+    chain = chain + (entry,)
+    if level == len(compiled['walk']) - 1:
+        yield chain, children
+        return
+    for child in children:
+        yield from spec_lists(compiled,child,level+1,chain)
+
+def extract_entry(spec,section_data,hostname,root_entry):
+    compiled = compile_spec(spec)
+    base = section_data if spec.get('top_level') else section_data[hostname]
+    if compiled['walk']:
+        innermost_lists = spec_lists(compiled,root_entry)
+    else:
+        innermost_lists = [((),[root_entry])]
+    innermost_match = compiled['match'][len(compiled['walk'])]
+    get_key, get_value, get_values, optional = compiled['key'], compiled['value'], compiled['values'], compiled['optional']
+    consume, collect = spec.get('consume'), spec.get('collect')
+    for chain, entries in innermost_lists:
+        if not entries:
+            continue
+        target = base
+        if compiled['group']:
+            level, get_group = compiled['group']
+            group = get_group(chain[level])
+            target = target.setdefault(group,{})
+            if compiled['exclude_group'] and compiled['exclude_group'].search(str(group)):
+                if consume:
+                    entries.clear()
+                continue
+        for entry in consume_list(entries) if consume else entries:
+            if innermost_match and not entry_matches_spec(entry,innermost_match):
+                continue
+            if get_values is None:
+                value = get_value(entry)
+            else:
+                value = {}
+                for name, get_leaf in get_values:
+                    leaf_value = get_leaf(entry)
+                    if leaf_value is None and name in optional:
+                        continue
+                    value[name] = leaf_value
+            if collect:
+                target.append(value)
+            else:
+                target[get_key(entry)] = value
+
+def extract_sections(raw_data,hostname,specs):
+    #Fills every section in specs (section -> spec) from one response, walking its root entries once
+    sections = {}
+    walked_specs = {}
+    for section, spec in specs.items():
+        if spec.get('root_value'):
+            sections[section] = {hostname : raw_data}
+            continue
+        sections[section] = {hostname : [] if spec.get('collect') else {}}
+        walked_specs[section] = spec
+        if 'missing_message' in spec and resolve_leaf(raw_data if type(raw_data) is dict else {},spec['walk'][0]) is None:
+            print (spec['missing_message'])
+    if type(raw_data) is list:
+        root_entries = raw_data
+    elif type(raw_data) is dict:
+        root_entries = [raw_data]
+    else:
+        root_entries = []
+    for root_entry in root_entries:
+        for section, spec in walked_specs.items():
+            extract_entry(spec,sections[section],hostname,root_entry)
+    return sections
+
+def extract_section(section,raw_data,hostname,version=None):
+    return extract_sections(raw_data,hostname,{section : EXTRACTION_SPECS[select_release(version)][section]})[section]
+
+@instrumented('parse_bgp_gnmi_v22')
 def parse_bgp_gnmi_v22(bgp_raw_data,hostname):
-    tor_bgp_status = {}
-    tor_bgp_status[hostname]= {}
-    for peer in bgp_raw_data:
-        #print (peer['peer-address']['afi-safi-name'])
-        tor_bgp_status[hostname].update({peer['peer-address'] : {'session-state': peer['session-state'], 'address_family_ipv4_received_routes': peer['ipv4-unicast']['received-routes'], 'address_family_evpn_received_routes': peer['evpn']['received-routes'], 'address_family_ipv6_received_routes': peer['ipv6-unicast']['received-routes'] }})
-    return tor_bgp_status  
-
-#This data structure is assuming v23+ is now the standard
+    return extract_section('bgp',bgp_raw_data,hostname,'v22')
+
+@instrumented('parse_bgp_gnmi')
 def parse_bgp_gnmi(bgp_raw_data,hostname):
-    tor_bgp_status = {}
-    tor_bgp_status[hostname]= {}
-    tor_evpn_info = {}
-    tor_ipv4_info = {}
-    tor_ipv6_info = {}
-    for peer in bgp_raw_data:
-        for family in peer['afi-safi']:
-            if family['afi-safi-name'] == 'srl_nokia-common:evpn':
-                #tor_bgp_status[hostname].update({peer['peer-address'] : {'session-state': peer['session-state'], 'address_family_evpn_received_routes': family['received-routes'] }})
-                tor_evpn_info = {'session-state': peer['session-state'], 'address_family_evpn_received_routes': family['received-routes']}
-            elif family['afi-safi-name'] == 'srl_nokia-common:ipv4-unicast':
-                #tor_bgp_status[hostname].update({peer['peer-address'] : {'session-state': peer['session-state'], 'address_family_ipv4_received_routes': family['received-routes'] }})
-                tor_ipv4_info = {'session-state': peer['session-state'], 'address_family_ipv4_received_routes': family['received-routes']}
-            elif family['afi-safi-name'] == 'srl_nokia-common:ipv6-unicast':
-                #tor_bgp_status[hostname].update({peer['peer-address'] : {'session-state': peer['session-state'], 'address_family_ipv6_received_routes': family['received-routes'] }})
-                tor_ipv6_info = {'session-state': peer['session-state'], 'address_family_ipv6_received_routes': family['received-routes']}
-        
-        tor_bgp_status[hostname].update({peer['peer-address']: {'session-state': peer['session-state'], 'address_family_evpn_received_routes' : tor_evpn_info['address_family_evpn_received_routes'], 'address_family_ipv4_received_routes': tor_ipv4_info['address_family_ipv4_received_routes'], 'address_family_ipv6_received_routes': tor_ipv6_info['address_family_ipv6_received_routes']}})
-    return tor_bgp_status
-def parse_srl_version(version_raw_data,hostname):
-    tor_version = {}
-    tor_version[hostname] = {}
-    tor_version[hostname] = version_raw_data
-    return tor_version
+    return extract_section('bgp',bgp_raw_data,hostname,'v23')
 
+@instrumented('parse_srl_version')
+def parse_srl_version(version_raw_data,hostname):
+    return extract_section('version',version_raw_data,hostname)
 
+@instrumented('parse_srl_applications')
 def parse_srl_applications(application_path_raw,hostname):
-    tor_application = {}
-    tor_application[hostname] = {}
-    
-    for app in application_path_raw:
-        tor_application[hostname].update({app['name'] : app['state']})
-    return tor_application
-
+    return extract_section('app',application_path_raw,hostname)
 
+@instrumented('parse_network_instances')
 def parse_network_instances(network_instance_raw,hostname):
-    tor_network_instance = {}
-    tor_network_instance[hostname] = {}
-    for vrf in network_instance_raw:
-        tor_network_instance[hostname].update({vrf['name']:vrf['oper-state']})
-    return tor_network_instance
+    return extract_section('network-instance',network_instance_raw,hostname)
 
-def parse_arp_status(arp_status_raw,hostname):
-    tor_arp_status = {}
-    tor_arp_status[hostname] = {}
-    for interface in arp_status_raw:
-        if 'subinterface' in interface.keys():
-            for subint in interface['subinterface']:
-                if 'ipv4' in subint.keys(): #not all subinterfaces will have an ipv4 entry, check that
-                    if 'neighbor' in subint['ipv4']['srl_nokia-interfaces-nbr:arp'].keys(): #check that there are neighbors listed under arp
-                        tor_arp_status[hostname].update({subint['name'] : []}) #Create a key in the dictonary for the sub interface name if we know it will have arps
-                        for neighbor in subint['ipv4']['srl_nokia-interfaces-nbr:arp']['neighbor']:
-                            if neighbor['origin'] == 'dynamic': 
-                                #Only save data that has a dynamic entry, not evpn routes
-                                #Append the ipv4 address, mac etc in a list 
-                                # Skip what's on the mgmt interface
-                                if 'mgmt0.0' in subint['name']: 
-                                    continue
-                                else:
-                                    #changing structure
-                                    #tor_arp_status[hostname][subint['name']].append({'ipv4_address' : neighbor['ipv4-address'],'mac_address' : neighbor['link-layer-address']})
-                                    tor_arp_status[hostname][subint['name']].append({neighbor['ipv4-address'] : neighbor['link-layer-address']})
-    return tor_arp_status
+def consume_list(entries):
+    #Yield the entries of a list while removing them from it, so the raw data is released while it is parsed
+    entries.reverse()
+    while entries:
+        yield entries.pop()
 
+@instrumented('parse_arp_status',nested=True)
+def parse_arp_status(arp_status_raw,hostname):
+    return extract_section('arp',arp_status_raw,hostname)
 
+@instrumented('parse_interface_status')
 def parse_interface_status(interface_raw_data,hostname):
-    tor_interface_status = {}
-    tor_interface_status[hostname] = {}
-    for port in interface_raw_data:
-        #If port has no description configured, there is not default value, so check keys first if has it, save it, if not just get port op status
-        if 'description' in port.keys():
-            tor_interface_status[hostname].update({port['name']: {'port_description' :port['description'], 'port_oper_state': port['oper-state']}})
+    return extract_section('interface',interface_raw_data,hostname)
+
+@instrumented('parse_fan_status')
+def parse_fan_status(fan_raw_data,hostname):
+    return extract_section('fan',fan_raw_data,hostname)
+
+@instrumented('parse_power_supply_status')
+def parse_power_supply_status(power_supply_raw_data,hostname):
+    return extract_section('power',power_supply_raw_data,hostname)
+
+@instrumented('parse_control_status')
+def parse_control_status(control_status_raw,hostname):
+    return extract_section('control',control_status_raw,hostname)
+
+@instrumented('parse_linecard_status')
+def parse_linecard_status(linecard_status_raw,hostname):
+    return extract_section('linecard',linecard_status_raw,hostname)
+
+@instrumented('parse_mac_information',nested=True)
+def parse_mac_information(network_instance_raw,hostname):
+    return extract_section('mac',network_instance_raw,hostname)
+
+@instrumented('parse_tunnel_information')
+def parse_tunnel_information(tunnel_data_raw,hostname):
+    return extract_section('tunnel',tunnel_data_raw,hostname)
+
+#Leaves watched by the flap check and the key they are saved under for each port
+FLAP_CHECK_LEAVES = {
+    'admin-state' : 'admin_state',
+    'oper-state' : 'oper_state',
+    'last-change' : 'state_change',
+    'in-error-packets' : 'in_errors',
+    'out-error-packets' : 'out_errors',
+}
+
+def parse_flap_update(update,prefix):
+    #Returns (port, leaf, value) for one streamed interface update
+    update_path = update.get('path')
+    if prefix and update_path:
+        update_path = prefix + '/' + update_path
+    elements = split_gnmi_path(update_path)
+    if not elements or elements[0][0] != 'interface' or 'name' not in elements[0][1]:
+        return None, None, None
+    value = update.get('val')
+    if type(value) is dict and len(value) == 1:
+        value = list(value.values())[0]
+    return elements[0][1]['name'], elements[-1][0], value
+
+#Interfaces without error counters (loopbacks, irb, system), matched on the whole name like the keep rule of
+#DEFAULT_PORT_SHUTDOWN_POLICY so a name that only contains lo or irb is still checked
+NO_STATS_INTERFACES = re.compile(r'(system|lo|irb)\d+')
+
+def check_bouncing_ports(session,hostname,flap_window=10,sample_interval=2):
+    #Stream oper-state/last-change on change and the error counters every sample_interval, instead of sampling the whole
+    #interface tree twice. Every transition is recorded with its timestamp. The check watches for flap_window seconds
+    #after sync, and ends early only once a flap is seen
+    subscription = {'subscription' : [], 'mode' : 'stream', 'encoding' : 'json_ietf'}
+    for leaf in ['admin-state','oper-state','last-change']:
+        subscription['subscription'].append({'path' : '/interface[name=*]/' + leaf, 'mode' : 'on_change'})
+    for leaf in ['in-error-packets','out-error-packets']:
+        subscription['subscription'].append({'path' : '/interface[name=*]/statistics/' + leaf, 'mode' : 'sample', 'sample_interval' : int(sample_interval * 1000000000)})
+    try:
+        stream = session.subscribe(subscribe=subscription)
+    except gNMIException as ex:
+        print ('Could not subscribe to interface state, falling back to polling: ' + str(ex))
+        return check_bouncing_ports_poll(session,hostname,flap_window)
+
+    messages = queue.Queue()
+    def read_stream():
+        try:
+            for message in stream:
+                messages.put(telemetryParser(message))
+        except Exception as ex:
+            messages.put({'error' : ex})
+    threading.Thread(target=read_stream,daemon=True).start()
+
+    port_values = {}
+    flagged_ports = set()
+    transitions = []
+    synced = False
+    print ('Streaming interface state to check for port flaps..')
+    #Give the device some time to send the initial state before giving up on the stream
+    sync_deadline = time.time() + max(30,flap_window)
+    window_deadline = None
+    while True:
+        now = time.time()
+        if synced:
+            if flagged_ports or now >= window_deadline:
+                break
+            timeout = window_deadline - now
         else:
-            tor_interface_status[hostname].update({port['name']: {'port_oper_state' : port['oper-state']}})
-    return tor_interface_status
+            if now >= sync_deadline:
+                break
+            timeout = sync_deadline - now
+        try:
+            message = messages.get(timeout=max(timeout,0.01))
+        except queue.Empty:
+            continue
+        if message is None:
+            continue
+        if 'error' in message:
+            logging.debug('interface state stream ended: ' + str(message['error']))
+            break
+        if 'sync_response' in message:
+            print ('Initial interface state received, watching for ' + str(flap_window) + ' seconds..')
+            synced = True
+            window_deadline = time.time() + flap_window
+            continue
+        if 'update' not in message:
+            continue
+        timestamp = message['update'].get('timestamp',0)
+        for update in message['update'].get('update',[]):
+            port, leaf, value = parse_flap_update(update,message['update'].get('prefix'))
+            if port is None or leaf not in FLAP_CHECK_LEAVES:
+                continue
+            key = FLAP_CHECK_LEAVES[leaf]
+            port_values.setdefault(port,{})
+            previous = port_values[port].get(key)
+            port_values[port][key] = value
+            if not synced or previous is None or previous == value:
+                continue
+            if key == 'admin_state':
+                continue
+            transitions.append({'port' : port, 'leaf' : leaf, 'from' : previous, 'to' : value,
+                                'time' : datetime.fromtimestamp(timestamp / 1000000000).isoformat() if timestamp else datetime.now().isoformat()})
+            flagged_ports.add(port)
+    try:
+        stream.cancel()
+    except Exception:
+        pass
+
+    if not synced:
+        print ('Did not get the initial interface state from the stream, falling back to polling')
+        return check_bouncing_ports_poll(session,hostname,flap_window)
+
+    tor_port_status = {}
+    tor_port_status[hostname] = {}
+    for port in port_values:
+        values = port_values[port]
+        #Admin disabled ports do not have stats, nor do irb/loopbacks or system so continue in loop
+        if values.get('admin_state') == 'disable' or NO_STATS_INTERFACES.fullmatch(port):
+            continue
+        if 'state_change' not in values or 'in_errors' not in values or 'out_errors' not in values:
+            print (port + ' did not have stats, most likley port is up but never passed traffic. continuing..')
+            continue
+        tor_port_status[hostname].update({port : {'state_change' : values['state_change'], 'in_errors' : values['in_errors'], 'out_errors' : values['out_errors'],
+                                                  'port_issues' : port in flagged_ports,
+                                                  'transitions' : [transition for transition in transitions if transition['port'] == port]}})
+    return tor_port_status
 
-def check_bouncing_ports(gnmi_host,username,password,hostname):
+def check_bouncing_ports_poll(session,hostname,flap_window=10):
     tor_port_status = {}
     tor_port_status[hostname] = {}
     tor_port_status_recheck = {}
     tor_port_status_recheck[hostname] = {}
     gnmi_path = '/interface/'
-    interface_raw_data = run_gnmi_query(gnmi_host,username,password,hostname,gnmi_path)
+    interface_raw_data = run_gnmi_query(session,gnmi_path)
     interface_status_parsed_data = parse_gnmi_result(interface_raw_data)
     print ('Checking initial state change time for interfaces..')
     for interface in interface_status_parsed_data:
         #Admin disabled ports do not have stats, nor do irb/loopbacks or system so continue in loop
-        if interface['admin-state'] == 'disable' or 'irb' in interface['name'] or 'lo' in interface['name'] or 'system' in interface['name']:
+        if interface['admin-state'] == 'disable' or NO_STATS_INTERFACES.fullmatch(interface['name']):
             continue
         try:
             tor_port_status[hostname].update({interface['name'] : {'state_change' : interface['last-change'], 'in_errors' : interface['statistics']['in-error-packets'], 
                                                                'out_errors' : interface['statistics']['out-error-packets'], 'port_issues' : False} })
         except: print (interface['name'] + ' did not have stats, most likley port is up but never passed traffic. continuing..')
-    print ('Sleeping 10 seconds to check for port flaps..')
-    time.sleep(10)
+    print ('Sleeping ' + str(flap_window) + ' seconds to check for port flaps..')
+    time.sleep(flap_window)
     #Loop through calls again, and build a secondary dictonary to compare new values to
-    interface_raw_data = run_gnmi_query(gnmi_host,username,password,hostname,gnmi_path)
+    interface_raw_data = run_gnmi_query(session,gnmi_path)
     interface_status_parsed_data = parse_gnmi_result(interface_raw_data)
 
     for interface in interface_status_parsed_data:
         #Admin disabled ports do not have stats, so continue in loop
-        if interface['admin-state'] == 'disable' or 'irb' in interface['name'] or 'lo' in interface['name'] or 'system' in interface['name']:
+        if interface['admin-state'] == 'disable' or NO_STATS_INTERFACES.fullmatch(interface['name']):
             continue
         try:
             tor_port_status_recheck[hostname].update({interface['name'] : {'state_change' : interface['last-change'], 'in_errors' : interface['statistics']['in-error-packets'], 
@@ -182,666 +983,1661 @@ def report_port_issues(port_status,hostname):
     for interface in port_status[hostname]:
         if port_status[hostname][interface]['port_issues'] == True:
             print ('\033[1;31m This port is flapping or errors incrementing: ' + interface + '\033[0;0m')
+            for transition in port_status[hostname][interface].get('transitions',[]):
+                print ('    ' + transition['time'] + ' ' + transition['leaf'] + ' ' + str(transition['from']) + ' -> ' + str(transition['to']))
             issues_found = True
         else: continue
     if issues_found == False:
         print ('\033[1;32m No issues found with port errors or flaps \033[0;0m')
-def generate_port_shutdown(tor_port_status,gnmi_host,username,password,hostname):
+#Paths indexed to classify ports: the type and interfaces of every network instance, and the lag of every port
+PORT_INDEX_PATHS = [
+    '/network-instance[name=*]/type',
+    '/network-instance[name=*]/interface[name=*]',
+    '/interface[name=*]/ethernet/aggregate-id',
+]
+
+#Which up ports the pre check shuts. Rules are checked in order and the first match wins. A rule matches on any of: name (a
+#regex the whole port name has to match), network_instance_types or network_instances (a regex on the names) the port or its
+#lag is in, and lag_member. -port_policy loads a json/yaml list of rules in this format instead
+DEFAULT_PORT_SHUTDOWN_POLICY = [
+    {'action' : 'keep', 'name' : r'(mgmt|system|lo|irb)\d+', 'reason' : 'management, system, loopback or irb interface'},
+    {'action' : 'keep', 'network_instance_types' : ['default'], 'reason' : 'uplink in the default network instance'},
+    {'action' : 'shutdown', 'reason' : 'access port'},
+]
+
+def load_policy_file(policy_file,description='policy'):
+    if policy_file.endswith('.yml') or policy_file.endswith('.yaml'):
+        if yaml is None:
+            raise SystemExit('PyYAML is not installed, install it or use a json ' + description)
+        with open(policy_file) as infile:
+            return yaml.safe_load(infile)
+    with open(policy_file) as infile:
+        return json.load(infile)
+
+def load_port_policy(policy_file):
+    policy = load_policy_file(policy_file,'port policy')
+    for rule in policy:
+        if rule.get('action') not in ('keep','shutdown'):
+            raise SystemExit('Port policy rule needs an action of keep or shutdown: ' + str(rule))
+    return policy
+
+def compile_port_policy(policy):
+    compiled_policy = []
+    for rule in policy:
+        rule = dict(rule)
+        for key in ('name','network_instances'):
+            if key in rule:
+                rule[key] = re.compile(rule[key])
+        if 'network_instance_types' in rule:
+            rule['network_instance_types'] = set(rule['network_instance_types'])
+        compiled_policy.append(rule)
+    return compiled_policy
+
+def physical_port(interface_name):
+    #ethernet-1/49.0 -> ethernet-1/49
+    return interface_name.split('.')[0]
+
+def build_port_index(session):
+    #One get and one pass: port -> {'network_instances' : {name : type}, 'lag' : lag it is a member of}. Lag members are
+    #indexed with the network instances of their lag as well
+    raw_data = run_gnmi_query(session,PORT_INDEX_PATHS)
+    updates = []
+    for notification in raw_data.get('notification',[]):
+        updates.extend(notification.get('update',[]))
+    tree = build_tree_from_updates(updates)
+    port_index = {}
+    for interface in tree.get('interface',[]):
+        aggregate_id = get_child(interface.get('ethernet') or {},'aggregate-id')
+        port_index.setdefault(interface['name'],{'network_instances' : {}, 'lag' : None})['lag'] = aggregate_id
+    for instance in tree.get('network-instance',[]):
+        instance_type = str(instance.get('type','')).split(':')[-1]
+        for interface in instance.get('interface',[]):
+            port = physical_port(interface['name'])
+            port_index.setdefault(port,{'network_instances' : {}, 'lag' : None})['network_instances'][instance['name']] = instance_type
+    for port, entry in port_index.items():
+        if entry['lag'] in port_index and entry['lag'] != port:
+            entry['network_instances'] = dict(port_index[entry['lag']]['network_instances'], **entry['network_instances'])
+    return port_index
+
+def classify_port(port,port_index,compiled_policy):
+    #Returns (action, reason) of the first policy rule the port matches
+    entry = port_index.get(port) or {'network_instances' : {}, 'lag' : None}
+    for rule in compiled_policy:
+        if 'name' in rule and not rule['name'].fullmatch(port):
+            continue
+        if 'network_instance_types' in rule and rule['network_instance_types'].isdisjoint(entry['network_instances'].values()):
+            continue
+        if 'network_instances' in rule and not any(rule['network_instances'].fullmatch(instance) for instance in entry['network_instances']):
+            continue
+        if 'lag_member' in rule and bool(entry['lag']) != rule['lag_member']:
+            continue
+        return rule['action'], rule.get('reason','')
+    return 'keep', 'no port policy rule matched'
+
+def generate_port_shutdown(tor_port_status,session,hostname,policy=None):
+    #Every port that is up and classified shutdown by the port policy
     tor_access_ports_for_shutdown = {}
     tor_access_ports_for_shutdown[hostname] = []
-    port_is_uplink = False
-    gnmi_path = '/network-instance[name=default]/interface/'
-    interface_base_data = run_gnmi_query(gnmi_host,username,password,hostname,gnmi_path)
-    interface_base_parsed_data = parse_gnmi_result(interface_base_data)
+    port_index = build_port_index(session)
+    compiled_policy = compile_port_policy(policy or DEFAULT_PORT_SHUTDOWN_POLICY)
     for port in tor_port_status[hostname]:
         #We only care about ports that are up to later shutdown
-        if tor_port_status[hostname][port]['port_oper_state'] == 'up':
-            for base_port in interface_base_parsed_data:
-                base_port_no_sub = base_port['name'].split('.')
-                #This is hacky.. but the problem is looking in the default network instance, those interfaces will be xx.sub interface. 
-                #to match properly with normal ethernet ports, above splits the network instance interfaces so it will just be ethernetx/x and not the ethernetx/x.x
-                if port == base_port_no_sub[0]:
-                    port_is_uplink = True
-                    break
-            if port_is_uplink == False:
-                #We don't want to shutdown irbs, los, system or mgmt ports so skip them
-                if 'irb' not in port:
-                    if 'lo' not in port:
-                        if 'system' not in port:
-                            if 'mgmt' not in port: 
-                                    tor_access_ports_for_shutdown[hostname].append(port)
-                continue
-            else: 
-                port_is_uplink = False
-                continue
+        if tor_port_status[hostname][port]['port_oper_state'] != 'up':
+            continue
+        action, reason = classify_port(port,port_index,compiled_policy)
+        logging.debug(port + ': ' + action + ', ' + reason)
+        if action == 'shutdown':
+            tor_access_ports_for_shutdown[hostname].append(port)
     return tor_access_ports_for_shutdown
-def shutdown_access_ports(tor_access_ports_for_shutdown,gnmi_host,username,password,hostname):
+
+#Actions that need an approval, answered at the prompt unless an approval policy is given. A policy maps each action to
+#approve, deny or prompt (actions it leaves out are prompted for), and max_shutdown_ports denies shutting more ports than that
+APPROVAL_ACTIONS = ['enter_maint_mode','shutdown_ports','exit_maint_mode']
+APPROVAL_PROMPT_LOCK = threading.Lock()
+
+def load_approval_policy(policy_file):
+    approvals = load_policy_file(policy_file,'approval policy')
+    for action in APPROVAL_ACTIONS:
+        if approvals.get(action,'prompt') not in ('approve','deny','prompt'):
+            raise SystemExit('Approval policy action ' + action + ' needs approve, deny or prompt')
+    return approvals
+
+def request_approval(action,question,approvals,hostname,count=None):
+    decision = 'prompt' if approvals is None else approvals.get(action,'prompt')
+    if decision == 'approve' and action == 'shutdown_ports' and count is not None and count > approvals.get('max_shutdown_ports',count):
+        print ('\033[1;31m ' + hostname + ': ' + str(count) + ' ports to shut is over max_shutdown_ports ' + str(approvals['max_shutdown_ports']) + ', denied by the approval policy \033[0;0m')
+        return False
+    if decision == 'prompt':
+        #Workers of the wave scheduler share the terminal, one question at a time
+        with APPROVAL_PROMPT_LOCK:
+            answer = input(hostname + ': ' + question)
+        return answer == "Y"
+    print (hostname + ': ' + action + ' ' + ('approved' if decision == 'approve' else 'denied') + ' by the approval policy')
+    return decision == 'approve'
+
+def shutdown_access_ports(tor_access_ports_for_shutdown,session,hostname,extra_updates=None,chunk_size=0,approvals=None):
+    #All ports are shut in one set so they go down together. extra_updates (the bgp maint mode change) are sent in the same set.
+    #Returns whether the shutdown was approved
     print (f"Script is now ready to shutdown ports to prepare for upgrade, these are the ports that will be shutdown:")
     print (tor_access_ports_for_shutdown)
-    answer = input("Enter Y or N for shutting down the ports: ")
-    if answer == "Y":
+    approved = request_approval('shutdown_ports',"Enter Y or N for shutting down the ports: ",approvals,hostname,len(tor_access_ports_for_shutdown[hostname]))
+    updates = list(extra_updates or [])
+    if approved:
         for port in tor_access_ports_for_shutdown[hostname]:
             gnmi_path = (f"interface[name={port}]",
                            {"admin-state": "disable"}
                          )
                         
             print (gnmi_path)
-            run_gnmi_set(gnmi_host,username,password,hostname,gnmi_path)
+            updates.append(gnmi_path)
     else: print ("Input was N, or not proper input. Exiting, but data has been saved for upgrade")
+    if updates:
+        run_gnmi_set_batch(session,updates,chunk_size)
+    return approved
 
-def enter_bgp_maint_mode(gnmi_host,username,password,hostname):
+def bgp_maint_mode_update(admin_state):
+    return (f"/system/maintenance/group[name=ebgp-ipv4-maintenance]/maintenance-mode/",
+            {"admin-state" : admin_state}
+            )
+
+def enter_bgp_maint_mode(session,apply=True,approvals=None):
+    #With apply False the change is only returned, so it can go out in the same set as the port shutdown
     print (f"Script is now ready to put the device into bgp maintenance mode. Should this be executed?")
-    answer = input("Enter Y or N to execute bgp maintenance mode: ")
-    if answer == "Y":
-        gnmi_path = (f"/system/maintenance/group[name=ebgp-ipv4-maintenance]/maintenance-mode/",
-                     {"admin-state" : "enable"}
-                     )
+    if request_approval('enter_maint_mode',"Enter Y or N to execute bgp maintenance mode: ",approvals,session.hostname):
+        gnmi_path = bgp_maint_mode_update("enable")
         print (gnmi_path)
-        run_gnmi_set(gnmi_host,username,password,hostname,gnmi_path)
+        if apply:
+            run_gnmi_set(session,gnmi_path)
+        return gnmi_path
     else: print ("Input was N, or not proper input. Continuning, but data has been saved for upgrade")
+    return None
 
-def exit_bgp_maint_mode(gnmi_host,username,password,hostname):
+def exit_bgp_maint_mode(session,apply=True,approvals=None):
     print (f"Script is now ready to exit the device out of bgp maintenance mode. Should this be executed?")
-    answer = input("Enter Y or N to exit bgp maintenance mode: ")
-    if answer == "Y":
-        logging.debug('User entered Y, and running GNMI commands to exit BGP maint mode')
-        gnmi_path = (f"/system/maintenance/group[name=ebgp-ipv4-maintenance]/maintenance-mode/",
-                     {"admin-state" : "disable"}
-                     )
+    if request_approval('exit_maint_mode',"Enter Y or N to exit bgp maintenance mode: ",approvals,session.hostname):
+        logging.debug('Exit approved, and running GNMI commands to exit BGP maint mode')
+        gnmi_path = bgp_maint_mode_update("disable")
         #print (gnmi_path)
-        run_gnmi_set(gnmi_host,username,password,hostname,gnmi_path)
+        if apply:
+            run_gnmi_set(session,gnmi_path)
         logging.debug('End of exit of bgp maint mode function')
+        return gnmi_path
     else: print ("Input was N, or not proper input. Continuning, without exiting bgp maintenance mode")
+    return None
 
-def no_shutdown_access_ports(gnmi_host,username,password,hostname):
-    tor_ports_no_shutdown_file = open(hostname+'-before'+'/'+hostname+'-port-shutdown-summary'+'.json')
-    tor_ports_no_shutdown = json.load(tor_ports_no_shutdown_file)
+def no_shutdown_access_ports(session,hostname,extra_updates=None,chunk_size=0):
+    tor_ports_no_shutdown = load_section(hostname,'before','port-shutdown')
     print ('These ports will be no shutdown now that were saved from before the upgrade')
     print (tor_ports_no_shutdown)
+    updates = list(extra_updates or [])
     for port in tor_ports_no_shutdown[hostname]:
         gnmi_path = (f"interface[name={port}]",
                            {"admin-state": "enable"}
                          )
         print (gnmi_path)
         #interface[name=ethernet1/1] {admin-state: enable} 
-        run_gnmi_set(gnmi_host,username,password,hostname,gnmi_path)
-def run_gnmi_set(gnmi_host,username,password,hostname,gnmi_path):
-    with gNMIclient(target=gnmi_host, username=username, password=password, override=hostname) as gc:
-        raw_data = gc.set(update=[gnmi_path])
+        updates.append(gnmi_path)
+    if updates:
+        run_gnmi_set_batch(session,updates,chunk_size)
+
+@instrumented('run_gnmi_set')
+def run_gnmi_set(session,gnmi_path):
+    raw_data = session.set(update=[gnmi_path])
+    logging.debug('running gnmi set, raw_data to follow')
+    logging.debug(raw_data)
+    logging.debug('end of raw_data from gnmi set command')
+
+@instrumented('run_gnmi_set_batch')
+def run_gnmi_set_batch(session,updates,chunk_size=0):
+    #Every update goes in one set request, which the device commits as one transaction.
+    #chunk_size splits very large lists over several set requests, each still applied as a whole
+    for update_group in group_gnmi_paths(updates,chunk_size):
+        logging.debug('running gnmi set with ' + str(len(update_group)) + ' updates')
+        raw_data = session.set(update=update_group)
         logging.debug('running gnmi set, raw_data to follow')
         logging.debug(raw_data)
         logging.debug('end of raw_data from gnmi set command')
-        #raw_data = gc.set()
 
-def parse_fan_status(fan_raw_data,hostname):
-    tor_fan_status = {}
-    tor_fan_status[hostname] = {}
-    for fan in fan_raw_data:
-        tor_fan_status[hostname].update({fan['id'] : fan['oper-state']})
-    return tor_fan_status
-
-def parse_power_supply_status(power_supply_raw_data,hostname):
-    tor_power_supply_status = {}
-    tor_power_supply_status[hostname] = {}
-    for fan in power_supply_raw_data:
-        tor_power_supply_status.update({fan['id']: fan['oper-state']})
-    return tor_power_supply_status
-
-def parse_control_status(control_status_raw,hostname):
-    tor_control_status = {}
-    tor_control_status[hostname] = {}
-    for card in control_status_raw:
-        #print (card['slot'])
-        tor_control_status.update({card['slot']: {'card_type' : card['type'], 'card_oper_status': card['oper-state']}})
-    return tor_control_status
-
-def parse_linecard_status(linecard_status_raw,hostname):
-    tor_linecard_status = {}
-    tor_linecard_status[hostname] = {}
-    for card in linecard_status_raw:
-        tor_linecard_status.update({card['slot']: {'card_type' : card['type'], 'card_oper_status': card['oper-state']}})
-    return tor_linecard_status
-
-def parse_mac_information(network_instance_raw,hostname):
-    tor_mac_vrf_information = {}
-    tor_mac_vrf_information[hostname] = {}
-    for service in network_instance_raw:
-        if service['type'] == 'srl_nokia-network-instance:mac-vrf':
-            #Only grab services that have mac addresses in it
-            if len(service['bridge-table']['mac-learning']['srl_nokia-bridge-table-mac-learning-entries:learnt-entries']) >=1:
-                tor_mac_vrf_information[hostname].update({service['name'] : []}) #update dictonary with key for service name, so we can append macs to it later. 
-                for mac in service['bridge-table']['mac-learning']['srl_nokia-bridge-table-mac-learning-entries:learnt-entries']['mac']:
-                    #changing structure
-                    #tor_mac_vrf_information[hostname][service['name']].append({'mac_address' : mac['address'],'interface_leanred' : mac['destination']})
-                    tor_mac_vrf_information[hostname][service['name']].append({mac['address']:  mac['destination']})
-
-    return tor_mac_vrf_information
-    
-def parse_tunnel_information(tunnel_data_raw,hostname):
-    tor_tunnel_information = {}
-    tor_tunnel_information[hostname] = []
+def split_gnmi_path(gnmi_path):
+    #Split a gnmi path string into (name, keys) elements. Keys can hold a / (ethernet-1/1) so only split outside of []
+    elements = []
+    if not gnmi_path:
+        return elements
+    element = ''
+    depth = 0
+    for char in gnmi_path:
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        if char == '/' and depth == 0:
+            if element:
+                elements.append(element)
+            element = ''
+        else:
+            element += char
+    if element:
+        elements.append(element)
+    parsed_elements = []
+    for element in elements:
+        name = element.split('[')[0]
+        #Module prefixes (srl_nokia-interfaces:interface) are dropped so requested and returned paths line up
+        name = name.split(':')[-1]
+        keys = {}
+        for key in element[len(element.split('[')[0]):].strip('[]').split(']['):
+            if '=' in key:
+                key_name, key_value = key.split('=',1)
+                keys[key_name] = key_value
+        parsed_elements.append((name,keys))
+    return parsed_elements
+
+def gnmi_path_matches(requested_path,update_path):
+    #True if the update path is the requested path, or falls under it. A * key in the request matches any value
+    requested_elements = split_gnmi_path(requested_path)
+    update_elements = split_gnmi_path(update_path)
+    if len(update_elements) < len(requested_elements):
+        return False
+    for (requested_name,requested_keys),(update_name,update_keys) in zip(requested_elements,update_elements):
+        if requested_name != update_name:
+            return False
+        for key_name in requested_keys:
+            if requested_keys[key_name] != '*' and update_keys.get(key_name) != requested_keys[key_name]:
+                return False
+    return True
+
+def demux_gnmi_result(raw_data,gnmi_paths):
+    #Split the result of a multi path gnmi get back into one result per requested path, so parse_gnmi_result can be used on each
+    demuxed_data = {}
+    for gnmi_path in gnmi_paths:
+        demuxed_data[gnmi_path] = {'notification' : [{'update' : []}]}
+    if not raw_data or 'notification' not in raw_data.keys():
+        return demuxed_data
+    notifications = raw_data['notification']
+    for index, notification in enumerate(notifications):
+        if 'update' not in notification.keys():
+            continue
+        for update in notification['update']:
+            update_path = update.get('path')
+            if notification.get('prefix') and update_path:
+                update_path = notification['prefix'] + '/' + update_path
+            matched_path = None
+            matched_length = -1
+            #Most specific requested path wins, /network-instance/ should not take the bgp neighbor updates
+            for gnmi_path in gnmi_paths:
+                if update_path and gnmi_path_matches(gnmi_path,update_path) and len(split_gnmi_path(gnmi_path)) > matched_length:
+                    matched_path = gnmi_path
+                    matched_length = len(split_gnmi_path(gnmi_path))
+            #Fall back to the order of the request if the device returned one notification per path
+            if matched_path is None and len(notifications) == len(gnmi_paths):
+                matched_path = gnmi_paths[index]
+            if matched_path is None:
+                logging.debug('Could not match update path to a requested path, skipping: ' + str(update_path))
+                continue
+            demuxed_data[matched_path]['notification'][0]['update'].append(update)
+    return demuxed_data
+
+def group_gnmi_paths(gnmi_paths,batch_size):
+    #Split the paths (or set updates) into groups of at most batch_size for each request, 0 keeps them all in one request
+    if batch_size <= 0:
+        return [list(gnmi_paths)]
+    return [list(gnmi_paths[index:index+batch_size]) for index in range(0,len(gnmi_paths),batch_size)]
+
+def fetch_collection_paths(session,gnmi_paths,batch=False,batch_size=0,rpc_timeout=None):
+    #Returns the parsed data for each path. With batch set the paths are sent together in as few gets as batch_size allows
+    parsed_data = {}
+    if not batch:
+        for gnmi_path in gnmi_paths:
+            logging.debug('Getting TOR data for ' + gnmi_path)
+            raw_data = run_gnmi_query(session,gnmi_path,'all',rpc_timeout)
+            parsed_data[gnmi_path] = parse_gnmi_result(raw_data)
+        return parsed_data
+    for path_group in group_gnmi_paths(gnmi_paths,batch_size):
+        logging.debug('Getting TOR data in one get for ' + str(path_group))
+        raw_data = run_gnmi_query(session,path_group,'all',rpc_timeout)
+        demuxed_data = demux_gnmi_result(raw_data,path_group)
+        for gnmi_path in path_group:
+            parsed_data[gnmi_path] = parse_gnmi_result(demuxed_data[gnmi_path])
+    return parsed_data
+
+def fetch_pruned_sections(session,batch=False,batch_size=0,sources=None,path_specs=None,skip_sections=(),rpc_timeout=None):
+    #State only, leaf level version of fetch_collection_paths. Returns the data for each section in COLLECTION_PATHS (or
+    #just the ones in sources), with the pruned sections rebuilt into the shape the parsers expect. Without batch each
+    #section is one get of its own paths. path_specs replaces PRUNED_COLLECTION_PATHS, and the section_paths of
+    #skip_sections are not fetched
+    if path_specs is None:
+        path_specs = PRUNED_COLLECTION_PATHS
+    section_paths = {}
+    for section in (sources or COLLECTION_PATHS):
+        if section in path_specs:
+            skipped_paths = [gnmi_path for skipped in skip_sections for gnmi_path in path_specs[section].get('section_paths',{}).get(skipped,[])]
+            section_paths[section] = [gnmi_path for gnmi_path in path_specs[section]['paths'] if gnmi_path not in skipped_paths]
+        else:
+            section_paths[section] = [COLLECTION_PATHS[section]]
+    if batch:
+        all_paths = [gnmi_path for section in section_paths for gnmi_path in section_paths[section]]
+        path_groups = group_gnmi_paths(all_paths,batch_size)
+    else:
+        path_groups = list(section_paths.values())
+    demuxed_data = {}
+    for path_group in path_groups:
+        logging.debug('Getting TOR state data in one get for ' + str(path_group))
+        raw_data = run_gnmi_query(session,path_group,'state',rpc_timeout)
+        demuxed_data.update(demux_gnmi_result(raw_data,path_group))
+    section_data = {}
+    for section in section_paths:
+        if section not in path_specs:
+            section_data[section] = parse_gnmi_result(demuxed_data[COLLECTION_PATHS[section]])
+            continue
+        updates = []
+        for gnmi_path in section_paths[section]:
+            updates.extend(demuxed_data.pop(gnmi_path)['notification'][0]['update'])
+        node = build_tree_from_updates(updates)
+        for name in path_specs[section]['root'].split('/'):
+            node = node.get(name) if type(node) is dict else None
+        section_data[section] = node if node is not None else path_specs[section]['empty']
+    return section_data
+
+#The collection path (COLLECTION_PATHS key) each section is extracted from. Sections that share a path are extracted
+#together in one pass over its response
+SECTION_SOURCES = {
+    'version' : 'version',
+    'app' : 'app',
+    'network-instance' : 'network-instance',
+    'mac' : 'network-instance',
+    'bgp' : 'bgp',
+    'interface' : 'interface',
+    'arp' : 'interface',
+    'fan' : 'fan',
+    'power' : 'power',
+    'control' : 'control',
+    'linecard' : 'linecard',
+    'tunnel' : 'tunnel',
+}
+
+def sources_timeout(session,sources):
+    #Timeout of a get of these COLLECTION_PATHS sources: the session's -rpc_timeout if set, which replaces the per path
+    #ones, otherwise the longest of their RPC_TIMEOUTS
+    if session.retry_policy['rpc_timeout'] is not None:
+        return session.retry_policy['rpc_timeout']
+    return max(RPC_TIMEOUTS.get(source,RPC_TIMEOUTS['default']) for source in sources)
+
+def collect_tor_data(session,hostname,batch=False,batch_size=0,pruned=False,tor_data=None,checkpoint_dir=None,sections=None,fetch_workers=1):
+    #Gather and parse every section that gets saved and compared (or just the ones in sections), keyed by section name.
+    #Sections already in tor_data (from a checkpoint) are not fetched again. With checkpoint_dir set each section is
+    #written out as soon as it is parsed, so a run that fails part way through can be resumed. Without batch and with
+    #fetch_workers over 1, the paths are fetched in parallel over the session so one slow path (a big /network-instance/)
+    #does not hold up the others
+    if tor_data is None:
+        tor_data = {}
+    wanted = [section for section in SECTION_SOURCES if sections is None or section in sections or (section == 'version' and 'bgp' in sections)]
+    sources = [source for source in COLLECTION_PATHS if any(SECTION_SOURCES[section] == source and section not in tor_data for section in wanted)]
+    #Without batch each path is fetched and parsed on its own, so a failure keeps what came before it
+    if batch:
+        fetch_groups = [sources] if sources else []
+    else:
+        fetch_groups = [[source] for source in sources]
+    #Leaves used only by sections that are already collected or not wanted are not fetched
+    skip_sections = [section for section in SECTION_SOURCES if section in tor_data or section not in wanted]
+    metrics_device = getattr(METRICS_CONTEXT,'hostname',None)
+
+    def fetch(fetch_group):
+        set_metrics_device(metrics_device)
+        rpc_timeout = sources_timeout(session,fetch_group)
+        if pruned:
+            return fetch_pruned_sections(session,batch,batch_size,fetch_group,None,skip_sections,rpc_timeout)
+        fetched_data = fetch_collection_paths(session,[COLLECTION_PATHS[source] for source in fetch_group],batch,batch_size,rpc_timeout)
+        return {source : fetched_data.pop(COLLECTION_PATHS[source]) for source in fetch_group}
+
+    def extract(fetch_group,parsed_data):
+        for source in fetch_group:
+            source_sections = [section for section in wanted if SECTION_SOURCES[section] == source and section not in tor_data]
+            release = select_release(tor_data['version'][hostname] if 'version' in tor_data else None)
+            logging.debug('Extracting ' + ', '.join(source_sections) + ' with the ' + release + ' specs')
+            with measure('stages','extract ' + source) as counters:
+                #The raw data for this path is released as soon as it is extracted
+                extracted = extract_sections(parsed_data.pop(source),hostname,{section : EXTRACTION_SPECS[release][section] for section in source_sections})
+                counters['entries'] = sum(count_entries(extracted[section],'group' in EXTRACTION_SPECS[release][section]) for section in source_sections)
+            for section in source_sections:
+                tor_data[section] = extracted[section]
+                if checkpoint_dir:
+                    save_checkpoint(checkpoint_dir,section,tor_data[section])
+
+    #Version is first in SECTION_SOURCES, and is extracted before the rest so the specs of the TOR's release are known
+    if fetch_workers <= 1 or len(fetch_groups) <= 1:
+        for fetch_group in fetch_groups:
+            extract(fetch_group,fetch(fetch_group))
+        return tor_data
+    if fetch_groups[0] == ['version']:
+        extract(fetch_groups[0],fetch(fetch_groups[0]))
+        fetch_groups = fetch_groups[1:]
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=fetch_workers,thread_name_prefix='fetch-'+hostname) as executor:
+        futures = {executor.submit(fetch,fetch_group) : fetch_group for fetch_group in fetch_groups}
+        #Sections are extracted (and checkpointed) as their paths come back, a failed path does not stop the others
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                parsed_data = future.result()
+            except Exception as ex:
+                logging.debug('Fetching ' + ', '.join(futures[future]) + ' failed: ' + str(ex))
+                errors.append(ex)
+                continue
+            extract(futures[future],parsed_data)
+    if errors:
+        raise errors[0]
+    return tor_data
+
+#Sections the -tiered quick check compares by their aggregates before fetching them in full
+TIERED_SECTIONS = ['bgp','interface','mac','arp']
+
+def section_aggregates(section,data,hostname):
+    #Totals a section is compared by in the quick check: received routes per address family and established peers for
+    #bgp, up interfaces, and the entry count of every mac-vrf and arp subinterface
+    if section == 'bgp':
+        aggregates = {'established_peers' : 0}
+        for status in data[hostname].values():
+            aggregates['established_peers'] += status.get('session-state') == 'established'
+            for item, value in status.items():
+                if item != 'session-state':
+                    aggregates[item] = aggregates.get(item,0) + int(value or 0)
+        return aggregates
+    if section == 'interface':
+        return {'up_interfaces' : sum(status['port_oper_state'] == 'up' for status in data[hostname].values())}
+    return {group : len(entries) for group, entries in keyed_table(data[hostname]).items() if entries}
+
+def counter_aggregates(counts,hostname,grouped=False):
+    #Same shape as section_aggregates from the mac-count/arp-count counters. Counters are uint64, which json_ietf sends as strings
+    if grouped:
+        counts = {key : value for group in counts[hostname].values() for key, value in group.items()}
+    else:
+        counts = counts[hostname]
+    return {key : int(value) for key, value in counts.items() if value and int(value)}
+
+@instrumented('quick_check')
+def quick_check(session,hostname,options):
+    #Fetch the version, bgp and the mac, arp and interface counters in one get and compare them to the same totals of the
+    #saved pre check. Returns the sections it collected and a report listing the TIERED_SECTIONS whose totals match, which
+    #are neither fetched in full nor diffed. A TOR that rejects the statistics paths, does not answer them in time (retries
+    #and timeouts included) or leaves the counters out, gets those sections (or all of them) collected in full
     try:
-        for tunnel in tunnel_data_raw['vtep']:
-            tor_tunnel_information[hostname].append(tunnel['address'])
-    except: 
-        print ('Appear to be running on a spine or leaf with no VTEPs. If not expected, examine node and script. Continuing.. ')
-    return tor_tunnel_information
-def save_data(tor_bgp_status,tor_version,tor_application_status,network_instance_status,interface_status,fan_status,power_supply_status,control_status,linecard_status,arp_status,mac_information_status,tunnel_status,port_status,tor_access_ports_for_shutdown,hostname,before_or_after_flag):
-
-    if before_or_after_flag == 'precheck':
+        raw_data = fetch_pruned_sections(session,True,options['batch_size'],['version','bgp'] + list(AGGREGATE_COLLECTION_PATHS),AGGREGATE_COLLECTION_PATHS)
+    except (gNMIException,TimeoutError,grpc.FutureTimeoutError,grpc.RpcError) as ex:
+        print ('\033[1;33m Quick check: could not get the statistics (' + str(ex) + '), collecting every section in full \033[0;0m')
+        return {}, {'skipped' : [], 'aggregates' : {}, 'error' : str(ex)}
+    version = extract_section('version',raw_data['version'],hostname)
+    specs = EXTRACTION_SPECS[select_release(version[hostname])]
+    tor_data = {'version' : version, 'bgp' : extract_sections(raw_data['bgp'],hostname,{'bgp' : specs['bgp']})['bgp']}
+    mac_counts = extract_sections(raw_data['mac'],hostname,{'mac-count' : specs['mac-count']})['mac-count']
+    arp_counts = extract_sections(raw_data['arp'],hostname,{'arp-count' : specs['arp-count']})['arp-count']
+    after = {
+        'bgp' : section_aggregates('bgp',tor_data['bgp'],hostname),
+        'interface' : section_aggregates('interface',extract_sections(raw_data['interface'],hostname,{'interface' : specs['interface']})['interface'],hostname),
+        'mac' : counter_aggregates(mac_counts,hostname),
+        'arp' : counter_aggregates(arp_counts,hostname,True),
+    }
+    #A mac-vrf that has not learnt anything yet has no bridge-table and subinterfaces without ipv4 have no arp count, so
+    #a section is only taken as missing when none of its groups has a count. A group that lost its count while it had
+    #entries in the pre check no longer matches the totals and gets its section collected anyway
+    mac_values = list(mac_counts[hostname].values())
+    arp_values = [value for group in arp_counts[hostname].values() for value in group.values()]
+    missing = {'mac' : bool(mac_values) and all(value is None for value in mac_values), 'arp' : bool(arp_values) and all(value is None for value in arp_values)}
+    saved = saved_sections(hostname,'before')
+    report = {'skipped' : [], 'aggregates' : {}}
+    for section in TIERED_SECTIONS:
         try:
-            os.mkdir(hostname+'-before')
-            print ('making directory')
-        except: print ('folder exists, continuning')
-        with open(hostname+'-before'+'/'+hostname+'-version'+'.json', "w") as outfile:
-            json.dump(tor_version, outfile)
-        print ('writing version data')
-        with open(hostname+'-before'+'/'+hostname+'-bgp-summary'+'.json', "w") as outfile:
-            json.dump(tor_bgp_status, outfile)
-        print ('writing bgp data')
-        with open(hostname+'-before'+'/'+hostname+'-app-summary'+'.json', "w") as outfile:
-            json.dump(tor_application_status, outfile)
-        print ('writing app data')
-        with open(hostname+'-before'+'/'+hostname+'-network-instance-summary'+'.json', "w") as outfile:
-            json.dump(network_instance_status, outfile)
-        print ('writing network instance data')
-        with open(hostname+'-before'+'/'+hostname+'-interface-summary'+'.json', "w") as outfile:
-            json.dump(interface_status, outfile)
-        print ('writing interface summary data')
-        with open(hostname+'-before'+'/'+hostname+'-fan-summary'+'.json', "w") as outfile:
-            json.dump(fan_status, outfile)
-        print ('writing fan data')
-        with open(hostname+'-before'+'/'+hostname+'-power-summary'+'.json', "w") as outfile:
-            json.dump(power_supply_status, outfile)
-        print ('writing power data')
-        with open(hostname+'-before'+'/'+hostname+'-control-summary'+'.json', "w") as outfile:
-            json.dump(control_status, outfile)
-        print ('writing control data')
-        with open(hostname+'-before'+'/'+hostname+'-linecard-summary'+'.json', "w") as outfile:
-            json.dump(linecard_status, outfile)
-        print ('writing linecard data')
-        with open(hostname+'-before'+'/'+hostname+'-arp-summary'+'.json', "w") as outfile:
-            json.dump(arp_status, outfile)
-        print ('writing arp data')
-        with open(hostname+'-before'+'/'+hostname+'-mac-summary'+'.json', "w") as outfile:
-            json.dump(mac_information_status, outfile)
-        print ('writing mac address data')
-        with open(hostname+'-before'+'/'+hostname+'-tunnel-summary'+'.json', "w") as outfile:
-            json.dump(tunnel_status, outfile)
-        print ('writing tunnel data')
-        with open(hostname+'-before'+'/'+hostname+'-port-summary'+'.json', "w") as outfile:
-            json.dump(port_status, outfile)
-        print ('writing port data')
-        with open(hostname+'-before'+'/'+hostname+'-port-shutdown-summary'+'.json', "w") as outfile:
-            json.dump(tor_access_ports_for_shutdown, outfile)
-        print ('writing ports for shutdown')
-    if before_or_after_flag == 'postcheck':
+            before = section_aggregates(section,load_section(hostname,'before',section),hostname) if section in saved else None
+        except (OSError,KeyError,ValueError):
+            before = None
+        report['aggregates'][section] = {'before' : before, 'after' : None if missing.get(section) else after[section]}
+        if missing.get(section):
+            print ('\033[1;33m Quick check: the TOR did not return the ' + section + ' statistics, collecting it in full \033[0;0m')
+        elif before == after[section]:
+            report['skipped'].append(section)
+            print ('\033[1;32m Quick check: ' + section + ' totals match the pre check (' + aggregate_summary(before) + '), skipping its full collection and diff \033[0;0m')
+        else:
+            print ('\033[1;33m Quick check: ' + section + ' totals differ from the pre check (' + aggregate_summary(after[section]) + ' after, ' + aggregate_summary(before) + ' before), collecting it in full \033[0;0m')
+    #bgp came back in full with its totals, it is only left out of the diff
+    if 'bgp' in report['skipped']:
+        del tor_data['bgp']
+    return tor_data, report
+
+def aggregate_summary(aggregates):
+    if aggregates is None:
+        return 'not saved'
+    if all(type(value) is int for value in aggregates.values()) and not set(aggregates) & {'established_peers','up_interfaces'}:
+        return str(sum(aggregates.values())) + ' entries in ' + str(len(aggregates)) + ' groups'
+    return ', '.join(item_label(item) + ' ' + str(value) for item, value in aggregates.items())
+
+def skipped_sections(tor_data,hostname):
+    return tor_data.get('quick-check',{}).get(hostname,{}).get('skipped',[])
+
+def saved_sections(hostname,phase):
+    #Sections saved for before or after, from the snapshot header or the json files
+    snapshot_file = snapshot_file_name(hostname,phase)
+    if os.path.exists(snapshot_file):
+        with open(snapshot_file, "rb") as infile:
+            return set(read_snapshot_header(infile,snapshot_file)['sections'])
+    return set(section for section in SAVED_SECTIONS if os.path.exists(hostname+'-'+phase+'/'+hostname+SAVED_SECTIONS[section][0]+'.json'))
+
+def saved_skipped_sections(hostname):
+    #Sections the saved post check left out with -tiered, for compares run without its tor_data (a restarted daemon).
+    #A post check that was not tiered saves no quick check
+    if 'quick-check' not in saved_sections(hostname,'after'):
+        return []
+    return skipped_sections({'quick-check' : load_section(hostname,'after','quick-check')},hostname)
+
+def collect_and_check(session,hostname,before_or_after_flag,options):
+    #Collection, flap check and (for the pre check) the list of ports to shut, checkpointed section by section.
+    #With options['resume'] set, sections checkpointed by an earlier run within resume_max_age seconds are reused
+    #With options['run_deadline'] every gnmi call of the collection, retries included, has to finish within that many
+    #seconds of the start
+    with run_deadline(session,options.get('run_deadline',DEFAULT_RUN_DEADLINE)):
+        checkpoint_dir = None
+        tor_data = {}
+        if before_or_after_flag:
+            checkpoint_dir = checkpoint_dir_name(hostname,phase_name(before_or_after_flag))
+            if options.get('resume'):
+                tor_data = load_checkpoint(checkpoint_dir,options.get('resume_max_age',3600))
+                if tor_data:
+                    print ('Resuming ' + hostname + ', reusing checkpointed sections: ' + ', '.join(tor_data))
+        #With options['tiered'] the post check compares totals first and only collects the sections that changed, with
+        #pruned queries so the tables of the unchanged sections are not fetched
+        tiered = before_or_after_flag == 'postcheck' and options.get('tiered')
+        if tiered and 'quick-check' not in tor_data:
+            with measure('phases','quick_check'):
+                quick_data, report = quick_check(session,hostname,options)
+            tor_data.update(quick_data)
+            tor_data['quick-check'] = {hostname : report}
+            save_checkpoint(checkpoint_dir,'quick-check',tor_data['quick-check'])
+        with measure('phases','collect'):
+            sections = [section for section in SECTION_SOURCES if section not in skipped_sections(tor_data,hostname)]
+            tor_data = collect_tor_data(session,hostname,options['batch'],options['batch_size'],options['pruned'] or tiered,tor_data,checkpoint_dir,sections,options.get('fetch_workers',1))
+        #Check for any bouncing ports
+        if 'port' not in tor_data:
+            logging.debug('Checking for bouncing ports')
+            with measure('phases','flap_check'):
+                tor_data['port'] = check_bouncing_ports(session,hostname,options['flap_window'],options['flap_sample_interval'])
+            if checkpoint_dir:
+                save_checkpoint(checkpoint_dir,'port',tor_data['port'])
+        #Generate list of ports we will shutdown through GNMI to prepare for upgrade
+        if before_or_after_flag == 'precheck' and 'port-shutdown' not in tor_data:
+            with measure('phases','port_shutdown_list'):
+                tor_data['port-shutdown'] = generate_port_shutdown(tor_data['interface'],session,hostname,options.get('port_policy'))
+            save_checkpoint(checkpoint_dir,'port-shutdown',tor_data['port-shutdown'])
+        return tor_data
+
+#Every saved section, the suffix of its json file and the name printed when it is written. port-shutdown is only saved
+#for the pre check
+SAVED_SECTIONS = {
+    'version' : ('-version', 'version data'),
+    'bgp' : ('-bgp-summary', 'bgp data'),
+    'app' : ('-app-summary', 'app data'),
+    'network-instance' : ('-network-instance-summary', 'network instance data'),
+    'interface' : ('-interface-summary', 'interface summary data'),
+    'fan' : ('-fan-summary', 'fan data'),
+    'power' : ('-power-summary', 'power data'),
+    'control' : ('-control-summary', 'control data'),
+    'linecard' : ('-linecard-summary', 'linecard data'),
+    'arp' : ('-arp-summary', 'arp data'),
+    'mac' : ('-mac-summary', 'mac address data'),
+    'tunnel' : ('-tunnel-summary', 'tunnel data'),
+    'port' : ('-port-summary', 'port data'),
+    'port-shutdown' : ('-port-shutdown-summary', 'ports for shutdown'),
+    'quick-check' : ('-quick-check', 'quick check data'),
+}
+
+SNAPSHOT_FORMAT = 'srl-upgrade-snapshot'
+#Version 2 stores the sections in DIGEST_SUBTREE_SECTIONS one blob per child
+SNAPSHOT_VERSION = 2
+
+#Sections digested per child (bgp peer, interface, arp subinterface, mac-vrf) as well as as a whole, so the compare only
+#loads and diffs the children whose digest changed
+DIGEST_SUBTREE_SECTIONS = ['bgp','interface','arp','mac']
+
+def phase_name(before_or_after_flag):
+    return 'before' if before_or_after_flag == 'precheck' else 'after'
+
+def snapshot_file_name(hostname,phase):
+    return hostname+'-'+phase+'.srlsnap'
+
+@instrumented('save_data')
+def save_data(tor_data,hostname,before_or_after_flag,save_format='json',snapshot_encoding='json',history_db=None):
+    #tor_data holds every section in SAVED_SECTIONS. json writes one file per section into <hostname>-before/-after,
+    #snapshot writes one <hostname>-before/-after.srlsnap file. The digests of every section are saved with them. With
+    #history_db the run is also added to that sqlite history, which keeps every run instead of the latest one. The history
+    #is written after the files and a failure to write it only warns, the files are what the compare and drain rely on
+    phase = phase_name(before_or_after_flag)
+    sections = {section : tor_data[section] for section in SAVED_SECTIONS if section in tor_data}
+    if before_or_after_flag != 'precheck':
+        sections.pop('port-shutdown',None)
+    digests = section_digests(sections,hostname)
+    #The loaders prefer a snapshot over the json folder, so the data saved in the other format by an earlier run is
+    #removed or the compare would read it instead of this check
+    if save_format == 'snapshot':
+        write_snapshot(snapshot_file_name(hostname,phase),sections,hostname,phase,None,snapshot_encoding,digests)
+        print ('writing snapshot ' + snapshot_file_name(hostname,phase))
+        if os.path.isdir(hostname+'-'+phase):
+            shutil.rmtree(hostname+'-'+phase)
+            print ('removing the json files of an earlier check in ' + hostname+'-'+phase)
+    else:
+        if os.path.exists(snapshot_file_name(hostname,phase)):
+            os.remove(snapshot_file_name(hostname,phase))
+            print ('removing the snapshot of an earlier check ' + snapshot_file_name(hostname,phase))
         try:
-            os.mkdir(hostname+'-after')
+            os.mkdir(hostname+'-'+phase)
             print ('making directory')
         except: print ('folder exists, continuning')
-        with open(hostname+'-after'+'/'+hostname+'-version'+'.json', "w") as outfile:
-            json.dump(tor_version, outfile)
-        print ('writing version data')
-        with open(hostname+'-after'+'/'+hostname+'-bgp-summary'+'.json', "w") as outfile:
-            json.dump(tor_bgp_status, outfile)
-        print ('writing bgp data')
-        with open(hostname+'-after'+'/'+hostname+'-app-summary'+'.json', "w") as outfile:
-            json.dump(tor_application_status, outfile)
-        print ('writing app data')
-        with open(hostname+'-after'+'/'+hostname+'-network-instance-summary'+'.json', "w") as outfile:
-            json.dump(network_instance_status, outfile)
-        print ('writing network instance data')
-        with open(hostname+'-after'+'/'+hostname+'-interface-summary'+'.json', "w") as outfile:
-            json.dump(interface_status, outfile)
-        print ('writing interface summary data')
-        with open(hostname+'-after'+'/'+hostname+'-fan-summary'+'.json', "w") as outfile:
-            json.dump(fan_status, outfile)
-        print ('writing fan data')
-        with open(hostname+'-after'+'/'+hostname+'-power-summary'+'.json', "w") as outfile:
-            json.dump(power_supply_status, outfile)
-        print ('writing power data')
-        with open(hostname+'-after'+'/'+hostname+'-control-summary'+'.json', "w") as outfile:
-            json.dump(control_status, outfile)
-        print ('writing control data')
-        with open(hostname+'-after'+'/'+hostname+'-linecard-summary'+'.json', "w") as outfile:
-            json.dump(linecard_status, outfile)
-        print ('writing linecard data')
-        with open(hostname+'-after'+'/'+hostname+'-arp-summary'+'.json', "w") as outfile:
-            json.dump(arp_status, outfile)
-        print ('writing arp data')
-        with open(hostname+'-after'+'/'+hostname+'-mac-summary'+'.json', "w") as outfile:
-            json.dump(mac_information_status, outfile)
-        print ('writing mac address data')
-        with open(hostname+'-after'+'/'+hostname+'-tunnel-summary'+'.json', "w") as outfile:
-            json.dump(tunnel_status, outfile)
-        print ('writing tunnel data')
-        with open(hostname+'-after'+'/'+hostname+'-port-summary'+'.json', "w") as outfile:
-            json.dump(port_status, outfile)
-        print ('writing port data')
-        
-def compare_data(hostname):
-    before_version_file = open(hostname+'-before'+'/'+hostname+'-version'+'.json')
-    before_version = json.load(before_version_file)
-    after_version_file = open(hostname+'-after'+'/'+hostname+'-version'+'.json')
-    after_version = json.load(after_version_file)
-    
-    version_diff = DeepDiff(before_version,after_version)
-    version_diff_dict = version_diff.to_dict()
+        for section in sections:
+            file_suffix, description = SAVED_SECTIONS[section]
+            with open(hostname+'-'+phase+'/'+hostname+file_suffix+'.json', "w") as outfile:
+                json.dump(sections[section], outfile)
+            print ('writing ' + description)
+        #Files of sections this check did not collect (left out by the tiered quick check) are from an older check, a
+        #later compare must not read them as current
+        for section in SAVED_SECTIONS:
+            if section not in sections and os.path.exists(hostname+'-'+phase+'/'+hostname+SAVED_SECTIONS[section][0]+'.json'):
+                os.remove(hostname+'-'+phase+'/'+hostname+SAVED_SECTIONS[section][0]+'.json')
+        with open(hostname+'-'+phase+'/'+hostname+'-digests.json', "w") as outfile:
+            json.dump(digests, outfile)
+        print ('writing section digests')
+    if history_db:
+        try:
+            run_id = write_history(history_db,sections,hostname,phase,digests)
+            print ('writing history run ' + str(run_id) + ' to ' + history_db)
+        except (sqlite3.Error,OSError) as ex:
+            print ('\033[1;33m Could not add the ' + phase + ' check of ' + hostname + ' to ' + history_db + ', the saved files are not affected: ' + str(ex) + '\033[0;0m')
+
+#Sections the sqlite history keeps as one row per entry, the rest are kept as json in run_sections. group is the column
+#of the service or subinterface the entries are grouped by, values maps columns to the fields of each entry (a single
+#column for sections saved as {key : value})
+HISTORY_TABLES = {
+    'bgp' : {'table' : 'bgp_peers', 'group' : None, 'key' : 'peer', 'values' : {
+        'session_state' : 'session-state',
+        'evpn_received_routes' : 'address_family_evpn_received_routes',
+        'ipv4_received_routes' : 'address_family_ipv4_received_routes',
+        'ipv6_received_routes' : 'address_family_ipv6_received_routes'}},
+    'mac' : {'table' : 'macs', 'group' : 'mac_vrf', 'key' : 'mac', 'values' : {'destination' : None}},
+    'arp' : {'table' : 'arp_entries', 'group' : 'subinterface', 'key' : 'ip', 'values' : {'mac' : None}},
+    'interface' : {'table' : 'interfaces', 'group' : None, 'key' : 'interface', 'values' : {
+        'oper_state' : 'port_oper_state',
+        'description' : 'port_description'}},
+    'app' : {'table' : 'apps', 'group' : None, 'key' : 'app', 'values' : {'state' : None}},
+}
+
+def history_key_columns(spec):
+    return ([spec['group']] if spec['group'] else []) + [spec['key']]
+
+def history_schema():
+    #Every table is keyed by run and entry, and indexed by entry across runs for fleet wide lookups
+    statements = [
+        'CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, hostname TEXT NOT NULL, phase TEXT NOT NULL, created TEXT NOT NULL, version TEXT)',
+        'CREATE INDEX IF NOT EXISTS runs_by_host ON runs (hostname, run_id)',
+        'CREATE TABLE IF NOT EXISTS run_sections (run_id INTEGER NOT NULL, section TEXT NOT NULL, digest TEXT, data TEXT, PRIMARY KEY (run_id, section)) WITHOUT ROWID',
+    ]
+    for spec in HISTORY_TABLES.values():
+        key_columns = history_key_columns(spec)
+        columns = ['run_id INTEGER NOT NULL'] + [column + ' TEXT NOT NULL COLLATE NOCASE' for column in key_columns] + [column for column in spec['values']]
+        statements.append('CREATE TABLE IF NOT EXISTS ' + spec['table'] + ' (' + ', '.join(columns) + ', PRIMARY KEY (run_id, ' + ', '.join(key_columns) + ')) WITHOUT ROWID')
+        statements.append('CREATE INDEX IF NOT EXISTS ' + spec['table'] + '_by_' + spec['key'] + ' ON ' + spec['table'] + ' (' + spec['key'] + ', run_id)')
+    return statements
+
+def open_history(history_db):
+    #WAL so fleet workers saving at the same time only wait on each other's commits
+    connection = sqlite3.connect(history_db, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    for statement in history_schema():
+        connection.execute(statement)
+    return connection
+
+def history_rows(section,data,hostname):
+    #(group, key, values...) rows of a HISTORY_TABLES section, without the group for ungrouped sections
+    spec = HISTORY_TABLES[section]
+    table = keyed_table(data[hostname]) if spec['group'] else data[hostname]
+    entries = ((group, key, value) for group in table for key, value in table[group].items()) if spec['group'] else ((key, value) for key, value in table.items())
+    for entry in entries:
+        value = entry[-1]
+        if type(value) is dict:
+            values = tuple(value.get(field) for field in spec['values'].values())
+        else:
+            values = (value,)
+        yield entry[:-1] + values
 
-    if version_diff_dict:
-        print(""" 
-    *********************
-    Version Status Difference
-    ********************""")
-        for difference in version_diff_dict:
-            print ('\033[1;31m Differences were found before and after for version status with type: ' + difference + '\033[0;0m')
-            for entry in version_diff_dict[difference]:
-                print (entry)
-                print (version_diff_dict[difference][entry])
+@instrumented('write_history')
+def write_history(history_db,sections,hostname,phase,digests):
+    #One transaction per run, entries inserted in bulk. Returns the run id
+    connection = open_history(history_db)
+    try:
+        with connection:
+            version = sections.get('version',{}).get(hostname)
+            run_id = connection.execute('INSERT INTO runs (hostname, phase, created, version) VALUES (?, ?, ?, ?)',
+                                        (hostname, phase, datetime.now().isoformat(), version)).lastrowid
+            for section, data in sections.items():
+                if section in HISTORY_TABLES:
+                    spec = HISTORY_TABLES[section]
+                    columns = 1 + len(history_key_columns(spec)) + len(spec['values'])
+                    connection.executemany('INSERT INTO ' + spec['table'] + ' VALUES (' + ', '.join(['?'] * columns) + ')',
+                                           ((run_id,) + row for row in history_rows(section,data,hostname)))
+                    data = None
+                connection.execute('INSERT INTO run_sections VALUES (?, ?, ?, ?)',
+                                   (run_id, section, digests[section]['digest'], json.dumps(data) if data is not None else None))
+    finally:
+        connection.close()
+    return run_id
+
+def canonical_digest(data):
+    #Same digest for the same data whether it was just collected or loaded back from json or msgpack
+    return hashlib.sha256(json.dumps(stringify_keys(data), sort_keys=True, separators=(',',':'), default=str).encode()).hexdigest()
+
+def subtree_children(section,data,hostname):
+    #{child : data} of a DIGEST_SUBTREE_SECTIONS section, None if it is not saved as {hostname : {child : data}}
+    if section not in DIGEST_SUBTREE_SECTIONS or type(data) is not dict or list(data) != [hostname] or type(data[hostname]) is not dict:
+        return None
+    return data[hostname]
+
+@instrumented('section_digests')
+def section_digests(sections,hostname):
+    #Digest of every section, and of every child of the DIGEST_SUBTREE_SECTIONS. A section's digest is then the digest
+    #of its children's digests, like a merkle tree
+    digests = {}
+    for section, data in sections.items():
+        children = subtree_children(section,data,hostname)
+        if children is None:
+            digests[section] = {'digest' : canonical_digest(data)}
+            continue
+        child_digests = {str(child) : canonical_digest(value) for child, value in children.items()}
+        digests[section] = {'digest' : canonical_digest(child_digests), 'children' : child_digests}
+    return digests
+def stringify_keys(data):
+    #json turns every dict key into a string, do the same for msgpack so both formats load the same data
+    if type(data) is dict:
+        return {str(key) : stringify_keys(value) for key, value in data.items()}
+    if type(data) is list:
+        return [stringify_keys(value) for value in data]
+    return data
+
+def encode_snapshot_section(data,codec,encoding):
+    if encoding == 'msgpack':
+        payload = msgpack.packb(stringify_keys(data))
     else:
-        print ('\033[1;32m No difference was found with software version \033[0;0m')
-
-
-    before_bgp_status_file = open(hostname+'-before'+'/'+hostname+'-bgp-summary'+'.json')
-    before_bgp_status = json.load(before_bgp_status_file)
-    after_bgp_status_file = open(hostname+'-after'+'/'+hostname+'-bgp-summary'+'.json')
-    after_bgp_status = json.load(after_bgp_status_file)
-    bgp_status_diff = DeepDiff(before_bgp_status,after_bgp_status)
-    bgp_status_diff_dict = bgp_status_diff.to_dict()
-    if bgp_status_diff_dict:
-        print(""" 
-            *********************
-            BGP Status Difference
-            ********************""")
-        for difference in bgp_status_diff_dict:
-            print ('\033[1;31m Differences were found before and after for bgp status with type: ' + difference + '\033[0;0m')
-            for entry in bgp_status_diff_dict[difference]:
-                print (entry)
-                try:
-                    print (bgp_status_diff_dict[difference][entry])
-                except: continue
-    else: print ('\033[1;32m No differences were found with BGP peer status \033[0;0m')
-    #App status
-    before_app_status_file = open(hostname+'-before'+'/'+hostname+'-app-summary'+'.json')
-    before_app_status = json.load(before_app_status_file)
-    after_app_status_file = open(hostname+'-after'+'/'+hostname+'-app-summary'+'.json')
-    after_app_status = json.load(after_app_status_file)
-    app_status_diff = DeepDiff(before_app_status,after_app_status)
-    app_status_diff_dict = app_status_diff.to_dict()
-
-    if app_status_diff_dict:
-        print(""" 
-    *********************
-    App Status Difference
-    ********************""")
-        for difference in app_status_diff_dict:
-            if difference == 'dictionary_item_added':
-                for entry in app_status_diff_dict[difference]:
-                    print ("\033[1;31m New APP was found after upgrade \033[0;0m")
-                    print(entry)
-                    
-            if difference == 'values_changed':
-                for entry in app_status_diff_dict[difference]:
-                    print ("\033[1;31m Existing app status status changed after upgrade: \033[0;0m")
-                    print ('app name: ' + entry)
-                    print (app_status_diff_dict[difference][entry])
-                    
-            
-    else: print ('\033[1;32m No differences were found with app status \033[0;0m')
-    
+        payload = json.dumps(data, separators=(',',':')).encode()
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compress(payload)
+    return gzip.compress(payload)
+
+def decode_snapshot_section(payload,codec,encoding):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise SystemExit('Snapshot is zstd compressed but zstandard is not installed')
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    else:
+        payload = gzip.decompress(payload)
+    if encoding == 'msgpack':
+        if msgpack is None:
+            raise SystemExit('Snapshot is msgpack encoded but msgpack is not installed')
+        return msgpack.unpackb(payload)
+    return json.loads(payload)
+
+def write_snapshot(snapshot_file,sections,hostname,phase,codec=None,encoding='json',digests=None):
+    #One file per device per phase: a json header line (format version, codec, section digests, and an index of where each
+    #section is) followed by each section compressed on its own, so a reader can load just the sections it needs. The
+    #DIGEST_SUBTREE_SECTIONS are compressed one child at a time, indexed by children offsets from the section offset.
+    #zstd is used when zstandard is installed, gzip otherwise. msgpack encoding is optional
+    if codec is None:
+        codec = 'zstd' if zstandard is not None else 'gzip'
+    if encoding == 'msgpack' and msgpack is None:
+        print ('msgpack is not installed, writing snapshot sections as json')
+        encoding = 'json'
+    blobs = []
+    index = {}
+    offset = 0
+    for section in sections:
+        children = subtree_children(section,sections[section],hostname)
+        if children is not None:
+            index[section] = {'offset' : offset, 'length' : 0, 'hostname' : hostname, 'children' : {}}
+            for child, value in children.items():
+                blob = encode_snapshot_section(value,codec,encoding)
+                index[section]['children'][str(child)] = [index[section]['length'],len(blob)]
+                index[section]['length'] += len(blob)
+                blobs.append(blob)
+            offset += index[section]['length']
+            continue
+        blob = encode_snapshot_section(sections[section],codec,encoding)
+        index[section] = {'offset' : offset, 'length' : len(blob)}
+        offset += len(blob)
+        blobs.append(blob)
+    header = {'format' : SNAPSHOT_FORMAT, 'version' : SNAPSHOT_VERSION, 'hostname' : hostname, 'phase' : phase,
+              'created' : datetime.now().isoformat(), 'codec' : codec, 'encoding' : encoding, 'sections' : index, 'digests' : digests}
+    with open(snapshot_file, "wb") as outfile:
+        outfile.write(json.dumps(header).encode() + b'\n')
+        for blob in blobs:
+            outfile.write(blob)
+
+def read_snapshot_header(infile,snapshot_file):
+    #Leaves infile at the start of the section data, where the index offsets count from
+    header = json.loads(infile.readline())
+    if header.get('format') != SNAPSHOT_FORMAT or header.get('version',0) > SNAPSHOT_VERSION:
+        raise SystemExit(snapshot_file + ' is not a snapshot this version of the script can read')
+    return header
+
+def load_section(hostname,phase,section):
+    #Load one saved section for before or after, from the snapshot file if there is one or the json directory if not
+    snapshot_file = snapshot_file_name(hostname,phase)
+    if os.path.exists(snapshot_file):
+        with open(snapshot_file, "rb") as infile:
+            header = read_snapshot_header(infile,snapshot_file)
+            if section not in header['sections']:
+                raise SystemExit(section + ' is not saved in ' + snapshot_file)
+            entry = header['sections'][section]
+            infile.seek(entry['offset'],os.SEEK_CUR)
+            payload = infile.read(entry['length'])
+        if 'children' in entry:
+            return {entry['hostname'] : {child : decode_snapshot_section(payload[start:start+length],header['codec'],header['encoding'])
+                                         for child, (start, length) in entry['children'].items()}}
+        return decode_snapshot_section(payload,header['codec'],header['encoding'])
+    with open(hostname+'-'+phase+'/'+hostname+SAVED_SECTIONS[section][0]+'.json') as infile:
+        return json.load(infile)
+
+def load_section_children(hostname,phase,section,children):
+    #{child : data} for just the given children of a DIGEST_SUBTREE_SECTIONS section. A snapshot only reads and
+    #decompresses their blobs, the json file has to be loaded whole
+    snapshot_file = snapshot_file_name(hostname,phase)
+    if os.path.exists(snapshot_file):
+        with open(snapshot_file, "rb") as infile:
+            header = read_snapshot_header(infile,snapshot_file)
+            entry = header['sections'].get(section,{})
+            if 'children' in entry:
+                data_start = infile.tell()
+                loaded = {}
+                for child in children:
+                    if child not in entry['children']:
+                        continue
+                    start, length = entry['children'][child]
+                    infile.seek(data_start + entry['offset'] + start)
+                    loaded[child] = decode_snapshot_section(infile.read(length),header['codec'],header['encoding'])
+                return loaded
+    table = load_section(hostname,phase,section)[hostname]
+    return {child : table[child] for child in children if child in table}
+
+def load_digests(hostname,phase):
+    #Digests saved with the section data, None for data saved before digests were
+    snapshot_file = snapshot_file_name(hostname,phase)
+    try:
+        if os.path.exists(snapshot_file):
+            with open(snapshot_file, "rb") as infile:
+                return read_snapshot_header(infile,snapshot_file).get('digests')
+        with open(hostname+'-'+phase+'/'+hostname+'-digests.json') as infile:
+            return json.load(infile)
+    except (OSError,ValueError):
+        return None
+
+def load_section_pair(hostname,section):
+    #Before and after data of a section for its comparator. When both were saved with digests, a section whose digest
+    #did not change is loaded once (or not at all, for DIGEST_SUBTREE_SECTIONS) and only the children whose digests
+    #differ are loaded, so the diff costs as much as what changed rather than the size of the table
+    before_digests = load_digests(hostname,'before')
+    after_digests = load_digests(hostname,'after')
+    if not before_digests or not after_digests or section not in before_digests or section not in after_digests:
+        return load_section(hostname,'before',section), load_section(hostname,'after',section)
+    before_digest = before_digests[section]
+    after_digest = after_digests[section]
+    if 'children' not in before_digest or 'children' not in after_digest:
+        if before_digest['digest'] == after_digest['digest']:
+            data = load_section(hostname,'before',section)
+            return data, data
+        return load_section(hostname,'before',section), load_section(hostname,'after',section)
+    before_children = before_digest['children']
+    after_children = after_digest['children']
+    changed = [child for child in list(before_children) + [child for child in after_children if child not in before_children]
+               if before_children.get(child) != after_children.get(child)]
+    logging.debug(section + ': ' + str(len(changed)) + ' of ' + str(len(set(before_children) | set(after_children))) + ' children changed')
+    return ({hostname : load_section_children(hostname,'before',section,changed)},
+            {hostname : load_section_children(hostname,'after',section,changed)})
+
+def checkpoint_dir_name(hostname,phase):
+    return hostname+'-'+phase+'-checkpoint'
+
+def save_checkpoint(checkpoint_dir,section,data):
+    #Written to a temp file and renamed so a run killed mid write never leaves a half written section behind
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    checkpoint_file = checkpoint_dir+'/'+section+'.json'
+    with open(checkpoint_file+'.tmp', "w") as outfile:
+        json.dump({'collected' : time.time(), 'data' : data}, outfile)
+    os.replace(checkpoint_file+'.tmp',checkpoint_file)
+
+def load_checkpoint(checkpoint_dir,max_age):
+    #Returns the checkpointed sections that are not older than max_age seconds
+    tor_data = {}
+    if not os.path.isdir(checkpoint_dir):
+        return tor_data
+    for file_name in sorted(os.listdir(checkpoint_dir)):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(checkpoint_dir+'/'+file_name) as infile:
+                checkpoint = json.load(infile)
+        except ValueError:
+            continue
+        if time.time() - checkpoint['collected'] <= max_age:
+            tor_data[file_name[:-len('.json')]] = checkpoint['data']
+        else:
+            print ('Checkpointed ' + file_name[:-len('.json')] + ' data is stale, fetching it again')
+    return tor_data
+
+def clear_checkpoint(checkpoint_dir):
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+def keyed_table(table):
+    #MAC and ARP tables are saved as {service or subinterface: {mac or ip: value}}. Files saved by older versions of the
+    #script hold a list of single key dicts instead, fold those into the same mapping
+    keyed = {}
+    for group in table:
+        if type(table[group]) is list:
+            keyed[group] = {}
+            for entry in table[group]:
+                keyed[group].update(entry)
+        else:
+            keyed[group] = table[group]
+    return keyed
+
+#Groups with fewer entries than this are diffed as sets, packing them costs more than it saves
+PACKED_DIFF_MIN_ENTRIES = 1000
+
+#Value of every ascii hex digit, 255 for the other characters, and the columns of a mac string holding the digits
+HEX_NIBBLES = numpy.array([int(chr(character),16) if chr(character) in '0123456789abcdefABCDEF' else 255 for character in range(256)],dtype=numpy.uint8) if numpy is not None else None
+MAC_HEX_COLUMNS = [column for column in range(17) if column % 3 != 2]
+
+def pack_keys(keys,key_type):
+    #Sorted numpy column of the keys packed into integers (48 bit macs, 32 bit ipv4 addresses), the order that sorts
+    #them and the case of the mac hex digits (None if there are no letters). None if any key is not in the canonical
+    #format (macs in one case, dotted quads without shorthand or leading zeros), so every key packs to its own integer
+    #and the group is diffed as strings otherwise
+    letter_case = None
+    try:
+        if key_type == 'mac':
+            if set(map(len,keys)) != {17}:
+                return None
+            characters = numpy.frombuffer(''.join(keys).encode('ascii'),dtype=numpy.uint8).reshape(len(keys),17)
+            if (characters[:,2::3] != ord(':')).any():
+                return None
+            digits = characters[:,MAC_HEX_COLUMNS]
+            nibbles = HEX_NIBBLES[digits]
+            if (nibbles > 15).any():
+                return None
+            lower, upper = (digits >= ord('a')).any(), ((digits >= ord('A')) & (digits <= ord('F'))).any()
+            if lower and upper:
+                return None
+            letter_case = 'lower' if lower else 'upper' if upper else None
+            octets = numpy.zeros((len(keys),8),dtype=numpy.uint8)
+            octets[:,2:] = (nibbles[:,0::2] << 4) | nibbles[:,1::2]
+            packed = octets.view('>u8').ravel().astype(numpy.uint64)
+        elif key_type == 'ipv4':
+            #inet_pton, unlike inet_aton, rejects 10.1 and 010.1.1.1
+            packed = numpy.frombuffer(b''.join(map(functools.partial(socket.inet_pton,socket.AF_INET),keys)),dtype='>u4').astype(numpy.uint32)
+        else:
+            return None
+    except (OSError, UnicodeEncodeError):
+        return None
+    order = numpy.argsort(packed)
+    packed = packed[order]
+    return packed, order, letter_case
+
+def value_codes(before_values,after_values):
+    #Values interned into small integer codes shared by the before and after table, so moved entries are found by
+    #comparing codes
+    codes = {value : code for code, value in enumerate(set(before_values) | set(after_values))}
+    return [numpy.fromiter(map(codes.__getitem__,values),dtype=numpy.int64,count=len(values)) for values in (before_values,after_values)]
+
+def diff_packed_group(before_entries,after_entries,key_type):
+    #added, removed and moved entries of one group from sorted set operations on the packed keys, None if the keys or
+    #values cannot be packed
+    before_keys, after_keys = list(before_entries), list(after_entries)
+    before_packed, after_packed = pack_keys(before_keys,key_type), pack_keys(after_keys,key_type)
+    if before_packed is None or after_packed is None:
+        return None
+    #aa:.. before and AA:.. after would pack to the same integer while the string diff sees two keys
+    if None not in (before_packed[2],after_packed[2]) and before_packed[2] != after_packed[2]:
+        return None
+    try:
+        before_values, after_values = value_codes(list(before_entries.values()),list(after_entries.values()))
+    except TypeError:
+        return None
+    before_values, after_values = before_values[before_packed[1]], after_values[after_packed[1]]
+    (before_sorted, before_order, _), (after_sorted, after_order, _) = before_packed, after_packed
+    added_index = numpy.searchsorted(after_sorted,numpy.setdiff1d(after_sorted,before_sorted,assume_unique=True))
+    removed_index = numpy.searchsorted(before_sorted,numpy.setdiff1d(before_sorted,after_sorted,assume_unique=True))
+    _, before_common, after_common = numpy.intersect1d(before_sorted,after_sorted,assume_unique=True,return_indices=True)
+    changed = before_values[before_common] != after_values[after_common]
+    added = {key : after_entries[key] for key in (after_keys[index] for index in after_order[added_index])}
+    removed = {key : before_entries[key] for key in (before_keys[index] for index in before_order[removed_index])}
+    moved = {}
+    for before_index, after_index in zip(before_order[before_common[changed]],after_order[after_common[changed]]):
+        moved[before_keys[before_index]] = (before_entries[before_keys[before_index]],after_entries[after_keys[after_index]])
+    return added, removed, moved
+
+def diff_keyed_table(before_table,after_table,key_type=None):
+    #Set based diff of two keyed tables. Entries only before are removed, only after are added, and entries whose value
+    #changed (mac learnt on another destination, ip answering from another mac) are moved. Counts are kept per group.
+    #With key_type mac or ipv4 and numpy installed, large groups are diffed on packed integer keys instead of strings
+    table_diff = {'added' : {}, 'removed' : {}, 'moved' : {}, 'counts' : {}}
+    for group in sorted(set(before_table) | set(after_table)):
+        before_entries = before_table.get(group,{})
+        after_entries = after_table.get(group,{})
+        group_diff = None
+        if numpy is not None and key_type and min(len(before_entries),len(after_entries)) >= PACKED_DIFF_MIN_ENTRIES:
+            group_diff = diff_packed_group(before_entries,after_entries,key_type)
+        if group_diff is None:
+            added = {key : after_entries[key] for key in after_entries.keys() - before_entries.keys()}
+            removed = {key : before_entries[key] for key in before_entries.keys() - after_entries.keys()}
+            moved = {key : (before_entries[key],after_entries[key]) for key in before_entries.keys() & after_entries.keys() if before_entries[key] != after_entries[key]}
+        else:
+            added, removed, moved = group_diff
+        if added:
+            table_diff['added'][group] = added
+        if removed:
+            table_diff['removed'][group] = removed
+        if moved:
+            table_diff['moved'][group] = moved
+        if added or removed or moved:
+            table_diff['counts'][group] = {'added' : len(added), 'removed' : len(removed), 'moved' : len(moved)}
+    return table_diff
+
+#Entries shown per group of differences (a mac-vrf, a subinterface or a DeepDiff change type) on the console, the rest
+#are counted. -diff_limit changes it for every section or per section, 0 shows every entry
+DEFAULT_DIFF_LIMIT = 20
+
+def parse_diff_limits(diff_limit):
+    #"20" or "20,mac=200,arp=0" into {'default' : 20, 'mac' : 200, 'arp' : 0}
+    limits = {'default' : DEFAULT_DIFF_LIMIT}
+    for limit in (diff_limit or '').split(','):
+        if not limit.strip():
+            continue
+        section, _, count = limit.rpartition('=')
+        limits[section.strip() or 'default'] = int(count)
+    return limits
+
+def section_result(section,heading,same_message,style='tree',moved_label='moved'):
+    #What a comparator found in a section: one group per mac-vrf, subinterface or DeepDiff change type, each with the
+    #line describing it, its counts and its entries. style table entries are added/removed/moved keys, style tree
+    #entries are DeepDiff paths
+    return {'section' : section, 'heading' : heading, 'same_message' : same_message, 'style' : style, 'moved_label' : moved_label, 'groups' : []}
+
+def deepdiff_result(section,before,after,heading,same_message,label,messages=None):
+    #messages maps the DeepDiff change types reported to their line, other types are left out. Without messages every
+    #type is reported
+    #Imported on first use, runs that never compare (pre checks, the convergence watcher) skip loading it
+    from deepdiff import DeepDiff
+    result = section_result(section,heading,same_message)
+    diff_dict = DeepDiff(before,after).to_dict()
+    for difference in diff_dict:
+        if messages is not None and difference not in messages:
+            continue
+        changes = diff_dict[difference]
+        if hasattr(changes,'items'):
+            entries = [{'change' : difference, 'key' : str(path), 'value' : value} for path, value in changes.items()]
+        else:
+            entries = [{'change' : difference, 'key' : str(path)} for path in changes]
+        message = messages[difference] if messages else 'Differences were found before and after for ' + label + ' with type: ' + difference
+        result['groups'].append({'group' : difference, 'message' : message, 'counts' : {difference : len(entries)}, 'entries' : entries})
+    return result
+
+def keyed_table_result(section,table_diff,heading,same_message,group_label,entry_label,moved_label):
+    result = section_result(section,heading,same_message,'table',moved_label)
+    for group in table_diff['counts']:
+        counts = table_diff['counts'][group]
+        entries = [{'change' : 'removed', 'key' : key, 'value' : value} for key, value in sorted(table_diff['removed'].get(group,{}).items())]
+        entries += [{'change' : 'added', 'key' : key, 'value' : value} for key, value in sorted(table_diff['added'].get(group,{}).items())]
+        entries += [{'change' : 'moved', 'key' : key, 'before' : before_value, 'after' : after_value}
+                    for key, (before_value, after_value) in sorted(table_diff['moved'].get(group,{}).items())]
+        message = ('Differences were found before and after for ' + entry_label + ': ' + group_label + group + ' added ' + str(counts['added']) +
+                   ', removed ' + str(counts['removed']) + ', ' + moved_label + ' ' + str(counts['moved']))
+        result['groups'].append({'group' : group, 'message' : message, 'counts' : counts, 'entries' : entries})
+    return result
+
+def result_entry_count(result):
+    return sum(len(group['entries']) for group in result['groups'])
+
+def render_entry(result,entry,outfile=None):
+    if result['style'] == 'table':
+        if entry['change'] == 'moved':
+            print (result['moved_label'] + ': ' + entry['key'] + ' ' + str(entry['before']) + ' -> ' + str(entry['after']), file=outfile)
+        else:
+            print (entry['change'] + ': ' + entry['key'] + ' ' + str(entry['value']), file=outfile)
+    else:
+        print (entry['key'], file=outfile)
+        if 'value' in entry:
+            print (entry['value'], file=outfile)
+
+def render_section_result(result,limit=DEFAULT_DIFF_LIMIT,outfile=None):
+    #The colored console view of a section result, with at most limit entries per group
+    if not result['groups']:
+        print ('\033[1;32m ' + result['same_message'] + ' \033[0;0m', file=outfile)
+        return
     print (""" 
-    
-    """)
-    #Network Insance
-    before_network_instance_file = open(hostname+'-before'+'/'+hostname+'-network-instance-summary'+'.json')
-    before_network_instance_status = json.load(before_network_instance_file)
-    after_network_instance_file = open(hostname+'-after'+'/'+hostname+'-network-instance-summary'+'.json')
-    after_network_instance_status = json.load(after_network_instance_file)
-    network_instance_diff = DeepDiff(before_network_instance_status,after_network_instance_status)
-    network_instance_diff_dict = network_instance_diff.to_dict()
-
-    if network_instance_diff_dict:
-        print(""" 
     *********************
-    Network Instance Status Difference
-    ********************""")
-        for difference in network_instance_diff:
-            print ('\033[1;31m Differences were found before and after for network instances with type: ' + difference + '\033[0;0m')
-            for entry in network_instance_diff[difference]:
-                print (entry)
-                print (network_instance_diff[difference][entry])
-    else: print ('\033[1;32m No differences were found with network instance status \033[0;0m')
+    """ + result['heading'] + """
+    ********************""", file=outfile)
+    for group in result['groups']:
+        print ('\033[1;31m ' + group['message'] + '\033[0;0m', file=outfile)
+        entries = group['entries'][:limit] if limit else group['entries']
+        for entry in entries:
+            render_entry(result,entry,outfile)
+        if len(entries) < len(group['entries']):
+            print ('\033[1;33m ' + '{:,}'.format(len(group['entries'])) + ' entries in ' + group['group'] + ', first ' + str(len(entries)) + ' shown \033[0;0m', file=outfile)
+
+def compare_version(hostname):
+    before_version, after_version = load_section_pair(hostname,'version')
+    return deepdiff_result('version',before_version,after_version,'Version Status Difference','No difference was found with software version','version status')
+
+def compare_bgp(hostname):
+    before_bgp_status, after_bgp_status = load_section_pair(hostname,'bgp')
+    return deepdiff_result('bgp',before_bgp_status,after_bgp_status,'BGP Status Difference','No differences were found with BGP peer status','bgp status')
+
+def compare_app(hostname):
+    #App status, only new apps and apps whose state changed are reported
+    before_app_status, after_app_status = load_section_pair(hostname,'app')
+    return deepdiff_result('app',before_app_status,after_app_status,'App Status Difference','No differences were found with app status','app status',
+                           {'dictionary_item_added' : 'New APP was found after upgrade', 'values_changed' : 'Existing app status status changed after upgrade'})
+
+def compare_network_instance(hostname):
+    #Network Insance
+    before_network_instance_status, after_network_instance_status = load_section_pair(hostname,'network-instance')
+    return deepdiff_result('network-instance',before_network_instance_status,after_network_instance_status,'Network Instance Status Difference',
+                           'No differences were found with network instance status','network instances')
 
+def compare_interface(hostname):
     #Interface status
-    before_interface_status_file = open(hostname+'-before'+'/'+hostname+'-interface-summary'+'.json')
-    before_interface_status_status = json.load(before_interface_status_file)
-    after_interface_status_file = open(hostname+'-after'+'/'+hostname+'-interface-summary'+'.json')
-    after_interface_status_status = json.load(after_interface_status_file)
-    interface_summary_diff = DeepDiff(before_interface_status_status,after_interface_status_status)
-    interface_summary_diff_dict = interface_summary_diff.to_dict()
-
-    if interface_summary_diff_dict:
-        print(""" 
-    *********************
-    Interface Status Difference
-    ********************""")
-        for difference in interface_summary_diff_dict:
-            print ('\033[1;31m Differences were found before and after for network instances with type: ' + difference +'\033[0;0m')
-            for entry in interface_summary_diff_dict[difference]:
-                print (entry)
-                print (interface_summary_diff_dict[difference][entry])
-    else: print ('\033[1;32m No differences were found with port status \033[0;0m')
-    
+    before_interface_status_status, after_interface_status_status = load_section_pair(hostname,'interface')
+    return deepdiff_result('interface',before_interface_status_status,after_interface_status_status,'Interface Status Difference',
+                           'No differences were found with port status','interface status')
+
+def compare_fan(hostname):
     #Fan status
-    before_fan_status_file = open(hostname+'-before'+'/'+hostname+'-fan-summary'+'.json')
-    before_fan_status = json.load(before_fan_status_file)
-    after_fan_status_file = open(hostname+'-after'+'/'+hostname+'-fan-summary'+'.json')
-    after_fan_status = json.load(after_fan_status_file)
-    fan_summary_diff = DeepDiff(before_fan_status,after_fan_status)
-    fan_summary_diff_dict = fan_summary_diff.to_dict()
-
-    if fan_summary_diff_dict:
-        print(""" 
-    *********************
-    Fan Status Difference
-    ********************""")
-        for difference in fan_summary_diff_dict:
-            print ('\033[1;31m Differences were found before and after for network instances with type: ' + difference +'\033[0;0m') 
-            for entry in fan_summary_diff_dict[difference]:
-                print (entry)
-                print (fan_summary_diff_dict[difference][entry])
-    else: print ('\033[1;32m No differences were found with fan status \033[0;0m')
+    before_fan_status, after_fan_status = load_section_pair(hostname,'fan')
+    return deepdiff_result('fan',before_fan_status,after_fan_status,'Fan Status Difference','No differences were found with fan status','fan status')
 
+def compare_power(hostname):
     #Power status
-    before_power_status_file = open(hostname+'-before'+'/'+hostname+'-power-summary'+'.json')
-    before_power_status = json.load(before_power_status_file)
-    after_power_status_file = open(hostname+'-after'+'/'+hostname+'-power-summary'+'.json')
-    after_power_status = json.load(after_power_status_file)
-    power_summary_diff = DeepDiff(before_power_status,after_power_status)
-    power_summary_diff_dict = power_summary_diff.to_dict()
-
-    if power_summary_diff_dict:
-        print(""" 
-    *********************
-    Power Status Difference
-    ********************""")
-        for difference in power_summary_diff_dict:
-            print ('\033[1;31m Differences were found before and after for network instances with type: ' + difference +'\033[0;0m')
-            for entry in power_summary_diff_dict[difference]:
-                print (entry)
-                print (power_summary_diff_dict[difference][entry])
-    else: print ('\033[1;32m No differences were found with power status \033[0;0m')
-    #control status
-
-    before_control_status_file = open(hostname+'-before'+'/'+hostname+'-control-summary'+'.json')
-    before_control_status = json.load(before_control_status_file)
-    after_control_status_file = open(hostname+'-after'+'/'+hostname+'-control-summary'+'.json')
-    after_control_status = json.load(after_control_status_file)
-    control_summary_diff = DeepDiff(before_control_status,after_control_status)
-    control_summary_diff_dict = control_summary_diff.to_dict()
+    before_power_status, after_power_status = load_section_pair(hostname,'power')
+    return deepdiff_result('power',before_power_status,after_power_status,'Power Status Difference','No differences were found with power status','power status')
 
-    if control_summary_diff_dict:
-        print(""" 
-    *********************
-    Control Status Difference
-    ********************""")
-        for difference in control_summary_diff_dict:
-            print ('\033[1;31m Differences were found before and after for network instances with type: ' + difference + '\033[0;0m')
-            for entry in control_summary_diff_dict[difference]:
-                print (entry)
-                print (control_summary_diff_dict[difference][entry])
-    else: print ('\033[1;32m No differences were found with power status \033[0;0m')
+def compare_control(hostname):
+    #control status
+    before_control_status, after_control_status = load_section_pair(hostname,'control')
+    return deepdiff_result('control',before_control_status,after_control_status,'Control Status Difference','No differences were found with control status','control status')
 
+def compare_linecard(hostname):
     #linecard status
-    
-    before_linecard_status_file = open(hostname+'-before'+'/'+hostname+'-linecard-summary'+'.json')
-    before_linecard_status = json.load(before_linecard_status_file)
-    after_linecard_status_file = open(hostname+'-after'+'/'+hostname+'-linecard-summary'+'.json')
-    after_linecard_status = json.load(after_linecard_status_file)
-    linecard_summary_diff = DeepDiff(before_linecard_status,after_linecard_status)
-    linecard_summary_diff_dict = linecard_summary_diff.to_dict()
-
-    if linecard_summary_diff_dict:
-        print(""" 
-    *********************
-    Linecard Status Difference
-    ********************""")
-        for difference in linecard_summary_diff_dict:
-            print ('Differences were found before and after for network instances with type: ' + difference)
-            for entry in linecard_summary_diff_dict[difference]:
-                print (entry)
-                print (linecard_summary_diff_dict[difference][entry])
-    else: print ('\033[1;32m No differences were found with linecard status \033[0;0m')
+    before_linecard_status, after_linecard_status = load_section_pair(hostname,'linecard')
+    return deepdiff_result('linecard',before_linecard_status,after_linecard_status,'Linecard Status Difference','No differences were found with linecard status','linecard status')
 
+def compare_arp(hostname):
     #Arp status
-    before_arp_status_file = open(hostname+'-before'+'/'+hostname+'-arp-summary'+'.json')
-    before_arp_status = json.load(before_arp_status_file)
-    after_arp_status_file = open(hostname+'-after'+'/'+hostname+'-arp-summary'+'.json')
-    after_arp_status = json.load(after_arp_status_file)
-    
-    arp_summary_diff = DeepDiff(before_arp_status,after_arp_status)
-
-    arp_summary_diff_dict = arp_summary_diff.to_dict()
-    if arp_summary_diff_dict:
-        #print (arp_summary_diff_dict)
-        print(""" 
-    *********************
-    Arp Status Difference
-    ********************""")
-        for difference in arp_summary_diff_dict:
-            print ('\033[1;31m Differences were found before and after for dynamic ARP entries: ' + difference + '\033[0;0m')
-            for entry in arp_summary_diff_dict[difference]:
-                print ('Interface name: ' + entry)
-                try:
-                    print (arp_summary_diff_dict[difference][entry])
-                except: continue
-        
-    else: print ('\033[1;32m No differences were found with dynamic arp entries \033[0;0m')
+    before_arp_data, after_arp_data = load_section_pair(hostname,'arp')
+    before_arp_status = keyed_table(before_arp_data[hostname])
+    after_arp_status = keyed_table(after_arp_data[hostname])
+    arp_summary_diff = diff_keyed_table(before_arp_status,after_arp_status,'ipv4')
+    return keyed_table_result('arp',arp_summary_diff,'Arp Status Difference','No differences were found with dynamic arp entries','Interface name: ','dynamic ARP entries','mac changed')
 
+def compare_mac(hostname):
     #mac status
-    before_mac_status_file = open(hostname+'-before'+'/'+hostname+'-mac-summary'+'.json')
-    before_mac_status = json.load(before_mac_status_file)
-    after_mac_status_file = open(hostname+'-after'+'/'+hostname+'-mac-summary'+'.json')
-    after_mac_status = json.load(after_mac_status_file)
-    mac_summary_diff = DeepDiff(before_mac_status,after_mac_status, ignore_order=True)
-    mac_summary_diff_dict = mac_summary_diff.to_dict()
-    #json_diff = diff(before_mac_status,after_app_status)
-    #print (json_diff)
-    if mac_summary_diff_dict:
-        print(""" 
-    *********************
-    Mac Status Difference
-    ********************""")
-        for difference in mac_summary_diff_dict:
-            print ('\033[1;31m Differences were found before and after for dynamic mac entries: ' + difference + '\033[0;0m')
-            for entry in mac_summary_diff_dict[difference]:
-                #print (mac_summary_diff_dict)
-                print ('network status name: ' + entry)
-                try:
-                    print (mac_summary_diff_dict[difference][entry])
-                except: continue
-    else: print ('\033[1;32m No differences were found with dynamic mac entries \033[0;0m')
-    #Tunnel status 
-    before_tunnel_status_file = open(hostname+'-before'+'/'+hostname+'-tunnel-summary'+'.json')
-    before_tunnel_status = json.load(before_tunnel_status_file)
-    after_tunnel_status_file = open(hostname+'-after'+'/'+hostname+'-tunnel-summary'+'.json')
-    after_tunnel_status = json.load(after_tunnel_status_file)
-    tunnel_summary_diff = DeepDiff(before_tunnel_status,after_tunnel_status)
+    before_mac_data, after_mac_data = load_section_pair(hostname,'mac')
+    before_mac_status = keyed_table(before_mac_data[hostname])
+    after_mac_status = keyed_table(after_mac_data[hostname])
+    mac_summary_diff = diff_keyed_table(before_mac_status,after_mac_status,'mac')
+    return keyed_table_result('mac',mac_summary_diff,'Mac Status Difference','No differences were found with dynamic mac entries','network status name: ','dynamic mac entries','moved')
 
-    tunnel_summary_diff_dict = tunnel_summary_diff.to_dict()
-    
-    if tunnel_summary_diff_dict:
-        print(""" 
-    *********************
-    Tunnel Status Difference
-    ********************""")
-        for difference in tunnel_summary_diff_dict:
-            print ('\033[1;31m Differences were found before and after for vxlan tunnel entries: ' + difference + '\033[0;0m')
-            for entry in tunnel_summary_diff_dict[difference]:
-                print (tunnel_summary_diff_dict[difference][entry])
-    else: print ('\033[1;32m No differences were found with vxlan tunnel entries \033[0;0m')
-
-
-    '''
-    This should be covered for interface status abovse for physical interfaces as well
-    #Port status
-    before_port_status_file = open(hostname+'-before'+'/'+hostname+'-port-summary'+'.json')
-    before_port_status = json.load(before_port_status_file)
-    after_port_status_file = open(hostname+'-after'+'/'+hostname+'-port-summary'+'.json')
-    after_port_status = json.load(after_port_status_file)
-    port_summary_diff = DeepDiff(before_port_status,after_port_status)
-    port_summary_diff_dict = port_summary_diff.to_dict()
-    if port_summary_diff_dict:
-        print(""" 
+def compare_tunnel(hostname):
+    #Tunnel status 
+    before_tunnel_status, after_tunnel_status = load_section_pair(hostname,'tunnel')
+    return deepdiff_result('tunnel',before_tunnel_status,after_tunnel_status,'Tunnel Status Difference','No differences were found with vxlan tunnel entries','vxlan tunnel entries')
+
+#Section comparators in the order their results are printed
+SECTION_COMPARATORS = [
+    ('version', compare_version),
+    ('bgp', compare_bgp),
+    ('app', compare_app),
+    ('network-instance', compare_network_instance),
+    ('interface', compare_interface),
+    ('fan', compare_fan),
+    ('power', compare_power),
+    ('control', compare_control),
+    ('linecard', compare_linecard),
+    ('arp', compare_arp),
+    ('mac', compare_mac),
+    ('tunnel', compare_tunnel),
+]
+
+def run_section_comparator(hostname,section,trace_memory=False):
+    #Runs one comparator, usually in a worker process, and hands back its section result and anything it printed so the
+    #sections are reported in a fixed order no matter which finishes first. Its run time (and peak memory with
+    #trace_memory) come back with it for the run report, as worker processes can not record into this one
+    comparator = dict(SECTION_COMPARATORS)[section]
+    output = io.StringIO()
+    if trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        memory_start = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        result = comparator(hostname)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - memory_start if trace_memory else None
+    return result, output.getvalue(), seconds, peak
+
+def compare_sections(hostname,sections,workers=None,mp_context=None,executor=None):
+    #Yields (section, comparator result) in the order of sections, diffing them on a process pool (executor if given,
+    #kept warm by the caller) unless workers is 1. If the pool breaks, the sections not yet yielded are diffed one at a
+    #time in this process. The pool is spawned unless mp_context says otherwise, forking after the gnmi session and fetch
+    #threads exist can hang or abort the workers inside grpc
+    remaining = list(sections)
+    if workers != 1 or executor is not None:
+        try:
+            with contextlib.ExitStack() as stack:
+                if executor is None:
+                    executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=workers,mp_context=mp_context or multiprocessing.get_context('spawn')))
+                futures = [executor.submit(run_section_comparator,hostname,section,METRICS['memory']) for section in remaining]
+                for section, future in zip(list(remaining),futures):
+                    yield section, future.result()
+                    remaining.remove(section)
+        except concurrent.futures.process.BrokenProcessPool:
+            print ('Process pool is not available, comparing sections one at a time')
+    for section in remaining:
+        yield section, run_section_comparator(hostname,section,METRICS['memory'])
+
+def summary_row(result,seconds):
+    counts = {}
+    for group in result['groups']:
+        for change, count in group['counts'].items():
+            counts[change] = counts.get(change,0) + count
+    return {'section' : result['section'], 'status' : 'different' if result['groups'] else 'same', 'groups' : len(result['groups']),
+            'entries' : result_entry_count(result), 'counts' : counts, 'seconds' : round(seconds,3)}
+
+def render_summary_table(rows,outfile=None):
+    print ('{:<18} {:<10} {:>7} {:>9}  {:>8}  {}'.format('section','status','groups','entries','seconds','changes'), file=outfile)
+    for row in rows:
+        color = '\033[1;31m' if row['status'] == 'different' else '\033[1;32m'
+        changes = ', '.join(change + ' ' + str(count) for change, count in row['counts'].items())
+        print (color + '{:<18} {:<10} {:>7} {:>9}  {:>8.3f}  {}'.format(row['section'],row['status'],row['groups'],row['entries'],row['seconds'],changes) + '\033[0;0m', file=outfile)
+
+def write_jsonl(outfile,record):
+    outfile.write(json.dumps(record, default=str) + '\n')
+
+def report_compare(hostname,section_results,diff_limits=None,report_file=None,outfile=None):
+    #Renders the comparator results as they arrive: the console view (or outfile), and with report_file a JSON Lines file
+    #with one section record, every entry of the section (not truncated) and a summary record at the end. Each section is
+    #written and dropped before the next one is diffed out of the pool. Returns the summary rows
+    diff_limits = diff_limits or parse_diff_limits(None)
+    rows = []
+    report = open(report_file, "w") if report_file else None
+    try:
+        for section, (result, output, seconds, peak) in section_results:
+            print (output, end='', file=outfile)
+            render_section_result(result,diff_limits.get(section,diff_limits['default']),outfile)
+            record_metric('compare',section,seconds,**({'peak_bytes' : peak} if peak is not None else {}))
+            row = summary_row(result,seconds)
+            rows.append(row)
+            if report:
+                write_jsonl(report,dict({'type' : 'section', 'hostname' : hostname}, **row,
+                                        group_counts={group['group'] : group['counts'] for group in result['groups']}))
+                for group in result['groups']:
+                    for entry in group['entries']:
+                        write_jsonl(report,dict({'type' : 'entry', 'hostname' : hostname, 'section' : section, 'group' : group['group']}, **entry))
+                report.flush()
+        print ('', file=outfile)
+        render_summary_table(rows,outfile)
+        if report:
+            write_jsonl(report,{'type' : 'summary', 'hostname' : hostname, 'sections' : rows})
+    finally:
+        if report:
+            report.close()
+    return rows
+
+def compare_data(hostname,workers=None,skip_sections=(),diff_limits=None,report_file=None):
+    #Every section is loaded and diffed on its own, on a process pool, so the post check takes as long as the slowest
+    #section (usually mac or arp) instead of the sum of all of them. workers 1 runs them one after another in this process.
+    #skip_sections (found unchanged by the quick check) are not diffed, nor are the ones the saved post check left out.
+    #Returns the summary row of every section
+    skip_sections = sorted(set(skip_sections) | set(saved_skipped_sections(hostname)))
+    sections = [section for section, comparator in SECTION_COMPARATORS if section not in skip_sections]
+    if skip_sections:
+        print ('\033[1;32m Not diffing ' + ', '.join(skip_sections) + ', their totals matched the pre check \033[0;0m')
+    return report_compare(hostname,compare_sections(hostname,sections,workers),diff_limits,report_file)
+
+#Sections the convergence watcher follows after an upgrade
+WATCH_SECTIONS = ['bgp','mac','arp']
+
+def convergence_items(section,data,hostname):
+    #{group : {item : value}} the watcher holds against the baseline: state and received routes of every bgp peer, and
+    #the entry count of every mac-vrf and arp subinterface
+    if section == 'bgp':
+        return {peer : dict(status) for peer, status in data[hostname].items()}
+    return {group : {'entries' : len(entries)} for group, entries in keyed_table(data[hostname]).items()}
+
+def item_converged(before_value,after_value,tolerance):
+    #Counters are within tolerance percent of the baseline, anything else has to match it
+    if type(before_value) in (int,float) and type(after_value) in (int,float):
+        return abs(after_value - before_value) <= abs(before_value) * tolerance / 100
+    return before_value == after_value
+
+def item_label(item):
+    return item.replace('address_family_','').replace('_received_routes',' routes')
+
+def watch_convergence(session,hostname,options,tolerance=0,interval=10,deadline=1800):
+    #Poll the bgp, mac and arp sections until every peer, mac-vrf and subinterface saved by the pre check is back within
+    #tolerance of it, or deadline seconds pass. Time to converge is recorded per section and per group in
+    #<hostname>-convergence.json. A section only counts as converged while all of its groups are. Errors right after an
+    #upgrade are expected, a poll that fails counts as not converged yet and the report is written either way
+    baseline = {section : convergence_items(section,load_section(hostname,'before',section),hostname) for section in WATCH_SECTIONS}
+    report = {'hostname' : hostname, 'version' : None, 'tolerance' : tolerance, 'started' : datetime.now().isoformat(), 'converged' : False,
+              'failed_polls' : 0, 'last_error' : None,
+              'sections' : {section : {'time_to_converge' : None, 'groups' : {group : None for group in baseline[section]}} for section in WATCH_SECTIONS}}
+    start = time.time()
+    print ('Watching ' + ', '.join(WATCH_SECTIONS) + ' until they are within ' + str(tolerance) + '% of the pre check, for up to ' + str(deadline) + ' seconds')
+    try:
+        while True:
+            try:
+                if report['version'] is None:
+                    report['version'] = collect_tor_data(session,hostname,options['batch'],options['batch_size'],options['pruned'],None,None,['version'])['version'][hostname]
+                poll_data = collect_tor_data(session,hostname,options['batch'],options['batch_size'],options['pruned'],{'version' : {hostname : report['version']}},None,WATCH_SECTIONS,options.get('fetch_workers',1))
+            except Exception as ex:
+                poll_data = None
+                report['failed_polls'] += 1
+                report['last_error'] = str(ex)
+            elapsed = time.time() - start
+            if poll_data is None:
+                print ('\033[1;33m ' + str(round(elapsed)) + 's poll failed, not converged yet: ' + report['last_error'] + '\033[0;0m')
+                for section in WATCH_SECTIONS:
+                    report['sections'][section]['time_to_converge'] = None
+                if elapsed + interval > deadline:
+                    break
+                time.sleep(interval)
+                continue
+            for section in WATCH_SECTIONS:
+                current = convergence_items(section,poll_data[section],hostname)
+                section_report = report['sections'][section]
+                pending = {}
+                for group, items in baseline[section].items():
+                    off = [item for item in items if not item_converged(items[item],current.get(group,{}).get(item),tolerance)]
+                    if off:
+                        pending[group] = off
+                        section_report['groups'][group] = None
+                    elif section_report['groups'][group] is None:
+                        section_report['groups'][group] = elapsed
+                if pending:
+                    section_report['time_to_converge'] = None
+                elif section_report['time_to_converge'] is None:
+                    section_report['time_to_converge'] = elapsed
+                    record_metric('convergence',section,elapsed)
+                color = '\033[1;32m' if not pending else '\033[1;33m'
+                line = section + ': ' + str(len(baseline[section]) - len(pending)) + '/' + str(len(baseline[section])) + (' peers' if section == 'bgp' else ' groups') + ' converged'
+                if section != 'bgp':
+                    line += ', ' + str(sum(items['entries'] for items in current.values())) + '/' + str(sum(items['entries'] for items in baseline[section].values())) + ' entries'
+                print (color + ' ' + str(round(elapsed)) + 's ' + line + '\033[0;0m')
+                for group in sorted(pending)[:10]:
+                    print ('    ' + group + ': ' + ', '.join(item_label(item) + ' ' + str(current.get(group,{}).get(item)) + '/' + str(baseline[section][group][item]) for item in pending[group]))
+                if len(pending) > 10:
+                    print ('    and ' + str(len(pending) - 10) + ' more')
+            if all(report['sections'][section]['time_to_converge'] is not None for section in WATCH_SECTIONS):
+                report['converged'] = True
+                break
+            if elapsed + interval > deadline:
+                break
+            time.sleep(interval)
+    finally:
+        report['duration'] = time.time() - start
+        with open(hostname+'-convergence.json', "w") as outfile:
+            json.dump(report, outfile, indent=1)
+    if report['converged']:
+        print ('\033[1;32m Converged to the pre check baseline in ' + str(round(report['duration'],1)) + ' seconds \033[0;0m')
+    else:
+        print ('\033[1;31m Did not converge to the pre check baseline within ' + str(deadline) + ' seconds \033[0;0m')
+    return report['converged']
+
+def load_inventory(inventory_file,default_username=None,default_password=None,default_port='57400'):
+    #Read the fleet inventory from a csv (header: ip,hostname,username,password,password_env,port,group) or a yaml list of the same keys.
+    #password_env names an environment variable holding the password so it does not have to live in the file. group is the
+    #redundancy group (mlag/esi pair, rack) the wave scheduler never drains all of at once, each TOR is its own group by default
+    if inventory_file.endswith('.yml') or inventory_file.endswith('.yaml'):
+        if yaml is None:
+            raise SystemExit('PyYAML is not installed, install it or use a csv inventory')
+        with open(inventory_file) as infile:
+            inventory = yaml.safe_load(infile)
+        if type(inventory) is dict:
+            inventory = inventory.get('devices',[])
+    else:
+        with open(inventory_file, newline='') as infile:
+            inventory = list(csv.DictReader(infile))
+    devices = []
+    for entry in inventory:
+        if not entry.get('ip') or not entry.get('hostname'):
+            print ('Skipping inventory entry without ip or hostname: ' + str(entry))
+            continue
+        password = entry.get('password') or default_password
+        if entry.get('password_env'):
+            password = os.environ.get(entry['password_env'],password)
+        devices.append({'ip' : str(entry['ip']), 'hostname' : str(entry['hostname']), 'username' : entry.get('username') or default_username,
+                        'password' : password, 'port' : str(entry.get('port') or default_port), 'group' : str(entry.get('group') or entry['hostname'])})
+    #Results, saved files and daemon state are keyed by hostname
+    hostnames = [device['hostname'] for device in devices]
+    duplicates = sorted(set(hostname for hostname in hostnames if hostnames.count(hostname) > 1))
+    if duplicates:
+        raise SystemExit('Inventory lists ' + ', '.join(duplicates) + ' more than once, their results and files would overwrite each other')
+    return devices
+
+def retry_policy_options(args):
+    #The retry policy of the gnmi sessions, DEFAULT_RETRY_POLICY for the options not given
+    policy = {'retries' : args.retries, 'rpc_timeout' : args.rpc_timeout, 'backoff' : args.retry_backoff}
+    return {option : value for option, value in policy.items() if value is not None}
+
+def collection_options(args):
+    #The command line options that change how a TOR is collected and saved, passed as one dict to the fleet workers
+    return {'retry_policy' : retry_policy_options(args), 'run_deadline' : args.run_deadline, 'fetch_workers' : args.fetch_workers,
+            'batch' : args.batch, 'batch_size' : args.batch_size, 'pruned' : args.pruned, 'flap_window' : args.flap_window,
+            'flap_sample_interval' : args.flap_sample_interval, 'save_format' : args.save_format, 'snapshot_encoding' : args.snapshot_encoding,
+            'resume' : args.resume, 'resume_max_age' : args.resume_max_age, 'insecure' : bool(args.insecure), 'tiered' : bool(args.tiered), 'history_db' : args.history_db,
+            'port_policy' : load_port_policy(args.port_policy) if args.port_policy else None}
+
+def run_fleet_device(device,before_or_after_flag,options,sessions,device_timeout=None):
+    #Collection and save for one device of the fleet. Prompts for maint mode and port shutdown are not run in fleet mode.
+    #Every call has to finish within device_timeout, and nothing is saved once run_fleet has cancelled the session
+    session = GnmiSession((device['ip'],device.get('port','57400')),device['username'],device['password'],device['hostname'],options.get('insecure',False),options.get('retry_policy'))
+    sessions[device['hostname']] = session
+    set_metrics_device(device['hostname'])
+    try:
+        with run_deadline(session,device_timeout):
+            tor_data = collect_and_check(session,device['hostname'],before_or_after_flag,options)
+        if session.cancelled:
+            raise SessionCancelled(device['hostname'] + ' was reported as timed out, its data is not saved')
+        port_status = tor_data['port']
+        save_data(tor_data,device['hostname'],before_or_after_flag,options['save_format'],options['snapshot_encoding'],options.get('history_db'))
+        clear_checkpoint(checkpoint_dir_name(device['hostname'],phase_name(before_or_after_flag)))
+        port_issues = [port for port in port_status[device['hostname']] if port_status[device['hostname']][port]['port_issues']]
+        return {'version' : tor_data['version'][device['hostname']], 'port_issues' : port_issues}
+    finally:
+        session.close()
+
+def run_fleet(devices,before_or_after_flag,options,workers=16,device_timeout=300):
+    #Check many TORs at once. Each device runs in its own worker with its own session, a device that errors or runs past
+    #device_timeout is marked failed (its session is cancelled so the worker stops) and the rest of the batch carries on.
+    #The workers are daemon threads, a TOR that never answers does not hold up the exit
+    hostnames = [device['hostname'] for device in devices]
+    results = {}
+    sessions = {}
+    started = {}
+    lock = threading.Lock()
+    todo = queue.Queue()
+    finished = queue.Queue()
+    for device in devices:
+        todo.put(device)
+
+    def worker():
+        while True:
+            try:
+                device = todo.get_nowait()
+            except queue.Empty:
+                return
+            with lock:
+                started[device['hostname']] = time.time()
+            try:
+                finished.put((device,run_fleet_device(device,before_or_after_flag,options,sessions,device_timeout),None))
+            except Exception as ex:
+                finished.put((device,None,ex))
+
+    for number in range(min(workers,len(devices))):
+        threading.Thread(target=worker,daemon=True,name='fleet-'+str(number)).start()
+    while len(results) < len(devices):
+        try:
+            device, result, error = finished.get(timeout=1)
+        except queue.Empty:
+            device = None
+        if device is not None and device['hostname'] not in results:
+            duration = time.time() - started[device['hostname']]
+            if error is None:
+                results[device['hostname']] = {'ip' : device['ip'], 'status' : 'ok', 'duration' : duration, 'version' : result['version'], 'port_issues' : result['port_issues'], 'error' : None}
+            else:
+                results[device['hostname']] = {'ip' : device['ip'], 'status' : 'failed', 'duration' : duration, 'version' : None, 'port_issues' : [], 'error' : str(error)}
+        with lock:
+            running = [(hostname, start_time) for hostname, start_time in started.items() if hostname not in results]
+        for hostname, start_time in running:
+            if time.time() - start_time > device_timeout:
+                device = devices[hostnames.index(hostname)]
+                results[hostname] = {'ip' : device['ip'], 'status' : 'timeout', 'duration' : time.time() - start_time, 'version' : None, 'port_issues' : [], 'error' : 'no result after ' + str(device_timeout) + ' seconds'}
+                if hostname in sessions:
+                    sessions[hostname].cancel()
+    return results
+
+def report_fleet_summary(results):
+    print(""" 
     *********************
-    Port Status Difference
+    Fleet Summary
     ********************""")
-        for difference in port_summary_diff_dict:
-            print ('\033[1;31m Differences were found before and after for port status entries: ' + difference + '\033[0;0m')
-            print (port_summary_diff_dict)
-            for entry in port_summary_diff_dict[difference]:
-                print (port_summary_diff_dict[difference][entry])
-    '''
+    failed = 0
+    for hostname in sorted(results):
+        result = results[hostname]
+        line = hostname + ' (' + result['ip'] + ') ' + result['status'] + ' in ' + str(round(result['duration'],1)) + 's'
+        if result['status'] != 'ok':
+            failed += 1
+            print ('\033[1;31m ' + line + ': ' + str(result['error']) + '\033[0;0m')
+        elif result['port_issues']:
+            print ('\033[1;31m ' + line + ', version ' + str(result['version']) + ', flapping or erroring ports: ' + ', '.join(result['port_issues']) + '\033[0;0m')
+        else:
+            print ('\033[1;32m ' + line + ', version ' + str(result['version']) + '\033[0;0m')
+    print (str(len(results) - failed) + ' of ' + str(len(results)) + ' TORs checked successfully')
+    return failed
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-tor_ip', action='store', required=True,
+    parser.add_argument('-tor_ip', action='store', required=False,
                         help=('Mgmt IP of SRL TOR'))
-    parser.add_argument('-username', action='store', required=True,
+    parser.add_argument('-username', action='store', required=False,
                         help=('username to login to SRL TOR'))
-    parser.add_argument('-hostname', action='store', required=True,
+    parser.add_argument('-hostname', action='store', required=False,
                         help=('Hostname of SRL TOR'))
-    parser.add_argument('-password', action='store', required=True, help=('Password for SRL TOR login'))
+    parser.add_argument('-password', action='store', required=False, help=('Password for SRL TOR login'))
     parser.add_argument('-pre_check', action='store', required=False, help=('set flag if checking tor before reboot'))
     parser.add_argument('-post_check', action='store', required=False, help=('set flag after tor has rebooted to do post checks'))
     parser.add_argument('-no_shut_ports', action='store', required=False, help=('set flag if you only want to no shutdown ports and exit bgp maint mode'))
     parser.add_argument('-debug',action='store', help='Set flag for debug to log all data to files')
+    parser.add_argument('-batch', action='store', required=False, help=('set flag to send all collection paths in one gnmi get instead of one get per path'))
+    parser.add_argument('-batch_size', action='store', type=int, default=0, help=('max paths per gnmi get when -batch is set, 0 sends every path in one get'))
+    parser.add_argument('-inventory', action='store', required=False, help=('csv or yaml file of TORs to check together in fleet mode'))
+    parser.add_argument('-workers', action='store', type=int, default=16, help=('max TORs checked at the same time in fleet mode'))
+    parser.add_argument('-device_timeout', action='store', type=int, default=300, help=('seconds before a TOR is marked failed in fleet mode'))
+    parser.add_argument('-flap_window', action='store', type=int, default=10, help=('max seconds to watch interfaces for flaps and errors'))
+    parser.add_argument('-flap_sample_interval', action='store', type=float, default=2, help=('seconds between error counter samples during the flap window'))
+    parser.add_argument('-atomic_maint', action='store', required=False, help=('set flag to send the bgp maint mode change in the same gnmi set as the port shutdown/no shutdown'))
+    parser.add_argument('-set_chunk_size', action='store', type=int, default=0, help=('max updates per gnmi set for port shutdown/no shutdown, 0 sends them all in one set'))
+    parser.add_argument('-pruned', action='store', required=False, help=('set flag to fetch only the state leaves each section uses instead of whole subtrees'))
+    parser.add_argument('-save_format', action='store', choices=['json','snapshot'], default='json', help=('json saves one file per section in <hostname>-before/-after, snapshot saves one compressed <hostname>-before/-after.srlsnap file'))
+    parser.add_argument('-snapshot_encoding', action='store', choices=['json','msgpack'], default='json', help=('encoding of each snapshot section, msgpack needs the msgpack package'))
+    parser.add_argument('-compare_workers', action='store', type=int, default=None, help=('processes used to diff sections in the post check, 1 diffs them one at a time. Defaults to the cpu count'))
+    parser.add_argument('-diff_limit', action='store', required=False, help=('entries printed per mac-vrf, subinterface or change type of the post check diff, default 20, 0 prints all. Per section with e.g. 20,mac=200,arp=0'))
+    parser.add_argument('-diff_report', action='store', required=False, help=('write every section and entry of the post check diff, and a summary, to this JSON Lines file'))
+    parser.add_argument('-resume', action='store', required=False, help=('set flag to reuse the sections checkpointed by a pre/post check that failed part way, and only fetch what is missing'))
+    parser.add_argument('-resume_max_age', action='store', type=int, default=3600, help=('seconds a checkpointed section is reused for with -resume'))
+    parser.add_argument('-gnmi_port', action='store', default='57400', help=('gnmi port of the TOR, and of fleet inventory entries without a port'))
+    parser.add_argument('-insecure', action='store', required=False, help=('set flag to connect without TLS, for the local fake target in srl_fake_target.py'))
+    parser.add_argument('-run_report', action='store', required=False, help=('write a json report of the time, rpc latency, response size and entry counts of every phase, stage and rpc to this file at exit'))
+    parser.add_argument('-prometheus_file', action='store', required=False, help=('also write the run report numbers to this node exporter textfile'))
+    parser.add_argument('-report_memory', action='store', required=False, help=('set flag to trace peak memory of every stage for the run report, slows the run down'))
+    parser.add_argument('-port_policy', action='store', required=False, help=('json or yaml list of rules deciding which up ports the pre check shuts, see DEFAULT_PORT_SHUTDOWN_POLICY'))
+    parser.add_argument('-history_db', action='store', required=False, help=('sqlite file every saved pre and post check is also added to, query it with srl_history.py'))
+    parser.add_argument('-tiered', action='store', required=False, help=('set flag to compare bgp, interface, mac and arp totals to the pre check first in the post check, and only collect and diff the ones that differ'))
+    parser.add_argument('-approval_policy', action='store', required=False, help=('json or yaml file that approves or denies bgp maint mode and port shutdown instead of prompting, see APPROVAL_ACTIONS'))
+    parser.add_argument('-watch', action='store', required=False, help=('set flag to poll bgp, mac and arp until they are back to the pre check values, before the post check if -post_check is also set'))
+    parser.add_argument('-watch_tolerance', action='store', type=float, default=0, help=('percent received routes and mac/arp counts can be off the pre check and still count as converged'))
+    parser.add_argument('-watch_interval', action='store', type=float, default=10, help=('seconds between polls in -watch'))
+    parser.add_argument('-watch_deadline', action='store', type=float, default=1800, help=('seconds -watch gives up after'))
+    parser.add_argument('-rpc_timeout', action='store', type=float, default=None, help=('seconds a gnmi call may take before it is cancelled and retried, 0 waits forever. Replaces the per path defaults of RPC_TIMEOUTS (60, 300 for /network-instance/, 180 for /interface/)'))
+    parser.add_argument('-retries', action='store', type=int, default=None, help=('retries of a failed or timed out gnmi call, default 3'))
+    parser.add_argument('-retry_backoff', action='store', type=float, default=None, help=('seconds the jittered exponential backoff between retries starts from, default 1'))
+    parser.add_argument('-run_deadline', action='store', type=float, default=DEFAULT_RUN_DEADLINE, help=('seconds the whole collection of a pre or post check, retries included, has to finish in, default 900. 0 sets no deadline'))
+    parser.add_argument('-fetch_workers', action='store', type=int, default=4, help=('collection paths fetched in parallel when -batch is not set, 1 fetches them one at a time'))
     args = parser.parse_args()
+    if not args.inventory and not (args.tor_ip and args.username and args.hostname and args.password):
+        parser.error('-tor_ip, -username, -hostname and -password are required unless -inventory is set')
     gnmi_host = ()
-    gnmi_host=(args.tor_ip,'57400')
+    gnmi_host=(args.tor_ip,args.gnmi_port)
     #gnmi_host=(args.tor_ip,'50001')
     if args.debug:
         logging.basicConfig(filename=(f'srl_upgrade_debug-{datetime.now().strftime("%Y-%m-%d-%H:%M:%S")}.log'), filemode='w',level=logging.DEBUG, format='%(asctime)s %(message)s')
         logging.debug('Starting debug file')
+    if args.run_report or args.prometheus_file:
+        enable_metrics(bool(args.report_memory))
+        atexit.register(write_run_report,args.run_report,args.prometheus_file)
+    set_metrics_device(args.hostname)
+    if args.inventory:
+        if not (args.pre_check or args.post_check):
+            parser.error('-inventory needs -pre_check or -post_check')
+        devices = load_inventory(args.inventory,args.username,args.password,args.gnmi_port)
+        before_or_after_flag = 'precheck' if args.pre_check else 'postcheck'
+        results = run_fleet(devices,before_or_after_flag,collection_options(args),args.workers,args.device_timeout)
+        failed = report_fleet_summary(results)
+        sys.exit(1 if failed else 0)
+    approvals = load_approval_policy(args.approval_policy) if args.approval_policy else None
+    #One gnmi session is used for every query and set for the rest of the run
+    session = GnmiSession(gnmi_host,args.username,args.password,args.hostname,bool(args.insecure),retry_policy_options(args))
     if args.no_shut_ports:
         logging.debug('No shutdown ports variable set. Running exit of BGP commands and no shutdown ports')
-        exit_bgp_maint_mode(gnmi_host,args.username,args.password,args.hostname)
-        no_shutdown_access_ports(gnmi_host,args.username,args.password,args.hostname)
+        with measure('phases','maintenance'):
+            maint_update = exit_bgp_maint_mode(session,not args.atomic_maint,approvals)
+            no_shutdown_access_ports(session,args.hostname,[maint_update] if args.atomic_maint and maint_update else None,args.set_chunk_size)
         logging.debug('Finish no shutdown of ports')
+        session.close()
         exit()
-    #get current version
-    gnmi_path = '/system/information/version'
-    logging.debug('Getting TOR version')
-    version_raw_data = run_gnmi_query(gnmi_host,args.username,args.password,args.hostname,gnmi_path)
-    tor_version_data = parse_gnmi_result(version_raw_data)
-    tor_version = parse_srl_version(tor_version_data,args.hostname)
-    
-
-
-    #Check application status
-    gnmi_path = '/system/app-management/application'
-    logging.debug('Getting TOR app status')
-    application_path_raw = run_gnmi_query(gnmi_host,args.username,args.password,args.hostname,gnmi_path)
-    tor_application_status_parsed_data = parse_gnmi_result(application_path_raw)
-    tor_application_status = parse_srl_applications(tor_application_status_parsed_data,args.hostname)
-    
-    #Check network-instances
-    gnmi_path = '/network-instance/'
-    logging.debug('Getting TOR network instance data')
-    network_instance_raw = run_gnmi_query(gnmi_host,args.username,args.password,args.hostname,gnmi_path)
-    network_instance_parsed_data = parse_gnmi_result(network_instance_raw)
-    network_instance_status = parse_network_instances(network_instance_parsed_data,args.hostname)
-
-    #get mac table information, and re-use the data from the network instance data
-    mac_information_status = parse_mac_information(network_instance_parsed_data,args.hostname)
-    
-    #Run BGP checks v22
-    if 'v22' in tor_version[args.hostname]:
-        gnmi_path = '/network-instance[name=default]/protocols/bgp/neighbor'
-        logging.debug('TOR appears to be on v22, run special checks for BGP info')
-        bgp_raw_data = run_gnmi_query(gnmi_host,args.username,args.password,args.hostname,gnmi_path)
-        tor_bgp_status_parsed_data = parse_gnmi_result(bgp_raw_data)
-        tor_bgp_status = parse_bgp_gnmi_v22(tor_bgp_status_parsed_data,args.hostname)
+    if args.watch:
+        with measure('phases','watch'):
+            converged = watch_convergence(session,args.hostname,collection_options(args),args.watch_tolerance,args.watch_interval,args.watch_deadline)
+        if not args.post_check:
+            session.close()
+            sys.exit(0 if converged else 1)
+    if args.pre_check:
+        before_or_after_flag = 'precheck'
+    elif args.post_check:
+        before_or_after_flag = 'postcheck'
     else:
-        gnmi_path = '/network-instance[name=default]/protocols/bgp/neighbor'
-        logging.debug('TOR is on code with newer BGP formating, getting BGP information')
-        bgp_raw_data = run_gnmi_query(gnmi_host,args.username,args.password,args.hostname,gnmi_path)
-        tor_bgp_status_parsed_data = parse_gnmi_result(bgp_raw_data)
-        tor_bgp_status = parse_bgp_gnmi(tor_bgp_status_parsed_data,args.hostname)
-
-    
-    #Run Interface checks
-    gnmi_path = '/interface/'
-    logging.debug('Getting TOR interface data')
-    interface_raw_data = run_gnmi_query(gnmi_host,args.username,args.password,args.hostname,gnmi_path)
-    interface_status_parsed_data = parse_gnmi_result(interface_raw_data)
-    interface_status = parse_interface_status(interface_status_parsed_data,args.hostname)
-    
-
-    
-
-    #Gather ARP table. This uses the data already gathered from the interface context
-    logging.debug('Parsing arp status')
-    arp_status = parse_arp_status(interface_status_parsed_data,args.hostname)
-
-    #Run fan checks
-    gnmi_path = '/platform/fan-tray'
-    logging.debug('Getting TOR fan information')
-    fan_raw_data = run_gnmi_query(gnmi_host,args.username,args.password,args.hostname,gnmi_path)
-    fan_status_parsed_data = parse_gnmi_result(fan_raw_data)
-    fan_status = parse_fan_status(fan_status_parsed_data,args.hostname)
-
-
-    #Run power supply checks
-    gnmi_path = '/platform/power-supply'
-    logging.debug('Getting TOR power supply information')
-    power_supply_raw_data = run_gnmi_query(gnmi_host,args.username,args.password,args.hostname,gnmi_path)
-    power_supply_parsed_data = parse_gnmi_result(power_supply_raw_data)
-    power_supply_status = parse_power_supply_status(power_supply_parsed_data,args.hostname)
-
-    #Run control card checks:
-    gnmi_path = '/platform/control'
-    logging.debug('Getting TOR CPM card information')
-    control_raw_data  = run_gnmi_query(gnmi_host,args.username,args.password,args.hostname,gnmi_path)
-    control_parsed_data = parse_gnmi_result(control_raw_data)
-    control_status = parse_control_status(control_parsed_data,args.hostname)
-
-
-    #Run line card checks:
-    gnmi_path = '/platform/linecard'
-    logging.debug('Getting TOR linecard information')
-    linecard_raw_data  = run_gnmi_query(gnmi_host,args.username,args.password,args.hostname,gnmi_path)
-    linecard_parsed_data = parse_gnmi_result(linecard_raw_data)
-    linecard_status = parse_linecard_status(linecard_parsed_data,args.hostname) 
-
-    #Get tunnel data
-    gnmi_path = '/tunnel'
-    logging.debug('Getting TOR tunnel information')
-    tunnel_raw_data = run_gnmi_query(gnmi_host,args.username,args.password,args.hostname,gnmi_path)
-    tunnel_parsed_data = parse_gnmi_result(tunnel_raw_data)
-    tunnel_status  = parse_tunnel_information(tunnel_parsed_data,args.hostname)
-
-    #Check for any bouncing ports
-    logging.debug('Checking for bouncing ports')
-    port_status = check_bouncing_ports(gnmi_host,args.username,args.password,args.hostname)
-    report_port_issues(port_status,args.hostname)
-
-    #Generate list of ports we will shutdown through GNMI to prepare for upgrade
+        before_or_after_flag = None
+    tor_data = collect_and_check(session,args.hostname,before_or_after_flag,collection_options(args))
+    report_port_issues(tor_data['port'],args.hostname)
 
     #This we handle outside of normal compare and save data because we want to know before an upgrade if happening as well. 
     if args.pre_check:
         logging.debug('User selected precheck option and gathering data')
-        #Generate list of ports we will shutdown through GNMI to prepare for upgrade
-        tor_access_ports_for_shutdown = generate_port_shutdown(interface_status,gnmi_host,args.username,args.password,args.hostname)
-        save_data(tor_bgp_status,tor_version,tor_application_status,network_instance_status,interface_status,fan_status,power_supply_status,control_status,linecard_status,arp_status,mac_information_status,tunnel_status,port_status,tor_access_ports_for_shutdown,args.hostname,'precheck')
-        enter_bgp_maint_mode(gnmi_host,args.username,args.password,args.hostname)
-        shutdown_access_ports(tor_access_ports_for_shutdown,gnmi_host,args.username,args.password,args.hostname)
+        tor_access_ports_for_shutdown = tor_data['port-shutdown']
+        save_data(tor_data,args.hostname,'precheck',args.save_format,args.snapshot_encoding,args.history_db)
+        clear_checkpoint(checkpoint_dir_name(args.hostname,'before'))
+        #Includes the time spent answering the prompts
+        with measure('phases','maintenance'):
+            maint_update = enter_bgp_maint_mode(session,not args.atomic_maint,approvals)
+            shutdown_access_ports(tor_access_ports_for_shutdown,session,args.hostname,[maint_update] if args.atomic_maint and maint_update else None,args.set_chunk_size,approvals)
     if args.post_check:
         logging.debug('User selected post check option, comparing data')
-        tor_access_ports_for_shutdown = [] #for now because this function needs something and we do not want to shutdown here, pass in a blank var
-        save_data(tor_bgp_status,tor_version,tor_application_status,network_instance_status,interface_status,fan_status,power_supply_status,control_status,linecard_status,arp_status,mac_information_status,tunnel_status,port_status,tor_access_ports_for_shutdown,args.hostname,'postcheck')
-        compare_data(args.hostname)
+        save_data(tor_data,args.hostname,'postcheck',args.save_format,args.snapshot_encoding,args.history_db)
+        clear_checkpoint(checkpoint_dir_name(args.hostname,'after'))
+        with measure('phases','compare'):
+            compare_data(args.hostname,args.compare_workers,skipped_sections(tor_data,args.hostname),parse_diff_limits(args.diff_limit),args.diff_report)
     
+    session.close()
     logging.debug('End of script')
 
 if __name__ == "__main__":
@@ -0,0 +1,305 @@
+import srl_upgrade
+import argparse
+import atexit
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import shlex
+import subprocess
+import time
+from datetime import datetime
+
+#Rolling upgrade of a fleet in waves. Every TOR goes through the same pre check -> drain (bgp maint mode and port
+#shutdown) -> upgrade -> restore (exit maint mode, no shutdown ports) -> post check steps as a manual run, with the
+#prompts answered by the approval policy. A wave never drains more than max_drained_per_group TORs of a redundancy
+#group (the group column of the inventory), and the next wave only starts if the post checks of the last one passed
+
+#Wave policy, a json or yaml dict. Keys it leaves out keep these values
+DEFAULT_WAVE_POLICY = {
+    #Max TORs upgraded at the same time, 0 for no limit
+    'parallelism' : 4,
+    'max_drained_per_group' : 1,
+    #Answers for srl_upgrade.APPROVAL_ACTIONS, anything left out is prompted for
+    'approvals' : {},
+    'atomic_maint' : True,
+    'set_chunk_size' : 0,
+    #Command run to upgrade a TOR, formatted with its hostname, ip and port (e.g. "upgrade.sh {hostname} {ip}"), never its
+    #credentials. Without it the scheduler waits for the TOR to come back on a new version, upgraded by whatever else is driving it
+    'upgrade_command' : None,
+    'upgrade_timeout' : 3600,
+    'upgrade_poll_interval' : 30,
+    #Version the TOR has to come back on, any version other than the pre check one if not set
+    'target_version' : None,
+    'block_on_port_issues' : True,
+    #Sections the post check may differ in and still pass
+    'allowed_differences' : ['version'],
+    #watch_convergence arguments (tolerance, interval, deadline) run between the restore and the post check, so the post
+    #check runs once the re-enabled ports have learnt their macs and arp and bgp is back. None skips the watch
+    'watch' : {'tolerance' : 0, 'interval' : 10, 'deadline' : 1800},
+    #Failed TORs allowed before no more waves are started
+    'max_failed' : 0,
+}
+
+def load_wave_policy(policy_file=None):
+    policy = dict(DEFAULT_WAVE_POLICY)
+    if policy_file:
+        policy.update(srl_upgrade.load_policy_file(policy_file,'wave policy'))
+    return policy
+
+def plan_waves(devices,parallelism=4,max_drained_per_group=1):
+    #Fewest waves that keep to both limits: every wave takes up to max_drained_per_group TORs from the groups with the most
+    #TORs left, so the largest group sets the number of waves unless parallelism does
+    groups = {}
+    for device in devices:
+        groups.setdefault(device['group'],[]).append(device)
+    waves = []
+    while any(groups.values()):
+        wave = []
+        for group in sorted(groups,key=lambda group: -len(groups[group])):
+            while groups[group] and sum(device['group'] == group for device in wave) < max_drained_per_group:
+                if parallelism and len(wave) >= parallelism:
+                    break
+                wave.append(groups[group].pop(0))
+        waves.append(wave)
+    return waves
+
+def tor_session(device,options):
+    return srl_upgrade.GnmiSession((device['ip'],device['port']),device['username'],device['password'],device['hostname'],options.get('insecure',False),options.get('retry_policy'))
+
+def port_issues(port_status,hostname):
+    return [port for port in port_status[hostname] if port_status[hostname][port]['port_issues']]
+
+def pre_check_and_drain(device,policy,options,result):
+    #Returns why the TOR was not drained, or None once it is in maint mode with its access ports shut. result['drained']
+    #is set before the first drain set goes out and only cleared once nothing is left drained, so a set that fails part
+    #way (after the maint mode change or some port chunks were committed) leaves the TOR counted as drained
+    hostname = device['hostname']
+    approvals = policy['approvals']
+    with tor_session(device,options) as session:
+        tor_data = srl_upgrade.collect_and_check(session,hostname,'precheck',options)
+        srl_upgrade.save_data(tor_data,hostname,'precheck',options['save_format'],options['snapshot_encoding'],options['history_db'])
+        srl_upgrade.clear_checkpoint(srl_upgrade.checkpoint_dir_name(hostname,'before'))
+        result['version_before'] = tor_data['version'][hostname]
+        issues = port_issues(tor_data['port'],hostname)
+        if issues and policy['block_on_port_issues']:
+            return 'pre check found flapping or erroring ports: ' + ', '.join(issues)
+        result['drained'] = True
+        maint_update = srl_upgrade.enter_bgp_maint_mode(session,not policy['atomic_maint'],approvals)
+        if maint_update is None:
+            result['drained'] = False
+            return 'bgp maintenance mode was not approved'
+        if not srl_upgrade.shutdown_access_ports(tor_data['port-shutdown'],session,hostname,[maint_update] if policy['atomic_maint'] else None,policy['set_chunk_size'],approvals):
+            #The maint mode change went out on its own, take it back as the TOR is not being upgraded
+            srl_upgrade.run_gnmi_set(session,srl_upgrade.bgp_maint_mode_update('disable'))
+            result['drained'] = False
+            return 'port shutdown was not approved'
+    return None
+
+def wait_for_version(device,policy,options,version_before):
+    #Poll the version until the TOR is back on the target version (or any new version), connection errors while it
+    #reboots are expected. Returns the new version, or None after upgrade_timeout
+    hostname = device['hostname']
+    deadline = time.time() + policy['upgrade_timeout']
+    while True:
+        try:
+            with tor_session(device,options) as session:
+                version = srl_upgrade.collect_tor_data(session,hostname,options['batch'],options['batch_size'],options['pruned'],None,None,['version'])['version'][hostname]
+            if version == policy['target_version'] or (not policy['target_version'] and version != version_before):
+                return version
+            logging.debug(hostname + ' is still on ' + str(version))
+        except Exception as ex:
+            logging.debug(hostname + ' is not answering yet: ' + str(ex))
+        if time.time() + policy['upgrade_poll_interval'] > deadline:
+            return None
+        time.sleep(policy['upgrade_poll_interval'])
+
+def upgrade_tor(device,policy,options,version_before):
+    if policy['upgrade_command']:
+        command = shlex.split(policy['upgrade_command'].format(hostname=device['hostname'],ip=device['ip'],port=device['port']))
+        print (device['hostname'] + ': running ' + command[0])
+        subprocess.run(command,check=True,timeout=policy['upgrade_timeout'])
+    return wait_for_version(device,policy,options,version_before)
+
+def compare_tor(hostname,compare_workers=None,skip_sections=(),diff_limits=None):
+    #Diff every section like compare_data, but into <hostname>-compare.txt and <hostname>-compare.jsonl so the TORs of a
+    #wave do not print over each other. Spawned workers as the gnmi threads of the other TORs are still running. Returns
+    #the sections that differ
+    sections = [section for section, comparator in srl_upgrade.SECTION_COMPARATORS if section not in skip_sections]
+    section_results = srl_upgrade.compare_sections(hostname,sections,compare_workers,multiprocessing.get_context('spawn'))
+    with open(hostname+'-compare.txt', "w") as outfile:
+        rows = srl_upgrade.report_compare(hostname,section_results,diff_limits,hostname+'-compare.jsonl',outfile)
+    return [row['section'] for row in rows if row['status'] == 'different']
+
+def post_check(device,policy,options,result,compare_workers=None):
+    #Returns the problems found after the upgrade, empty if it passed
+    hostname = device['hostname']
+    with tor_session(device,options) as session:
+        tor_data = srl_upgrade.collect_and_check(session,hostname,'postcheck',options)
+        srl_upgrade.save_data(tor_data,hostname,'postcheck',options['save_format'],options['snapshot_encoding'],options['history_db'])
+        srl_upgrade.clear_checkpoint(srl_upgrade.checkpoint_dir_name(hostname,'after'))
+    problems = []
+    issues = port_issues(tor_data['port'],hostname)
+    if issues:
+        problems.append('flapping or erroring ports: ' + ', '.join(issues))
+    result['differences'] = compare_tor(hostname,compare_workers,srl_upgrade.skipped_sections(tor_data,hostname),options.get('diff_limits'))
+    unexpected = [section for section in result['differences'] if section not in policy['allowed_differences']]
+    if unexpected:
+        problems.append('post check differs in ' + ', '.join(unexpected) + ', see ' + hostname + '-compare.txt')
+    return problems
+
+def restore_tor(device,policy,options,result):
+    #Exit maint mode and enable the ports shut by the pre check, then wait for convergence if the policy asks for it
+    hostname = device['hostname']
+    problems = []
+    with tor_session(device,options) as session:
+        maint_update = srl_upgrade.exit_bgp_maint_mode(session,not policy['atomic_maint'],policy['approvals'])
+        srl_upgrade.no_shutdown_access_ports(session,hostname,[maint_update] if policy['atomic_maint'] and maint_update else None,policy['set_chunk_size'])
+        if maint_update is None:
+            problems.append('exit of bgp maintenance mode was not approved')
+        else:
+            result['drained'] = False
+        if policy['watch'] and not srl_upgrade.watch_convergence(session,hostname,options,**policy['watch']):
+            problems.append('did not converge to the pre check baseline, see ' + hostname + '-convergence.json')
+    return problems
+
+def run_phase(result,phase,function,*args):
+    result['phase'] = phase
+    start = time.time()
+    with srl_upgrade.measure('phases',phase):
+        value = function(*args)
+    result['durations'][phase] = time.time() - start
+    return value
+
+def run_tor(device,policy,options,compare_workers=None):
+    #One TOR through every step. status is ok, blocked (not drained, not upgraded) or failed, and drained says if it was
+    #left in maint mode with its ports shut
+    srl_upgrade.set_metrics_device(device['hostname'])
+    result = {'ip' : device['ip'], 'group' : device['group'], 'status' : 'ok', 'phase' : None, 'drained' : False, 'error' : None,
+              'version_before' : None, 'version_after' : None, 'differences' : [], 'durations' : {}}
+    try:
+        reason = run_phase(result,'pre_check',pre_check_and_drain,device,policy,options,result)
+        if reason:
+            result.update({'status' : 'blocked', 'error' : reason})
+            return result
+        result['version_after'] = run_phase(result,'upgrade',upgrade_tor,device,policy,options,result['version_before'])
+        if result['version_after'] is None:
+            result.update({'status' : 'failed', 'error' : 'not back on a new version after ' + str(policy['upgrade_timeout']) + ' seconds'})
+            return result
+        problems = run_phase(result,'restore',restore_tor,device,policy,options,result)
+        problems += run_phase(result,'post_check',post_check,device,policy,options,result,compare_workers)
+        if problems:
+            result.update({'status' : 'failed', 'error' : '; '.join(problems)})
+    except Exception as ex:
+        result.update({'status' : 'failed', 'error' : result['phase'] + ': ' + str(ex)})
+    return result
+
+def report_wave(number,results):
+    print("""
+    *********************
+    Wave """ + str(number) + """ Summary
+    ********************""")
+    for hostname in sorted(results):
+        result = results[hostname]
+        line = hostname + ' (' + result['group'] + ') ' + result['status']
+        if result['status'] == 'ok':
+            print ('\033[1;32m ' + line + ', ' + str(result['version_before']) + ' -> ' + str(result['version_after']) + ' in ' + str(round(sum(result['durations'].values()),1)) + 's\033[0;0m')
+        else:
+            print ('\033[1;31m ' + line + (' and left drained' if result['drained'] else '') + ': ' + str(result['error']) + '\033[0;0m')
+
+def run_waves(devices,policy,options,compare_workers=None,dry_run=False,report_file=None):
+    plan = plan_waves(devices,policy['parallelism'],policy['max_drained_per_group'])
+    for number, wave in enumerate(plan,1):
+        print ('Wave ' + str(number) + ': ' + ', '.join(device['hostname'] + ' (' + device['group'] + ')' for device in wave))
+    report = {'started' : datetime.now().isoformat(), 'policy' : policy, 'plan' : [[device['hostname'] for device in wave] for wave in plan], 'waves' : [], 'halted' : None}
+    if dry_run:
+        return report
+    #TORs left drained by a failure still count against their group in later waves
+    drained = {}
+    failed = 0
+    for number, wave in enumerate(plan,1):
+        if failed > policy['max_failed']:
+            report['halted'] = 'stopped before wave ' + str(number) + ', ' + str(failed) + ' TORs failed'
+            print ('\033[1;31m ' + report['halted'] + '\033[0;0m')
+            break
+        results = {}
+        runnable = []
+        for device in wave:
+            in_group = list(drained.values()).count(device['group']) + sum(other['group'] == device['group'] for other in runnable)
+            if in_group >= policy['max_drained_per_group']:
+                results[device['hostname']] = {'ip' : device['ip'], 'group' : device['group'], 'status' : 'skipped', 'phase' : None, 'drained' : False,
+                                               'error' : 'group ' + device['group'] + ' has a TOR left drained', 'version_before' : None,
+                                               'version_after' : None, 'differences' : [], 'durations' : {}}
+            else:
+                runnable.append(device)
+        print ('Starting wave ' + str(number) + ' of ' + str(len(plan)) + ': ' + ', '.join(device['hostname'] for device in runnable))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(runnable),1)) as executor:
+            futures = {device['hostname'] : executor.submit(run_tor,device,policy,options,compare_workers) for device in runnable}
+            for hostname, future in futures.items():
+                results[hostname] = future.result()
+        for hostname, result in results.items():
+            if result['drained']:
+                drained[hostname] = result['group']
+            if result['status'] in ('failed','blocked'):
+                failed += 1
+        report['waves'].append({'wave' : number, 'devices' : results})
+        report_wave(number,results)
+    report['failed'] = failed
+    report['drained'] = sorted(drained)
+    if report_file:
+        with open(report_file, "w") as outfile:
+            json.dump(report, outfile, indent=1)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Rolling upgrade of the TORs of an inventory in waves, around the srl_upgrade.py pre and post checks')
+    parser.add_argument('-inventory', action='store', required=True, help=('csv or yaml inventory of TORs, the group column holds the redundancy group'))
+    parser.add_argument('-username', action='store', required=False, help=('username for inventory entries without one'))
+    parser.add_argument('-password', action='store', required=False, help=('password for inventory entries without one'))
+    parser.add_argument('-gnmi_port', action='store', default='57400', help=('gnmi port for inventory entries without one'))
+    parser.add_argument('-insecure', action='store', required=False, help=('set flag to connect without TLS, for srl_fake_target.py'))
+    parser.add_argument('-wave_policy', action='store', required=False, help=('json or yaml wave policy, see DEFAULT_WAVE_POLICY'))
+    parser.add_argument('-parallelism', action='store', type=int, default=None, help=('max TORs per wave, overrides the wave policy'))
+    parser.add_argument('-dry_run', action='store', required=False, help=('set flag to print the waves and exit'))
+    parser.add_argument('-wave_report', action='store', required=False, help=('write the result of every TOR of every wave to this json file'))
+    parser.add_argument('-batch', action='store', required=False, help=('set flag to send all collection paths in one gnmi get'))
+    parser.add_argument('-batch_size', action='store', type=int, default=0, help=('max paths per gnmi get when -batch is set'))
+    parser.add_argument('-pruned', action='store', required=False, help=('set flag to fetch only the state leaves each section uses'))
+    parser.add_argument('-flap_window', action='store', type=int, default=10, help=('max seconds to watch interfaces for flaps and errors'))
+    parser.add_argument('-flap_sample_interval', action='store', type=float, default=2, help=('seconds between error counter samples'))
+    parser.add_argument('-save_format', action='store', choices=['json','snapshot'], default='json', help=('how the pre and post checks are saved'))
+    parser.add_argument('-snapshot_encoding', action='store', choices=['json','msgpack'], default='json', help=('encoding of each snapshot section'))
+    parser.add_argument('-resume', action='store', required=False, help=('set flag to reuse checkpointed sections of a failed pre or post check'))
+    parser.add_argument('-resume_max_age', action='store', type=int, default=3600, help=('seconds a checkpointed section is reused for'))
+    parser.add_argument('-history_db', action='store', required=False, help=('sqlite file every saved pre and post check is also added to'))
+    parser.add_argument('-tiered', action='store', required=False, help=('set flag to only collect and diff the post check sections whose totals changed'))
+    parser.add_argument('-rpc_timeout', action='store', type=float, default=None, help=('seconds a gnmi call may take before it is cancelled and retried, 0 waits forever. Replaces the per path defaults of RPC_TIMEOUTS (60, 300 for /network-instance/, 180 for /interface/)'))
+    parser.add_argument('-retries', action='store', type=int, default=None, help=('retries of a failed or timed out gnmi call, default 3'))
+    parser.add_argument('-retry_backoff', action='store', type=float, default=None, help=('seconds the jittered exponential backoff between retries starts from, default 1'))
+    parser.add_argument('-run_deadline', action='store', type=float, default=srl_upgrade.DEFAULT_RUN_DEADLINE, help=('seconds the whole collection of a pre or post check, retries included, has to finish in, default 900. 0 sets no deadline'))
+    parser.add_argument('-fetch_workers', action='store', type=int, default=4, help=('collection paths fetched in parallel when -batch is not set, 1 fetches them one at a time'))
+    parser.add_argument('-port_policy', action='store', required=False, help=('json or yaml rules deciding which up ports are shut'))
+    parser.add_argument('-compare_workers', action='store', type=int, default=None, help=('processes used to diff the sections of each post check'))
+    parser.add_argument('-diff_limit', action='store', required=False, help=('entries written per group of differences to <hostname>-compare.txt, e.g. 20,mac=200'))
+    parser.add_argument('-run_report', action='store', required=False, help=('write the srl_upgrade.py run report of every TOR to this file at exit'))
+    parser.add_argument('-prometheus_file', action='store', required=False, help=('also write the run report numbers to this node exporter textfile'))
+    parser.add_argument('-debug',action='store', help='Set flag for debug to log all data to files')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(filename=(f'srl_waves_debug-{datetime.now().strftime("%Y-%m-%d-%H:%M:%S")}.log'), filemode='w',level=logging.DEBUG, format='%(asctime)s %(threadName)s %(message)s')
+    if args.run_report or args.prometheus_file:
+        srl_upgrade.enable_metrics()
+        atexit.register(srl_upgrade.write_run_report,args.run_report,args.prometheus_file)
+    policy = load_wave_policy(args.wave_policy)
+    if args.parallelism is not None:
+        policy['parallelism'] = args.parallelism
+    devices = srl_upgrade.load_inventory(args.inventory,args.username,args.password,args.gnmi_port)
+    options = srl_upgrade.collection_options(args)
+    options['diff_limits'] = srl_upgrade.parse_diff_limits(args.diff_limit)
+    report = run_waves(devices,policy,options,args.compare_workers,bool(args.dry_run),args.wave_report)
+    if report['halted'] or report.get('failed'):
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import srl_fake_target
+import srl_upgrade
+import pytest
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+HOSTNAME = 'leaf1'
+
+def synthetic_state(layout):
+    #The state the fixtures in data/ were recorded from: a small synthetic TOR plus a mac-vrf that has not learnt anything
+    #(no bridge-table) and an ip-vrf
+    options = {'layout' : layout, 'ports' : 3, 'subinterfaces' : 2, 'mac_vrfs' : 2, 'macs_per_vrf' : 4, 'arp_entries' : 6, 'bgp_peers' : 3}
+    state = srl_fake_target.build_synthetic_state(options)
+    state['network-instance'].append({'name' : 'mac-vrf-empty', 'type' : 'mac-vrf', 'oper-state' : 'up'})
+    state['network-instance'].append({'name' : 'ip-vrf-1', 'type' : 'ip-vrf', 'oper-state' : 'down'})
+    return state
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    #save_data, load_section and compare_data work on the current directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def fake_tor():
+    #Starts a fake gNMI target on a free port for a state and returns it with a connected session to it. The target's
+    #stats count the calls of every rpc
+    started = []
+    def start(state, retry_policy=None, **target_options):
+        target = srl_fake_target.FakeTarget(state, **target_options)
+        port = target.start(0)
+        session = srl_upgrade.GnmiSession(('127.0.0.1', port), 'admin', 'admin', HOSTNAME, insecure=True, retry_policy=retry_policy)
+        session.connect()
+        started.append((target, session))
+        return target, session
+    yield start
+    for target, session in started:
+        session.close()
+        target.stop()
@@ -0,0 +1,66 @@
+import json
+
+import srl_upgrade
+import pytest
+from conftest import HOSTNAME, synthetic_state
+
+def write_policy(workdir, approvals):
+    with open(workdir / 'approvals.json', 'w') as outfile:
+        json.dump(approvals, outfile)
+    return str(workdir / 'approvals.json')
+
+def prompt_answers(monkeypatch, answer):
+    asked = []
+    def answer_prompt(question):
+        asked.append(question)
+        return answer
+    monkeypatch.setattr('builtins.input', answer_prompt)
+    return asked
+
+def test_load_approval_policy(workdir):
+    approvals = {'enter_maint_mode' : 'approve', 'shutdown_ports' : 'prompt', 'max_shutdown_ports' : 10}
+    assert srl_upgrade.load_approval_policy(write_policy(workdir, approvals)) == approvals
+    with pytest.raises(SystemExit):
+        srl_upgrade.load_approval_policy(write_policy(workdir, {'exit_maint_mode' : 'yes'}))
+
+@pytest.mark.parametrize('approvals, count, approved', [
+    ({'shutdown_ports' : 'approve'}, 40, True),
+    ({'shutdown_ports' : 'deny'}, 1, False),
+    ({'shutdown_ports' : 'approve', 'max_shutdown_ports' : 40}, 40, True),
+    ({'shutdown_ports' : 'approve', 'max_shutdown_ports' : 40}, 41, False),
+])
+def test_request_approval_from_policy(monkeypatch, approvals, count, approved):
+    asked = prompt_answers(monkeypatch, 'Y')
+    assert srl_upgrade.request_approval('shutdown_ports', 'Shut? ', approvals, HOSTNAME, count) is approved
+    assert asked == []
+
+@pytest.mark.parametrize('approvals', [None, {}, {'enter_maint_mode' : 'prompt'}, {'shutdown_ports' : 'approve'}])
+@pytest.mark.parametrize('answer, approved', [('Y', True), ('N', False), ('y', False), ('', False)])
+def test_request_approval_prompts(monkeypatch, approvals, answer, approved):
+    asked = prompt_answers(monkeypatch, answer)
+    assert srl_upgrade.request_approval('enter_maint_mode', 'Maint? ', approvals, HOSTNAME) is approved
+    assert asked == [HOSTNAME + ': Maint? ']
+
+def maint_mode(state):
+    return state['system']['maintenance']['group'][0]['maintenance-mode']['admin-state']
+
+def shut_ports(state):
+    return sorted(interface['name'] for interface in state['interface'] if interface.get('admin-state') == 'disable')
+
+@pytest.mark.parametrize('approvals, maint_state, ports_shut', [
+    ({'enter_maint_mode' : 'approve', 'shutdown_ports' : 'approve'}, 'enable', True),
+    ({'enter_maint_mode' : 'approve', 'shutdown_ports' : 'deny'}, 'enable', False),
+    ({'enter_maint_mode' : 'deny', 'shutdown_ports' : 'approve'}, 'disable', True),
+    ({'enter_maint_mode' : 'approve', 'shutdown_ports' : 'approve', 'max_shutdown_ports' : 2}, 'enable', False),
+])
+def test_drain_follows_the_policy(fake_tor, monkeypatch, approvals, maint_state, ports_shut):
+    #The maint mode change goes out in the same set as the port shutdown, and only what the policy approves is sent
+    prompt_answers(monkeypatch, 'Y')
+    state = synthetic_state('v23')
+    target, session = fake_tor(state)
+    ports = {HOSTNAME : ['ethernet-1/1', 'ethernet-1/2', 'ethernet-1/3']}
+    maint_update = srl_upgrade.enter_bgp_maint_mode(session, False, approvals)
+    approved = srl_upgrade.shutdown_access_ports(ports, session, HOSTNAME, [maint_update] if maint_update else None, 0, approvals)
+    assert approved is ports_shut
+    assert maint_mode(state) == maint_state
+    assert shut_ports(state) == (ports[HOSTNAME] if ports_shut else [])
@@ -0,0 +1,45 @@
+import srl_upgrade
+import pytest
+from conftest import HOSTNAME, synthetic_state
+
+def test_split_gnmi_path_keeps_slashes_in_keys():
+    assert srl_upgrade.split_gnmi_path('/interface[name=ethernet-1/1]/srl_nokia-if:subinterface[index=0]/') == [
+        ('interface', {'name' : 'ethernet-1/1'}), ('subinterface', {'index' : '0'})]
+    assert srl_upgrade.split_gnmi_path('') == []
+
+@pytest.mark.parametrize('requested, update, matches', [
+    ('/interface/', 'interface[name=ethernet-1/1]/oper-state', True),
+    ('/network-instance[name=default]/protocols/bgp/neighbor', 'network-instance[name=default]/protocols/bgp/neighbor[peer-address=10.0.0.1]', True),
+    ('/network-instance[name=default]/protocols/bgp/neighbor', 'network-instance[name=mac-vrf-1]/protocols/bgp/neighbor', False),
+    ('/interface[name=*]/oper-state', 'interface[name=ethernet-1/1]/oper-state', True),
+    ('/platform/fan-tray', 'platform', False),
+])
+def test_gnmi_path_matches(requested, update, matches):
+    assert srl_upgrade.gnmi_path_matches(requested, update) is matches
+
+def test_demux_takes_the_most_specific_path():
+    paths = [srl_upgrade.COLLECTION_PATHS['network-instance'], srl_upgrade.COLLECTION_PATHS['bgp']]
+    raw_data = {'notification' : [{'update' : [
+        {'path' : 'network-instance[name=default]/protocols/bgp/neighbor[peer-address=10.0.0.1]', 'val' : {'session-state' : 'established'}},
+        {'path' : 'network-instance[name=mac-vrf-1]', 'val' : {'type' : 'mac-vrf'}},
+    ]}]}
+    demuxed = srl_upgrade.demux_gnmi_result(raw_data, paths)
+    assert [update['path'] for update in demuxed[paths[0]]['notification'][0]['update']] == ['network-instance[name=mac-vrf-1]']
+    assert [update['path'] for update in demuxed[paths[1]]['notification'][0]['update']] == ['network-instance[name=default]/protocols/bgp/neighbor[peer-address=10.0.0.1]']
+
+def test_group_gnmi_paths():
+    assert srl_upgrade.group_gnmi_paths(['a', 'b', 'c'], 0) == [['a', 'b', 'c']]
+    assert srl_upgrade.group_gnmi_paths(['a', 'b', 'c'], 2) == [['a', 'b'], ['c']]
+
+@pytest.mark.parametrize('batch, batch_size, gets', [
+    (False, 0, len(srl_upgrade.COLLECTION_PATHS)),
+    (True, 0, 1),
+    (True, 4, 3),
+])
+def test_batched_collection(fake_tor, batch, batch_size, gets):
+    #Same sections whether the paths go in one get, a few, or one each
+    target, session = fake_tor(synthetic_state('v23'))
+    tor_data = srl_upgrade.collect_tor_data(session, HOSTNAME, batch, batch_size)
+    assert target.stats['get']['calls'] == gets
+    assert target.stats['get']['paths'] == len(srl_upgrade.COLLECTION_PATHS)
+    assert tor_data == srl_upgrade.collect_tor_data(fake_tor(synthetic_state('v23'))[1], HOSTNAME)
@@ -0,0 +1,45 @@
+import json
+import os
+import time
+
+import srl_upgrade
+from conftest import HOSTNAME, synthetic_state
+
+OPTIONS = {'batch' : False, 'batch_size' : 0, 'pruned' : False, 'flap_window' : 0.2, 'flap_sample_interval' : 0.1}
+
+def test_checkpoint_round_trip(workdir):
+    srl_upgrade.save_checkpoint('checkpoint', 'version', {HOSTNAME : '23.10.1'})
+    srl_upgrade.save_checkpoint('checkpoint', 'app', {HOSTNAME : {'mgmt_server' : 'running'}})
+    assert srl_upgrade.load_checkpoint('checkpoint', 60) == {'app' : {HOSTNAME : {'mgmt_server' : 'running'}}, 'version' : {HOSTNAME : '23.10.1'}}
+    assert not [file_name for file_name in os.listdir('checkpoint') if file_name.endswith('.tmp')]
+
+def test_stale_and_corrupt_checkpoints_are_skipped(workdir):
+    srl_upgrade.save_checkpoint('checkpoint', 'version', {HOSTNAME : '23.10.1'})
+    srl_upgrade.save_checkpoint('checkpoint', 'app', {HOSTNAME : {'mgmt_server' : 'running'}})
+    with open('checkpoint/app.json') as infile:
+        checkpoint = json.load(infile)
+    checkpoint['collected'] = time.time() - 120
+    with open('checkpoint/app.json', 'w') as outfile:
+        json.dump(checkpoint, outfile)
+    #A run killed mid write before the rename existed
+    with open('checkpoint/bgp.json', 'w') as outfile:
+        outfile.write('{"collected": ')
+    assert srl_upgrade.load_checkpoint('checkpoint', 60) == {'version' : {HOSTNAME : '23.10.1'}}
+    assert srl_upgrade.load_checkpoint('missing', 60) == {}
+
+def test_resume_reuses_the_checkpointed_sections(fake_tor, workdir):
+    target, session = fake_tor(synthetic_state('v23'))
+    tor_data = srl_upgrade.collect_and_check(session, HOSTNAME, 'precheck', OPTIONS)
+    gets = target.stats['get']['calls']
+    #Drop a few sections as if the first run failed before fetching them
+    for section in ['mac', 'arp', 'port', 'port-shutdown']:
+        os.remove(srl_upgrade.checkpoint_dir_name(HOSTNAME, 'before') + '/' + section + '.json')
+    resumed = srl_upgrade.collect_and_check(session, HOSTNAME, 'precheck', dict(OPTIONS, resume=True))
+    assert resumed == json.loads(json.dumps(tor_data))
+    assert 0 < target.stats['get']['calls'] - gets < gets
+    assert target.stats['subscribe']['calls'] == 2
+
+def test_resume_without_a_checkpoint_collects_everything(fake_tor, workdir):
+    target, session = fake_tor(synthetic_state('v23'))
+    srl_upgrade.collect_and_check(session, HOSTNAME, 'precheck', dict(OPTIONS, resume=True, resume_max_age=60))
+    assert target.stats['get']['calls'] > len(srl_upgrade.COLLECTION_PATHS)
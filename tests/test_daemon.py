@@ -0,0 +1,80 @@
+import threading
+
+import srl_daemon
+import pytest
+from conftest import HOSTNAME, synthetic_state
+
+OPTIONS = {'batch' : False, 'batch_size' : 0, 'pruned' : False, 'flap_window' : 0.2, 'flap_sample_interval' : 0.1,
+           'save_format' : 'json', 'snapshot_encoding' : 'json', 'history_db' : None}
+
+@pytest.fixture
+def daemon(fake_tor, workdir):
+    #The daemon state start_daemon builds, with one TOR on a fake target and no health checker or compare pool
+    def start(state):
+        target, session = fake_tor(state)
+        tor = {'device' : {'hostname' : HOSTNAME, 'ip' : '127.0.0.1'}, 'session' : session, 'lock' : threading.Lock(),
+               'health' : {'ok' : None, 'checked' : None, 'latency' : None, 'version' : None, 'error' : None}, 'state' : None}
+        return target, {'tors' : {HOSTNAME : tor}, 'options' : OPTIONS, 'approvals' : {'enter_maint_mode' : 'approve', 'shutdown_ports' : 'approve'},
+                        'atomic_maint' : True, 'set_chunk_size' : 0, 'started' : None, 'started_time' : 0}
+    return start
+
+@pytest.mark.parametrize('approvals, requested, narrowed', [
+    #Nobody answers prompts on the daemon
+    (None, None, {'enter_maint_mode' : 'deny', 'shutdown_ports' : 'deny', 'exit_maint_mode' : 'deny'}),
+    ({'enter_maint_mode' : 'approve', 'shutdown_ports' : 'prompt', 'exit_maint_mode' : 'approve'}, None,
+     {'enter_maint_mode' : 'approve', 'shutdown_ports' : 'deny', 'exit_maint_mode' : 'approve'}),
+    #A request can deny what the daemon approves, but not approve what it denies or leaves to a prompt
+    ({'enter_maint_mode' : 'approve', 'shutdown_ports' : 'approve', 'exit_maint_mode' : 'deny'},
+     {'enter_maint_mode' : 'deny', 'shutdown_ports' : 'approve', 'exit_maint_mode' : 'approve'},
+     {'enter_maint_mode' : 'deny', 'shutdown_ports' : 'approve', 'exit_maint_mode' : 'deny'}),
+    ({'enter_maint_mode' : 'approve', 'shutdown_ports' : 'approve', 'exit_maint_mode' : 'approve'},
+     {'enter_maint_mode' : 'prompt'},
+     {'enter_maint_mode' : 'deny', 'shutdown_ports' : 'approve', 'exit_maint_mode' : 'approve'}),
+    #max_shutdown_ports can only be lowered
+    ({'shutdown_ports' : 'approve', 'max_shutdown_ports' : 10}, {'max_shutdown_ports' : 50},
+     {'enter_maint_mode' : 'deny', 'shutdown_ports' : 'approve', 'exit_maint_mode' : 'deny', 'max_shutdown_ports' : 10}),
+    ({'shutdown_ports' : 'approve', 'max_shutdown_ports' : 10}, {'max_shutdown_ports' : 4},
+     {'enter_maint_mode' : 'deny', 'shutdown_ports' : 'approve', 'exit_maint_mode' : 'deny', 'max_shutdown_ports' : 4}),
+    ({'shutdown_ports' : 'approve'}, {'max_shutdown_ports' : '4'},
+     {'enter_maint_mode' : 'deny', 'shutdown_ports' : 'approve', 'exit_maint_mode' : 'deny', 'max_shutdown_ports' : 4}),
+])
+def test_daemon_approvals_only_narrow(approvals, requested, narrowed):
+    assert srl_daemon.daemon_approvals(approvals, requested) == narrowed
+
+def test_pre_check_with_drain(daemon):
+    state = synthetic_state('v23')
+    target, daemon = daemon(state)
+    status, response = srl_daemon.handle_request(daemon, 'POST', '/devices/' + HOSTNAME + '/pre_check', {}, {'drain' : True})
+    assert status == 200
+    assert response['ok'] and response['maint_mode'] and response['ports_shut']
+    assert response['port_shutdown'] == ['ethernet-1/1', 'ethernet-1/2', 'ethernet-1/3']
+    assert target.stats['set']['calls'] == 1
+    status, response = srl_daemon.handle_request(daemon, 'GET', '/devices/' + HOSTNAME + '/state', {'section' : ['version']}, {})
+    assert status == 200 and response['phase'] == 'before' and list(response['sections']) == ['version']
+
+def test_request_approvals_narrow_the_drain(daemon):
+    state = synthetic_state('v23')
+    target, daemon = daemon(state)
+    status, response = srl_daemon.handle_request(daemon, 'POST', '/devices/' + HOSTNAME + '/pre_check', {},
+                                                 {'drain' : True, 'approvals' : {'shutdown_ports' : 'deny'}})
+    assert status == 200
+    assert response['maint_mode'] and not response['ports_shut'] and not response['ok']
+    assert not [interface for interface in state['interface'] if interface.get('admin-state') == 'disable']
+
+def test_routes(daemon):
+    target, daemon = daemon(synthetic_state('v23'))
+    assert srl_daemon.handle_request(daemon, 'POST', '/devices/leaf9/pre_check', {}, {})[0] == 404
+    assert srl_daemon.handle_request(daemon, 'GET', '/devices/' + HOSTNAME + '/state', {}, {})[0] == 404
+    assert srl_daemon.handle_request(daemon, 'DELETE', '/devices/' + HOSTNAME + '/pre_check', {}, {})[0] == 404
+    #One request per TOR at a time
+    with daemon['tors'][HOSTNAME]['lock']:
+        assert srl_daemon.handle_request(daemon, 'POST', '/devices/' + HOSTNAME + '/compare', {}, {})[0] == 409
+
+def test_health_check_over_the_warm_session(daemon):
+    target, daemon = daemon(synthetic_state('v23'))
+    tor = daemon['tors'][HOSTNAME]
+    srl_daemon.check_health(tor, OPTIONS)
+    assert tor['health']['ok'] and tor['health']['version']
+    assert target.stats['capabilities']['calls'] == 1
+    status, response = srl_daemon.handle_request(daemon, 'GET', '/health', {}, {})
+    assert response['devices'][HOSTNAME]['ok']
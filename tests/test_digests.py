@@ -0,0 +1,54 @@
+import copy
+import os
+
+import srl_upgrade
+import pytest
+from conftest import HOSTNAME, synthetic_state
+
+@pytest.fixture
+def tor_data(fake_tor):
+    target, session = fake_tor(synthetic_state('v23'))
+    return srl_upgrade.collect_tor_data(session, HOSTNAME)
+
+def save_pair(tor_data, after_data, save_format):
+    srl_upgrade.save_data(tor_data, HOSTNAME, 'precheck', save_format)
+    srl_upgrade.save_data(after_data, HOSTNAME, 'postcheck', save_format)
+
+def test_section_digests(tor_data):
+    digests = srl_upgrade.section_digests({'version' : tor_data['version'], 'bgp' : tor_data['bgp']}, HOSTNAME)
+    assert 'children' not in digests['version']
+    assert sorted(digests['bgp']['children']) == sorted(tor_data['bgp'][HOSTNAME])
+    #The section digest is a digest of its children's digests, so it changes with any child
+    changed = copy.deepcopy(tor_data['bgp'])
+    peer = sorted(changed[HOSTNAME])[0]
+    changed[HOSTNAME][peer]['session-state'] = 'idle'
+    changed_digests = srl_upgrade.section_digests({'bgp' : changed}, HOSTNAME)
+    assert changed_digests['bgp']['digest'] != digests['bgp']['digest']
+    assert [child for child in digests['bgp']['children'] if digests['bgp']['children'][child] != changed_digests['bgp']['children'][child]] == [peer]
+
+@pytest.mark.parametrize('save_format', ['json', 'snapshot'])
+def test_unchanged_section_is_loaded_once(workdir, tor_data, save_format):
+    save_pair(tor_data, tor_data, save_format)
+    before, after = srl_upgrade.load_section_pair(HOSTNAME, 'version')
+    assert before is after
+    assert before == tor_data['version']
+
+@pytest.mark.parametrize('save_format', ['json', 'snapshot'])
+def test_subtree_section_loads_only_the_changed_children(workdir, tor_data, save_format):
+    after_data = copy.deepcopy(tor_data)
+    peer = sorted(after_data['bgp'][HOSTNAME])[0]
+    after_data['bgp'][HOSTNAME][peer]['session-state'] = 'idle'
+    save_pair(tor_data, after_data, save_format)
+    before, after = srl_upgrade.load_section_pair(HOSTNAME, 'bgp')
+    assert list(before[HOSTNAME]) == list(after[HOSTNAME]) == [peer]
+    assert after[HOSTNAME][peer]['session-state'] == 'idle'
+    #Nothing changed in the interfaces, nothing is loaded
+    assert srl_upgrade.load_section_pair(HOSTNAME, 'interface') == ({HOSTNAME : {}}, {HOSTNAME : {}})
+
+def test_no_digests_loads_both_sides(workdir, tor_data):
+    #Checks saved before digests were have no digests file
+    save_pair(tor_data, tor_data, 'json')
+    os.remove(HOSTNAME + '-before/' + HOSTNAME + '-digests.json')
+    before, after = srl_upgrade.load_section_pair(HOSTNAME, 'bgp')
+    assert before is not after
+    assert before == after == tor_data['bgp']
@@ -0,0 +1,89 @@
+import copy
+import json
+import os
+
+import srl_upgrade
+import pytest
+from conftest import DATA_DIR, HOSTNAME, synthetic_state
+
+#data/sections-<layout>.json holds the raw data of every collection path fetched from synthetic_state(layout) and the
+#sections the parse_* functions made of it before they were replaced by the extraction specs. The specs have to give
+#the same sections for the same data
+
+LAYOUTS = ['v22', 'v23']
+
+def load_fixture(layout):
+    with open(os.path.join(DATA_DIR, 'sections-' + layout + '.json')) as infile:
+        return json.load(infile)
+
+def as_saved(data):
+    #Sections are compared the way they are saved, with the int keys (fan ids, slots) turned into strings
+    return json.loads(json.dumps(data))
+
+@pytest.mark.parametrize('layout', LAYOUTS)
+@pytest.mark.parametrize('section', list(srl_upgrade.SECTION_SOURCES))
+def test_specs_match_old_parsers(layout, section):
+    fixture = load_fixture(layout)
+    version = fixture['expected']['version'][HOSTNAME]
+    #The mac and arp specs consume the raw data they walk
+    raw_data = copy.deepcopy(fixture['raw'][srl_upgrade.SECTION_SOURCES[section]])
+    extracted = srl_upgrade.extract_section(section, raw_data, HOSTNAME, None if section == 'version' else version)
+    assert as_saved(extracted) == fixture['expected'][section]
+
+@pytest.mark.parametrize('layout', LAYOUTS)
+def test_extract_sections_shares_one_walk(layout):
+    fixture = load_fixture(layout)
+    specs = srl_upgrade.EXTRACTION_SPECS[layout]
+    for source in ['network-instance', 'interface']:
+        sections = [section for section, section_source in srl_upgrade.SECTION_SOURCES.items() if section_source == source]
+        extracted = srl_upgrade.extract_sections(copy.deepcopy(fixture['raw'][source]), HOSTNAME, {section : specs[section] for section in sections})
+        assert {section : as_saved(extracted[section]) for section in sections} == {section : fixture['expected'][section] for section in sections}
+
+@pytest.mark.parametrize('version, release', [
+    ('v22.11.2-74-g39f3b1b9b7', 'v22'),
+    ('v23.10.1-218-ga3fc1bea5a', 'v23'),
+    ('v24.3.1', 'v23'),
+    (None, 'v23'),
+])
+def test_select_release(version, release):
+    assert srl_upgrade.select_release(version) == release
+
+def test_legacy_parser_wrappers():
+    fixture = load_fixture('v22')
+    assert as_saved(srl_upgrade.parse_bgp_gnmi_v22(copy.deepcopy(fixture['raw']['bgp']), HOSTNAME)) == fixture['expected']['bgp']
+    assert as_saved(srl_upgrade.parse_mac_information(copy.deepcopy(fixture['raw']['network-instance']), HOSTNAME)) == fixture['expected']['mac']
+    assert as_saved(srl_upgrade.parse_arp_status(copy.deepcopy(fixture['raw']['interface']), HOSTNAME)) == fixture['expected']['arp']
+
+def test_mac_vrf_without_bridge_table():
+    raw_data = [
+        {'name' : 'mac-vrf-1', 'type' : 'mac-vrf', 'bridge-table' : {'mac-learning' : {'learnt-entries' : {'mac' : [
+            {'address' : '00:00:00:00:00:01', 'destination' : 'ethernet-1/1.0'}]}}}},
+        {'name' : 'mac-vrf-new', 'type' : 'mac-vrf'},
+        {'name' : 'ip-vrf-1', 'type' : 'ip-vrf'},
+    ]
+    assert srl_upgrade.parse_mac_information(raw_data, HOSTNAME) == {HOSTNAME : {'mac-vrf-1' : {'00:00:00:00:00:01' : 'ethernet-1/1.0'}}}
+
+def test_arp_keeps_dynamic_entries_off_mgmt():
+    raw_data = [
+        {'name' : 'mgmt0', 'subinterface' : [{'name' : 'mgmt0.0', 'ipv4' : {'arp' : {'neighbor' : [
+            {'ipv4-address' : '172.16.0.1', 'link-layer-address' : '00:00:00:00:00:aa', 'origin' : 'dynamic'}]}}}]},
+        {'name' : 'ethernet-1/1', 'subinterface' : [{'name' : 'ethernet-1/1.0', 'ipv4' : {'arp' : {'neighbor' : [
+            {'ipv4-address' : '10.0.0.1', 'link-layer-address' : '00:00:00:00:00:01', 'origin' : 'dynamic'},
+            {'ipv4-address' : '10.0.0.2', 'link-layer-address' : '00:00:00:00:00:02', 'origin' : 'evpn'}]}}}]},
+    ]
+    #Like the old parser, a subinterface with neighbors gets a group even when none of them are saved
+    assert srl_upgrade.parse_arp_status(raw_data, HOSTNAME) == {HOSTNAME : {'mgmt0.0' : {}, 'ethernet-1/1.0' : {'10.0.0.1' : '00:00:00:00:00:01'}}}
+
+@pytest.mark.parametrize('layout', LAYOUTS)
+@pytest.mark.parametrize('mode', [
+    {},
+    {'batch' : True},
+    {'pruned' : True},
+    {'batch' : True, 'pruned' : True},
+    {'fetch_workers' : 4},
+])
+def test_collect_from_fake_target(fake_tor, layout, mode):
+    target, session = fake_tor(synthetic_state(layout))
+    tor_data = srl_upgrade.collect_tor_data(session, HOSTNAME, mode.get('batch', False), 0, mode.get('pruned', False), fetch_workers=mode.get('fetch_workers', 1))
+    expected = load_fixture(layout)['expected']
+    assert {section : as_saved(tor_data[section]) for section in expected} == expected
@@ -0,0 +1,34 @@
+import time
+
+import srl_upgrade
+import pytest
+from conftest import HOSTNAME, synthetic_state
+
+@pytest.mark.parametrize('port, skipped', [
+    ('system0', True),
+    ('lo0', True),
+    ('irb1', True),
+    ('ethernet-1/1', False),
+    #Only whole names are skipped, not ports that happen to contain one
+    ('ethernet-1/1-lo0', False),
+    ('irb', False),
+])
+def test_no_stats_interfaces(port, skipped):
+    assert bool(srl_upgrade.NO_STATS_INTERFACES.fullmatch(port)) is skipped
+
+def test_clean_ports_are_watched_for_the_whole_window(fake_tor):
+    target, session = fake_tor(synthetic_state('v23'))
+    start = time.time()
+    port_status = srl_upgrade.check_bouncing_ports(session, HOSTNAME, 1, 0.2)
+    assert time.time() - start >= 1
+    assert sorted(port_status[HOSTNAME]) == ['ethernet-1/' + str(port) for port in range(1, 8)]
+    assert not any(status['port_issues'] or status['transitions'] for status in port_status[HOSTNAME].values())
+
+def test_flapping_port_ends_the_check_early(fake_tor):
+    target, session = fake_tor(synthetic_state('v23'), flap_ports=['ethernet-1/2'], flap_interval=0.3)
+    start = time.time()
+    port_status = srl_upgrade.check_bouncing_ports(session, HOSTNAME, 20, 0.2)
+    assert time.time() - start < 10
+    assert port_status[HOSTNAME]['ethernet-1/2']['port_issues']
+    assert port_status[HOSTNAME]['ethernet-1/2']['transitions'][0]['leaf'] in srl_upgrade.FLAP_CHECK_LEAVES
+    assert not port_status[HOSTNAME]['ethernet-1/1']['port_issues']
@@ -0,0 +1,70 @@
+import copy
+import json
+import os
+
+import srl_history
+import srl_upgrade
+import pytest
+from conftest import DATA_DIR, HOSTNAME
+
+def saved_sections():
+    with open(os.path.join(DATA_DIR, 'sections-v23.json')) as infile:
+        return json.load(infile)['expected']
+
+@pytest.fixture
+def history(workdir):
+    #Two runs of leaf1 and one of leaf2. Between the leaf1 runs a mac is lost, one moves and a bgp peer goes down
+    before = saved_sections()
+    after = copy.deepcopy(before)
+    del after['mac'][HOSTNAME]['mac-vrf-1']['00:00:00:00:00:01']
+    after['mac'][HOSTNAME]['mac-vrf-2']['00:00:00:00:00:05'] = 'ethernet-1/3.0'
+    after['bgp'][HOSTNAME]['10.0.0.1']['session-state'] = 'active'
+    history_db = str(workdir / 'history.db')
+    srl_upgrade.save_data(before, HOSTNAME, 'precheck', history_db=history_db)
+    srl_upgrade.save_data(after, HOSTNAME, 'postcheck', history_db=history_db)
+    other = {section : {'leaf2' : data[HOSTNAME]} for section, data in before.items()}
+    srl_upgrade.save_data(other, 'leaf2', 'precheck', history_db=history_db)
+    connection = srl_upgrade.open_history(history_db)
+    yield connection
+    connection.close()
+
+def test_list_runs(history):
+    assert [(run['run_id'], run['hostname'], run['phase']) for run in srl_history.list_runs(history)] == [(3, 'leaf2', 'before'), (2, HOSTNAME, 'after'), (1, HOSTNAME, 'before')]
+    assert [run['run_id'] for run in srl_history.list_runs(history, HOSTNAME, 1)] == [2]
+    assert srl_history.run_info(history, 1)['version'] == saved_sections()['version'][HOSTNAME]
+    with pytest.raises(SystemExit):
+        srl_history.run_info(history, 99)
+
+def test_diff_runs(history):
+    diffs = srl_history.diff_runs(history, 1, 2)
+    assert diffs['mac'] == {
+        'removed' : [('mac-vrf-1', '00:00:00:00:00:01', 'ethernet-1/1.0')],
+        'added' : [],
+        'changed' : [(('mac-vrf-2', '00:00:00:00:00:05'), ('ethernet-1/1.0',), ('ethernet-1/3.0',))],
+    }
+    assert diffs['bgp']['changed'] == [(('10.0.0.1',), ('established', 1000, 100, 50), ('active', 1000, 100, 50))]
+    assert diffs['bgp']['added'] == diffs['bgp']['removed'] == []
+    for section in ['version', 'app', 'arp', 'interface', 'fan', 'tunnel']:
+        assert diffs[section] is None
+    #The subtree digests leave the hostname out, so another TOR with the same tables matches
+    assert srl_history.diff_runs(history, 1, 3, srl_upgrade.DIGEST_SUBTREE_SECTIONS) == {section : None for section in srl_upgrade.DIGEST_SUBTREE_SECTIONS}
+
+def test_lost_and_find_entries(history):
+    assert srl_history.lost_entries(history, 'mac', '00:00:00:00:00:01') == [(HOSTNAME, 1, 2, 'mac-vrf-1', '00:00:00:00:00:01', 'ethernet-1/1.0')]
+    assert srl_history.lost_entries(history, 'mac', '00:00:00:00:00:05') == []
+    assert srl_history.find_entries(history, 'mac', '00:00:00:00:00:05') == [
+        (HOSTNAME, 2, 'mac-vrf-2', '00:00:00:00:00:05', 'ethernet-1/3.0'),
+        ('leaf2', 3, 'mac-vrf-2', '00:00:00:00:00:05', 'ethernet-1/1.0'),
+    ]
+    assert srl_history.find_entries(history, 'mac', '00:00:00:00:00:01') == [('leaf2', 3, 'mac-vrf-1', '00:00:00:00:00:01', 'ethernet-1/1.0')]
+    assert srl_history.find_entries(history, 'arp', '10.0.0.3') == [
+        (HOSTNAME, 2, 'ethernet-1/2.1', '10.0.0.3', '00:00:00:00:00:03'),
+        ('leaf2', 3, 'ethernet-1/2.1', '10.0.0.3', '00:00:00:00:00:03'),
+    ]
+
+def test_history_failure_keeps_the_saved_files(workdir, capsys):
+    #A history that cannot be opened only warns, the json files the compare reads are still written
+    os.mkdir('history.db')
+    srl_upgrade.save_data(saved_sections(), HOSTNAME, 'precheck', history_db='history.db')
+    assert 'Could not add the before check of ' + HOSTNAME in capsys.readouterr().out
+    assert srl_upgrade.load_section(HOSTNAME, 'before', 'mac') == saved_sections()['mac']
@@ -0,0 +1,39 @@
+import json
+import os
+
+import srl_upgrade
+from conftest import HOSTNAME
+
+def test_keyed_table_folds_lists():
+    table = {'mac-vrf-1' : [{'00:00:00:00:00:01' : 'ethernet-1/1.0'}, {'00:00:00:00:00:02' : 'ethernet-1/2.0'}], 'mac-vrf-2' : {'00:00:00:00:00:03' : 'ethernet-1/3.0'}}
+    assert srl_upgrade.keyed_table(table) == {'mac-vrf-1' : {'00:00:00:00:00:01' : 'ethernet-1/1.0', '00:00:00:00:00:02' : 'ethernet-1/2.0'},
+                                              'mac-vrf-2' : {'00:00:00:00:00:03' : 'ethernet-1/3.0'}}
+
+def test_diff_keyed_table():
+    before = {'mac-vrf-1' : {'00:00:00:00:00:01' : 'ethernet-1/1.0', '00:00:00:00:00:02' : 'ethernet-1/2.0'}, 'mac-vrf-2' : {'00:00:00:00:00:03' : 'ethernet-1/3.0'}}
+    after = {'mac-vrf-1' : {'00:00:00:00:00:01' : 'ethernet-1/3.0', '00:00:00:00:00:04' : 'ethernet-1/1.0'}, 'mac-vrf-2' : {'00:00:00:00:00:03' : 'ethernet-1/3.0'}}
+    assert srl_upgrade.diff_keyed_table(before, after) == {
+        'added' : {'mac-vrf-1' : {'00:00:00:00:00:04' : 'ethernet-1/1.0'}},
+        'removed' : {'mac-vrf-1' : {'00:00:00:00:00:02' : 'ethernet-1/2.0'}},
+        'moved' : {'mac-vrf-1' : {'00:00:00:00:00:01' : ('ethernet-1/1.0', 'ethernet-1/3.0')}},
+        'counts' : {'mac-vrf-1' : {'added' : 1, 'removed' : 1, 'moved' : 1}},
+    }
+
+def test_diff_keyed_table_group_only_on_one_side():
+    table_diff = srl_upgrade.diff_keyed_table({'ethernet-1/1.0' : {'10.0.0.1' : 'aa'}}, {'ethernet-1/2.0' : {'10.0.0.1' : 'aa'}}, 'ipv4')
+    assert table_diff['removed'] == {'ethernet-1/1.0' : {'10.0.0.1' : 'aa'}}
+    assert table_diff['added'] == {'ethernet-1/2.0' : {'10.0.0.1' : 'aa'}}
+
+def test_compare_mac_against_a_list_format_pre_check(workdir):
+    #A pre check saved by an older version of the script, with each mac-vrf a list of single entry dicts
+    for phase, table in [('before', {'mac-vrf-1' : [{'00:00:00:00:00:01' : 'ethernet-1/1.0'}, {'00:00:00:00:00:02' : 'ethernet-1/2.0'}]}),
+                         ('after', {'mac-vrf-1' : {'00:00:00:00:00:01' : 'ethernet-1/2.0'}})]:
+        os.mkdir(HOSTNAME + '-' + phase)
+        with open(HOSTNAME + '-' + phase + '/' + HOSTNAME + srl_upgrade.SAVED_SECTIONS['mac'][0] + '.json', 'w') as outfile:
+            json.dump({HOSTNAME : table}, outfile)
+    result = srl_upgrade.compare_mac(HOSTNAME)
+    assert [group['counts'] for group in result['groups']] == [{'added' : 0, 'removed' : 1, 'moved' : 1}]
+    assert result['groups'][0]['entries'] == [
+        {'change' : 'removed', 'key' : '00:00:00:00:00:02', 'value' : 'ethernet-1/2.0'},
+        {'change' : 'moved', 'key' : '00:00:00:00:00:01', 'before' : 'ethernet-1/1.0', 'after' : 'ethernet-1/2.0'},
+    ]
@@ -0,0 +1,78 @@
+import srl_upgrade
+import pytest
+
+#Groups big enough to take the packed path, with entries removed, added and moved between the before and after tables
+ENTRIES = srl_upgrade.PACKED_DIFF_MIN_ENTRIES + 200
+
+def mac_address(number, upper=False):
+    address = ':'.join('{:02x}'.format(octet) for octet in number.to_bytes(6, 'big'))
+    return address.upper() if upper else address
+
+def ipv4_address(number):
+    return '.'.join(str(octet) for octet in number.to_bytes(4, 'big'))
+
+def churned_tables(make_key, values):
+    before = {make_key(number) : values[number % len(values)] for number in range(ENTRIES)}
+    after = dict(before)
+    for number in range(0, 100):
+        del after[make_key(number)]
+    for number in range(ENTRIES, ENTRIES + 150):
+        after[make_key(number)] = values[0]
+    for number in range(500, 600):
+        after[make_key(number)] = 'moved-' + before[make_key(number)]
+    return before, after
+
+def set_diff(before, after):
+    #The string set diff the packed path has to agree with
+    added = {key : after[key] for key in after.keys() - before.keys()}
+    removed = {key : before[key] for key in before.keys() - after.keys()}
+    moved = {key : (before[key], after[key]) for key in before.keys() & after.keys() if before[key] != after[key]}
+    return added, removed, moved
+
+@pytest.mark.parametrize('key_type, make_key, values', [
+    ('mac', mac_address, ['ethernet-1/1.0', 'ethernet-1/2.0', 'vxlan1.1']),
+    ('mac', lambda number: mac_address(number, True), ['ethernet-1/1.0', 'ethernet-1/2.0']),
+    ('ipv4', ipv4_address, ['00:00:00:00:00:01', '00:00:00:00:00:02']),
+])
+def test_packed_diff_matches_set_diff(key_type, make_key, values):
+    pytest.importorskip('numpy')
+    before, after = churned_tables(make_key, values)
+    assert srl_upgrade.diff_packed_group(before, after, key_type) == set_diff(before, after)
+    table_diff = srl_upgrade.diff_keyed_table({'group' : before}, {'group' : after}, key_type)
+    assert table_diff['counts'] == {'group' : {'added' : 150, 'removed' : 100, 'moved' : 100}}
+
+@pytest.mark.parametrize('key_type, before_key, after_key', [
+    #Mixed case in one table, and a different case in each table
+    ('mac', 'aa:00:00:00:00:01', 'AA:00:00:00:00:0b'),
+    ('mac', 'aa:00:00:00:00:01', 'AA:00:00:00:00:01'),
+    #Shorthand and leading zeros pack to the same integer as the canonical address
+    ('ipv4', '10.0.0.1', '10.1'),
+    ('ipv4', '10.0.0.1', '010.0.0.1'),
+    ('ipv4', '10.0.0.1', 'not-an-address'),
+])
+def test_non_canonical_keys_fall_back_to_set_diff(key_type, before_key, after_key):
+    pytest.importorskip('numpy')
+    make_key = mac_address if key_type == 'mac' else ipv4_address
+    before, after = churned_tables(make_key, ['a', 'b'])
+    before[before_key] = 'a'
+    after[after_key] = 'a'
+    if key_type == 'mac' and before_key.lower() == after_key.lower():
+        #Every key of the after table in the other case
+        after = {key.upper() : value for key, value in after.items()}
+    assert srl_upgrade.diff_packed_group(before, after, key_type) is None
+    table_diff = srl_upgrade.diff_keyed_table({'group' : before}, {'group' : after}, key_type)
+    added, removed, moved = set_diff(before, after)
+    assert table_diff['added'].get('group', {}) == added
+    assert table_diff['removed'].get('group', {}) == removed
+    assert table_diff['moved'].get('group', {}) == moved
+
+def test_pack_keys_round_trip():
+    pytest.importorskip('numpy')
+    keys = ['00:00:00:00:00:02', 'ff:ff:ff:ff:ff:ff', '00:00:00:00:00:01']
+    packed, order, letter_case = srl_upgrade.pack_keys(keys, 'mac')
+    assert list(packed) == [1, 2, 0xffffffffffff]
+    assert [keys[index] for index in order] == sorted(keys)
+    assert letter_case == 'lower'
+    assert srl_upgrade.pack_keys(['00-00-00-00-00-01'], 'mac') is None
+    assert list(srl_upgrade.pack_keys(['10.0.0.1', '1.2.3.4'], 'ipv4')[0]) == [0x01020304, 0x0a000001]
+    assert srl_upgrade.pack_keys(['10.0.0.1'], 'ipv6') is None
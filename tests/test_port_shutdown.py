@@ -0,0 +1,51 @@
+import srl_upgrade
+import pytest
+from conftest import HOSTNAME, synthetic_state
+
+PORTS = {HOSTNAME : ['ethernet-1/1', 'ethernet-1/2', 'ethernet-1/3']}
+
+def admin_states(state):
+    return {interface['name'] : interface.get('admin-state', 'enable') for interface in state['interface'] if interface['name'] in PORTS[HOSTNAME]}
+
+def maint_mode(state):
+    return state['system']['maintenance']['group'][0]['maintenance-mode']['admin-state']
+
+@pytest.fixture
+def answer_yes(monkeypatch):
+    monkeypatch.setattr('builtins.input', lambda question: 'Y')
+
+@pytest.mark.parametrize('chunk_size, sets', [(0, 1), (2, 2)])
+def test_drain_in_one_set(fake_tor, answer_yes, chunk_size, sets):
+    #bgp maint mode and every port shutdown go out in one set, so the TOR commits them together
+    state = synthetic_state('v23')
+    target, session = fake_tor(state)
+    maint_update = srl_upgrade.enter_bgp_maint_mode(session, False)
+    assert target.stats['set']['calls'] == 0
+    assert srl_upgrade.shutdown_access_ports(PORTS, session, HOSTNAME, [maint_update], chunk_size)
+    assert target.stats['set']['calls'] == sets
+    assert target.stats['set']['paths'] == 4
+    assert maint_mode(state) == 'enable'
+    assert set(admin_states(state).values()) == {'disable'}
+
+def test_denied_shutdown_still_sends_the_maint_mode(fake_tor, monkeypatch):
+    state = synthetic_state('v23')
+    target, session = fake_tor(state)
+    answers = iter(['Y', 'N'])
+    monkeypatch.setattr('builtins.input', lambda question: next(answers))
+    maint_update = srl_upgrade.enter_bgp_maint_mode(session, False)
+    assert not srl_upgrade.shutdown_access_ports(PORTS, session, HOSTNAME, [maint_update])
+    assert target.stats['set']['calls'] == 1
+    assert maint_mode(state) == 'enable'
+    assert set(admin_states(state).values()) == {'enable'}
+
+def test_restore_in_one_set(fake_tor, workdir, answer_yes):
+    #The ports saved by the pre check are enabled together with the exit from maint mode
+    state = synthetic_state('v23')
+    target, session = fake_tor(state)
+    srl_upgrade.save_data({'port-shutdown' : PORTS}, HOSTNAME, 'precheck')
+    srl_upgrade.shutdown_access_ports(PORTS, session, HOSTNAME, [srl_upgrade.enter_bgp_maint_mode(session, False)])
+    maint_update = srl_upgrade.exit_bgp_maint_mode(session, False)
+    srl_upgrade.no_shutdown_access_ports(session, HOSTNAME, [maint_update])
+    assert target.stats['set']['calls'] == 2
+    assert maint_mode(state) == 'disable'
+    assert set(admin_states(state).values()) == {'enable'}
@@ -0,0 +1,110 @@
+import time
+
+import grpc
+import srl_fake_target
+import srl_upgrade
+import pytest
+from conftest import HOSTNAME, synthetic_state
+
+VERSION_PATH = srl_upgrade.COLLECTION_PATHS['version']
+SHUTDOWN_UPDATE = ('/interface[name=ethernet-1/1]', {'admin-state' : 'disable'})
+
+def failing(monkeypatch, rpc, failures, code=grpc.StatusCode.UNAVAILABLE):
+    #The first failures calls of rpc are aborted with code, the calls after them are served
+    original = srl_fake_target.FakeTarget.delay_or_fail
+    failed = []
+    def delay_or_fail(self, called, context, paths=0):
+        original(self, called, context, paths)
+        if called == rpc and len(failed) < failures:
+            failed.append(called)
+            context.abort(code, 'injected ' + called + ' failure')
+    monkeypatch.setattr(srl_fake_target.FakeTarget, 'delay_or_fail', delay_or_fail)
+
+def test_unavailable_get_is_retried_on_a_fresh_connection(fake_tor, monkeypatch):
+    failing(monkeypatch, 'get', 2)
+    target, session = fake_tor(synthetic_state('v23'), {'backoff' : 0.01})
+    assert srl_upgrade.run_gnmi_query(session, VERSION_PATH)
+    assert target.stats['get']['calls'] == 3
+    assert target.stats['capabilities']['calls'] == 3
+
+def test_exhausted_retries_raise_the_error(fake_tor, monkeypatch):
+    failing(monkeypatch, 'get', 10)
+    target, session = fake_tor(synthetic_state('v23'), {'retries' : 2, 'backoff' : 0.01})
+    with pytest.raises(srl_upgrade.gNMIException):
+        srl_upgrade.run_gnmi_query(session, VERSION_PATH)
+    assert target.stats['get']['calls'] == 3
+
+def test_rejected_get_is_not_retried(fake_tor, monkeypatch):
+    failing(monkeypatch, 'get', 1, grpc.StatusCode.NOT_FOUND)
+    target, session = fake_tor(synthetic_state('v23'), {'backoff' : 0.01})
+    with pytest.raises(srl_upgrade.gNMIException):
+        srl_upgrade.run_gnmi_query(session, VERSION_PATH)
+    assert target.stats['get']['calls'] == 1
+    assert target.stats['capabilities']['calls'] == 1
+
+def test_backoff_grows_up_to_max_backoff(fake_tor, monkeypatch):
+    failing(monkeypatch, 'get', 3)
+    waits = []
+    monkeypatch.setattr(srl_upgrade.random, 'uniform', lambda low, high: high)
+    monkeypatch.setattr(srl_upgrade.time, 'sleep', waits.append)
+    target, session = fake_tor(synthetic_state('v23'), {'backoff' : 0.5, 'max_backoff' : 1.5})
+    srl_upgrade.run_gnmi_query(session, VERSION_PATH)
+    assert waits == [0.5, 1.0, 1.5]
+
+def test_set_is_only_retried_when_asked(fake_tor, monkeypatch):
+    #A set that failed on the client may have been committed on the TOR
+    failing(monkeypatch, 'set', 1)
+    state = synthetic_state('v23')
+    target, session = fake_tor(state, {'backoff' : 0.01})
+    with pytest.raises(srl_upgrade.gNMIException):
+        session.set(update=[SHUTDOWN_UPDATE])
+    assert target.stats['set']['calls'] == 1
+    session.set(retry=True, update=[SHUTDOWN_UPDATE])
+    assert target.stats['set']['calls'] == 2
+
+def test_rpc_timeout_cancels_a_slow_get(fake_tor):
+    target, session = fake_tor(synthetic_state('v23'), {'retries' : 0, 'rpc_timeout' : 0.5}, latency=2)
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        srl_upgrade.run_gnmi_query(session, VERSION_PATH)
+    assert time.monotonic() - start < 1.5
+    assert session.gc is None
+
+def test_run_deadline_bounds_the_retries(fake_tor, monkeypatch):
+    failing(monkeypatch, 'get', 100)
+    target, session = fake_tor(synthetic_state('v23'), {'retries' : 100, 'backoff' : 0.2, 'max_backoff' : 0.2})
+    start = time.monotonic()
+    with srl_upgrade.run_deadline(session, 1):
+        with pytest.raises(srl_upgrade.gNMIException):
+            srl_upgrade.run_gnmi_query(session, VERSION_PATH)
+    assert time.monotonic() - start < 2
+    assert session.deadline is None
+    #An inner deadline does not extend an outer one
+    with srl_upgrade.run_deadline(session, 1):
+        outer = session.deadline
+        with srl_upgrade.run_deadline(session, 60):
+            assert session.deadline == outer
+
+def test_cancelled_session_stops_calling(fake_tor):
+    target, session = fake_tor(synthetic_state('v23'))
+    session.cancel()
+    with pytest.raises(srl_upgrade.SessionCancelled):
+        srl_upgrade.run_gnmi_query(session, VERSION_PATH)
+    assert target.stats['get']['calls'] == 0
+
+def test_sources_timeout():
+    session = srl_upgrade.GnmiSession(('127.0.0.1', 1), 'admin', 'admin', HOSTNAME)
+    assert srl_upgrade.sources_timeout(session, ['version', 'app']) == srl_upgrade.RPC_TIMEOUTS['default']
+    assert srl_upgrade.sources_timeout(session, ['version', 'network-instance']) == srl_upgrade.RPC_TIMEOUTS['network-instance']
+    #-rpc_timeout replaces the per path timeouts
+    session = srl_upgrade.GnmiSession(('127.0.0.1', 1), 'admin', 'admin', HOSTNAME, retry_policy={'rpc_timeout' : 5})
+    assert srl_upgrade.sources_timeout(session, ['version', 'network-instance']) == 5
+
+def test_close_of_a_replaced_channel_keeps_the_current_one(fake_tor):
+    #A call that timed out on an old channel must not close the one other threads moved to
+    target, session = fake_tor(synthetic_state('v23'))
+    old_channel = session.connect()
+    session.close()
+    current = session.connect()
+    session.close(old_channel)
+    assert session.gc is current
@@ -0,0 +1,24 @@
+import srl_upgrade
+from conftest import HOSTNAME, synthetic_state
+
+OPTIONS = {'batch' : False, 'batch_size' : 0, 'pruned' : False, 'flap_window' : 0.2, 'flap_sample_interval' : 0.1}
+
+def test_one_connection_for_the_whole_check(fake_tor, workdir):
+    #Collection, flap check and the port index all go over the channel opened once, the target sees one handshake
+    target, session = fake_tor(synthetic_state('v23'))
+    channel = session.connect()
+    tor_data = srl_upgrade.collect_and_check(session, HOSTNAME, 'precheck', OPTIONS)
+    assert session.gc is channel
+    assert target.stats['capabilities']['calls'] == 1
+    assert target.stats['get']['calls'] > len(srl_upgrade.COLLECTION_PATHS)
+    assert target.stats['subscribe']['calls'] == 1
+    assert tor_data['port-shutdown'][HOSTNAME]
+
+def test_close_and_reconnect(fake_tor):
+    target, session = fake_tor(synthetic_state('v23'))
+    channel = session.connect()
+    session.close()
+    assert session.gc is None
+    assert srl_upgrade.run_gnmi_query(session, srl_upgrade.COLLECTION_PATHS['version'])
+    assert session.gc is not None and session.gc is not channel
+    assert target.stats['capabilities']['calls'] == 2
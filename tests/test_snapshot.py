@@ -0,0 +1,58 @@
+import json
+import os
+
+import srl_upgrade
+import pytest
+from conftest import HOSTNAME, synthetic_state
+
+@pytest.fixture
+def tor_data(fake_tor):
+    target, session = fake_tor(synthetic_state('v23'))
+    return srl_upgrade.collect_tor_data(session, HOSTNAME)
+
+@pytest.mark.parametrize('codec', ['gzip', 'zstd'])
+@pytest.mark.parametrize('encoding', ['json', 'msgpack'])
+def test_snapshot_round_trip(workdir, tor_data, codec, encoding):
+    if codec == 'zstd':
+        pytest.importorskip('zstandard')
+    if encoding == 'msgpack':
+        pytest.importorskip('msgpack')
+    sections = {section : tor_data[section] for section in srl_upgrade.SAVED_SECTIONS if section in tor_data}
+    digests = srl_upgrade.section_digests(sections, HOSTNAME)
+    srl_upgrade.write_snapshot(srl_upgrade.snapshot_file_name(HOSTNAME, 'before'), sections, HOSTNAME, 'before', codec, encoding, digests)
+    for section in sections:
+        #The data the json files would have loaded back
+        assert srl_upgrade.load_section(HOSTNAME, 'before', section) == json.loads(json.dumps(sections[section]))
+    assert srl_upgrade.load_digests(HOSTNAME, 'before') == digests
+    with open(srl_upgrade.snapshot_file_name(HOSTNAME, 'before'), 'rb') as infile:
+        header = srl_upgrade.read_snapshot_header(infile, srl_upgrade.snapshot_file_name(HOSTNAME, 'before'))
+    assert (header['version'], header['codec'], header['encoding']) == (2, codec, encoding)
+    assert sorted(header['sections']['bgp']['children']) == sorted(sections['bgp'][HOSTNAME])
+
+def test_load_section_children_reads_only_the_asked_children(workdir, tor_data):
+    srl_upgrade.save_data(tor_data, HOSTNAME, 'precheck', 'snapshot')
+    children = sorted(tor_data['interface'][HOSTNAME])[:2] + ['ethernet-9/9']
+    assert srl_upgrade.load_section_children(HOSTNAME, 'before', 'interface', children) == {
+        child : json.loads(json.dumps(tor_data['interface'][HOSTNAME][child])) for child in children[:2]}
+
+def test_newer_snapshot_version_is_refused(workdir, tor_data):
+    srl_upgrade.save_data(tor_data, HOSTNAME, 'precheck', 'snapshot')
+    snapshot_file = srl_upgrade.snapshot_file_name(HOSTNAME, 'before')
+    with open(snapshot_file, 'rb') as infile:
+        header = json.loads(infile.readline())
+        data = infile.read()
+    header['version'] = srl_upgrade.SNAPSHOT_VERSION + 1
+    with open(snapshot_file, 'wb') as outfile:
+        outfile.write(json.dumps(header).encode() + b'\n' + data)
+    with pytest.raises(SystemExit):
+        srl_upgrade.load_section(HOSTNAME, 'before', 'version')
+
+def test_switching_format_removes_the_other_one(workdir, tor_data):
+    #The loaders prefer the snapshot, so whichever format was saved last has to be the only one left
+    srl_upgrade.save_data(tor_data, HOSTNAME, 'precheck', 'json')
+    srl_upgrade.save_data(tor_data, HOSTNAME, 'precheck', 'snapshot')
+    assert os.path.exists(srl_upgrade.snapshot_file_name(HOSTNAME, 'before'))
+    assert not os.path.exists(HOSTNAME + '-before')
+    srl_upgrade.save_data(tor_data, HOSTNAME, 'precheck', 'json')
+    assert not os.path.exists(srl_upgrade.snapshot_file_name(HOSTNAME, 'before'))
+    assert srl_upgrade.load_section(HOSTNAME, 'before', 'version') == tor_data['version']
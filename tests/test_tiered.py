@@ -0,0 +1,60 @@
+import time
+
+import grpc
+import srl_fake_target
+import srl_upgrade
+import pytest
+from conftest import HOSTNAME, synthetic_state
+
+OPTIONS = {'batch' : False, 'batch_size' : 0, 'pruned' : False, 'flap_window' : 0.2, 'flap_sample_interval' : 0.1, 'tiered' : True}
+
+def pre_checked(fake_tor):
+    #A TOR with its pre check saved, to run tiered post checks against
+    state = synthetic_state('v23')
+    target, session = fake_tor(state, retry_policy={'retries' : 0, 'rpc_timeout' : 1})
+    srl_upgrade.save_data(srl_upgrade.collect_and_check(session, HOSTNAME, 'precheck', OPTIONS), HOSTNAME, 'precheck')
+    return state, target, session
+
+def statistics_get(failure):
+    #A Get that fails (or stalls) the gets asking for the statistics counters and answers the rest. The target serves
+    #the methods it had when it started
+    original = srl_fake_target.FakeTarget.Get
+    def get(self, request, context):
+        if 'statistics' in str(request):
+            if failure == 'slow':
+                time.sleep(2)
+            else:
+                context.abort(grpc.StatusCode.UNAVAILABLE, 'statistics are not ready')
+        return original(self, request, context)
+    return get
+
+def test_unchanged_sections_are_skipped(fake_tor, workdir):
+    state, target, session = pre_checked(fake_tor)
+    tor_data = srl_upgrade.collect_and_check(session, HOSTNAME, 'postcheck', OPTIONS)
+    assert sorted(srl_upgrade.skipped_sections(tor_data, HOSTNAME)) == sorted(srl_upgrade.TIERED_SECTIONS)
+    assert 'mac' not in tor_data and 'arp' not in tor_data
+
+def test_changed_section_is_collected(fake_tor, workdir):
+    state, target, session = pre_checked(fake_tor)
+    mac_vrf = [instance for instance in state['network-instance'] if instance['name'] == 'mac-vrf-1'][0]
+    del mac_vrf['bridge-table']['mac-learning']['learnt-entries']['mac'][0]
+    srl_fake_target.refresh_counters(state)
+    tor_data = srl_upgrade.collect_and_check(session, HOSTNAME, 'postcheck', OPTIONS)
+    assert 'mac' not in srl_upgrade.skipped_sections(tor_data, HOSTNAME)
+    assert len(tor_data['mac'][HOSTNAME]['mac-vrf-1']) == 3
+
+@pytest.mark.parametrize('failure', ['slow', 'unavailable'])
+def test_statistics_failure_falls_back_to_full_collection(fake_tor, workdir, monkeypatch, failure):
+    #A TOR still settling after its reboot does not answer the counters, the post check collects everything instead
+    monkeypatch.setattr(srl_fake_target.FakeTarget, 'Get', statistics_get(failure))
+    state, target, session = pre_checked(fake_tor)
+    tor_data = srl_upgrade.collect_and_check(session, HOSTNAME, 'postcheck', OPTIONS)
+    assert srl_upgrade.skipped_sections(tor_data, HOSTNAME) == []
+    assert tor_data['quick-check'][HOSTNAME]['error']
+    assert tor_data['mac'] == srl_upgrade.load_section(HOSTNAME, 'before', 'mac')
+
+def test_cancelled_session_is_not_a_fallback(fake_tor, workdir):
+    state, target, session = pre_checked(fake_tor)
+    session.cancel()
+    with pytest.raises(srl_upgrade.SessionCancelled):
+        srl_upgrade.quick_check(session, HOSTNAME, OPTIONS)
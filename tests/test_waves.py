@@ -0,0 +1,65 @@
+import srl_waves
+import pytest
+
+def inventory(groups):
+    #{group : TOR count} -> inventory devices named <group>-<n>
+    devices = []
+    for group in groups:
+        for number in range(1, groups[group] + 1):
+            devices.append({'hostname' : group + '-' + str(number), 'ip' : '192.0.2.' + str(len(devices) + 1), 'group' : group})
+    return devices
+
+def check_plan(devices, waves, parallelism, max_drained_per_group):
+    assert sorted(device['hostname'] for wave in waves for device in wave) == sorted(device['hostname'] for device in devices)
+    for wave in waves:
+        assert wave
+        if parallelism:
+            assert len(wave) <= parallelism
+        for group in set(device['group'] for device in wave):
+            assert sum(device['group'] == group for device in wave) <= max_drained_per_group
+
+@pytest.mark.parametrize('groups, parallelism, max_drained_per_group, wave_count', [
+    #mlag pairs: one of each pair per wave
+    ({'rack1' : 2, 'rack2' : 2, 'rack3' : 2}, 0, 1, 2),
+    ({'rack1' : 2, 'rack2' : 2, 'rack3' : 2}, 2, 1, 3),
+    #The largest group sets the number of waves
+    ({'rack1' : 4, 'rack2' : 1, 'rack3' : 1}, 0, 1, 4),
+    ({'rack1' : 4, 'rack2' : 1, 'rack3' : 1}, 0, 2, 2),
+    #Every TOR its own group, parallelism sets the number of waves
+    ({'tor' + str(number) : 1 for number in range(10)}, 4, 1, 3),
+])
+def test_plan_waves(groups, parallelism, max_drained_per_group, wave_count):
+    devices = inventory(groups)
+    waves = srl_waves.plan_waves(devices, parallelism, max_drained_per_group)
+    check_plan(devices, waves, parallelism, max_drained_per_group)
+    assert len(waves) == wave_count
+
+def test_plan_waves_takes_the_largest_groups_first():
+    #Leaving the group of 3 for later would need a fourth wave
+    devices = inventory({'rack1' : 1, 'rack2' : 1, 'rack3' : 3})
+    waves = srl_waves.plan_waves(devices, 2, 1)
+    check_plan(devices, waves, 2, 1)
+    assert len(waves) == 3
+    assert all('rack3' in [device['group'] for device in wave] for wave in waves)
+
+def test_drained_tor_holds_back_its_group(monkeypatch, workdir):
+    #A TOR left drained by a failure still counts against its group, so the other TOR of the pair is not taken down
+    def run_tor(device, policy, options, compare_workers=None):
+        failed = device['hostname'] == 'rack1-1'
+        return {'ip' : device['ip'], 'group' : device['group'], 'status' : 'failed' if failed else 'ok', 'phase' : 'upgrade', 'drained' : failed,
+                'error' : 'upgrade failed' if failed else None, 'version_before' : 'v23.10.1', 'version_after' : 'v24.3.1', 'differences' : [], 'durations' : {}}
+    monkeypatch.setattr(srl_waves, 'run_tor', run_tor)
+    policy = dict(srl_waves.DEFAULT_WAVE_POLICY, parallelism=0, max_failed=10)
+    report = srl_waves.run_waves(inventory({'rack1' : 2, 'rack2' : 2}), policy, {})
+    statuses = {hostname : result['status'] for wave in report['waves'] for hostname, result in wave['devices'].items()}
+    assert statuses == {'rack1-1' : 'failed', 'rack2-1' : 'ok', 'rack1-2' : 'skipped', 'rack2-2' : 'ok'}
+    assert report['drained'] == ['rack1-1']
+
+def test_failures_halt_the_next_wave(monkeypatch, workdir):
+    def run_tor(device, policy, options, compare_workers=None):
+        return {'ip' : device['ip'], 'group' : device['group'], 'status' : 'failed', 'phase' : 'post_check', 'drained' : False, 'error' : 'post check differs',
+                'version_before' : 'v23.10.1', 'version_after' : 'v24.3.1', 'differences' : ['bgp'], 'durations' : {}}
+    monkeypatch.setattr(srl_waves, 'run_tor', run_tor)
+    report = srl_waves.run_waves(inventory({'rack1' : 2, 'rack2' : 2}), dict(srl_waves.DEFAULT_WAVE_POLICY, parallelism=0), {})
+    assert len(report['waves']) == 1
+    assert report['halted'] == 'stopped before wave 2, 2 TORs failed'